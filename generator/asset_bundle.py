@@ -0,0 +1,180 @@
+import io
+import mmap
+import os
+import posixpath
+import struct
+import tarfile
+import zipfile
+import zlib
+
+WATCHFACE_INFO = "watchface_info.json"
+
+# Zip local file header, see APPNOTE.TXT 4.3.7
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# What zipfile, tarfile and their decompressors raise for an archive that ends early or is
+# damaged
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error)
+
+
+class AssetBundle(object):
+    """
+    A zip or tar archive holding watchface_info.json next to the raw asset files it references,
+    e.g. "font_data": {"file": "font_time.ttf"}. Paths are relative to watchface_info.json.
+
+    Files are mapped into memory rather than read, and assets that are stored uncompressed
+    (zip stored entries, plain tar) are handed out as memoryviews without being copied.
+    """
+
+    def __init__(self, source):
+        """
+        source is a path, a bytes-like object or a binary file object
+        """
+
+        # The archive is parsed through fileobj, asset views are sliced out of buffer
+        self.mmap = None
+        self.file = None
+        self.view = None
+        self.zip_file = None
+        self.tar_file = None
+        try:
+            self._open(source)
+        except ARCHIVE_ERRORS as e:
+            self.close()
+            raise ValueError("Asset bundle is truncated or corrupt: {}".format(e))
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            self.file = open(source, 'rb')
+            if os.fstat(self.file.fileno()).st_size == 0:
+                # mmap can't map an empty file
+                raise ValueError("Asset bundle is empty")
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = self.mmap
+            fileobj = self.file
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            buffer = source
+            fileobj = io.BytesIO(source)
+        else:
+            try:
+                self.mmap = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+                buffer = self.mmap
+                fileobj = source
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                # Not backed by a real file (e.g. a BytesIO or a socket)
+                buffer = source.read()
+                fileobj = io.BytesIO(buffer)
+
+        self.view = memoryview(buffer)
+        if not self.view.nbytes:
+            raise ValueError("Asset bundle is empty")
+        self.tar_compressed = False
+
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            self.zip_file = zipfile.ZipFile(fileobj)
+            names = self.zip_file.namelist()
+        else:
+            fileobj.seek(0)
+            try:
+                self.tar_file = tarfile.open(fileobj=fileobj, mode='r:')
+            except tarfile.ReadError:
+                fileobj.seek(0)
+                try:
+                    self.tar_file = tarfile.open(fileobj=fileobj, mode='r:*')
+                except tarfile.ReadError:
+                    raise ValueError("Asset bundle is neither a zip nor a tar archive")
+                self.tar_compressed = True
+            names = [m.name for m in self.tar_file.getmembers() if m.isfile()]
+
+        info_paths = [name for name in names if posixpath.basename(name) == WATCHFACE_INFO]
+        if len(info_paths) != 1:
+            raise ValueError("Asset bundle must contain exactly one {}, found {}".format(
+                WATCHFACE_INFO, len(info_paths)))
+        self.info_path = info_paths[0]
+        self.base_dir = posixpath.dirname(self.info_path)
+
+    def read_watchface_info(self):
+        return str(self._read_member(self.info_path), 'utf-8')
+
+    def read(self, name):
+        """
+        Returns the contents of the asset name (relative to watchface_info.json) as a
+        bytes-like object.
+        """
+
+        relative_path = posixpath.normpath(name)
+        if relative_path.startswith('../') or relative_path == '..' or posixpath.isabs(name):
+            raise ValueError("Asset path {} points outside of the directory of {}".format(
+                name, WATCHFACE_INFO))
+        return self._read_member(posixpath.join(self.base_dir, relative_path))
+
+    def _read_member(self, path):
+        if self.zip_file is not None:
+            try:
+                info = self.zip_file.getinfo(path)
+            except KeyError:
+                raise ValueError("Asset {} not found in bundle".format(path))
+
+            if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+                try:
+                    return self.zip_file.read(info)
+                except ARCHIVE_ERRORS as e:
+                    raise ValueError("Asset {} in bundle is truncated or corrupt: {}".format(
+                        path, e))
+
+            # Stored entries are raw bytes in the archive, just point at them
+            header = ZIP_LOCAL_HEADER.unpack_from(self.view, info.header_offset)
+            if header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+                raise ValueError("Corrupt zip entry {} in bundle".format(path))
+            name_length, extra_length = header[9], header[10]
+            start = info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+            return self._slice(path, start, info.file_size)
+
+        try:
+            member = self.tar_file.getmember(path)
+        except KeyError:
+            raise ValueError("Asset {} not found in bundle".format(path))
+        if not member.isfile():
+            raise ValueError("Asset {} in bundle is not a regular file".format(path))
+
+        if self.tar_compressed:
+            try:
+                return self.tar_file.extractfile(member).read()
+            except ARCHIVE_ERRORS as e:
+                raise ValueError("Asset {} in bundle is truncated or corrupt: {}".format(path, e))
+        return self._slice(path, member.offset_data, member.size)
+
+    def _slice(self, path, start, size):
+        if start + size > self.view.nbytes:
+            raise ValueError("Asset {} in bundle is truncated".format(path))
+        return self.view[start:start + size]
+
+    def close(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+        if self.tar_file is not None:
+            self.tar_file.close()
+        if self.view is not None:
+            self.view.release()
+        if self.file is not None:
+            self.file.close()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # Someone is still holding on to an asset, the map goes away with them
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def is_asset_bundle(path):
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
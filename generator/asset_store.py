@@ -0,0 +1,189 @@
+import copy
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from base64 import decodebytes
+
+# Keys in watchface_info['customization'] that hold assets
+ASSET_KEYS = ('image_data', 'bw_image_data', 'font_data')
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DIGEST_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class AssetNotFound(KeyError):
+    """
+    Raised when watchface_info references an asset the store doesn't have (or has evicted).
+    The client should upload it again.
+    """
+    pass
+
+
+class AssetStore(object):
+    """
+    Local content-addressed store for watchface assets. Assets are files named by their sha256,
+    so watchface_info can reference them as {"sha256": <hex digest>} instead of carrying them
+    inline. The store is capped at max_bytes, least recently used assets are evicted first.
+
+    Files are written atomically, so several processes can share one store directory.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Size of the store as of the last walk plus what this process added since, None until
+        # the first walk. Other processes' assets are only counted from the next walk.
+        self.estimated_bytes = None
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest):
+        if not DIGEST_RE.match(digest):
+            raise ValueError("Invalid asset digest {!r}".format(digest))
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data, evict=True):
+        """
+        Add data to the store, returns its sha256 hex digest. With evict=False the store may
+        stay over max_bytes until the next evict().
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+
+        if os.path.exists(path):
+            # Already have it, just mark it as recently used
+            os.utime(path)
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        with self.lock:
+            if self.estimated_bytes is not None:
+                self.estimated_bytes += memoryview(data).nbytes
+        if evict:
+            self.evict()
+        return digest
+
+    def get(self, digest):
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            raise AssetNotFound(digest)
+
+        os.utime(path)
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def __contains__(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used assets until the store fits in max_bytes, apart from the
+        digests in keep. The store is only walked when it may have grown past max_bytes.
+        """
+
+        with self.lock:
+            if self.estimated_bytes is not None and self.estimated_bytes <= self.max_bytes:
+                return
+
+        keep_paths = {self._path(digest) for digest in keep}
+        entries = []
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for name in file_names:
+                if not DIGEST_RE.match(name):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep_paths:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self.lock:
+                self.evictions += 1
+        with self.lock:
+            self.estimated_bytes = total
+
+    def ingest_watchface_info(self, watchface_info):
+        """
+        Store every inline (base64) asset in watchface_info. Returns a copy of watchface_info
+        with the assets replaced by {"sha256": <digest>} references. Eviction runs once at the
+        end and never removes the assets this watchface_info references.
+        """
+
+        watchface_info = copy.deepcopy(watchface_info)
+        digests = set()
+
+        def ingest(section):
+            for key, value in section.items():
+                if key in ASSET_KEYS and isinstance(value, str):
+                    digest = self.put(decodebytes(bytes(value, 'utf-8')), evict=False)
+                    section[key] = {'sha256': digest}
+                    digests.add(digest)
+                elif key in ASSET_KEYS and isinstance(value, dict) and 'sha256' in value:
+                    digests.add(value['sha256'])
+                elif isinstance(value, dict):
+                    ingest(value)
+
+        ingest(watchface_info['customization'])
+        self.evict(keep=digests)
+        return watchface_info
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='move the assets of a watchface_info.json into an asset store')
+
+    parser.add_argument('store_dir', help='path to the asset store')
+    parser.add_argument('info_path', help='path to watchface_info.json')
+    parser.add_argument('output_path', help='where to write the watchface_info.json with references')
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='size cap for the store')
+
+    args = parser.parse_args()
+
+    with open(args.info_path, 'r') as f:
+        watchface_info = json.load(f)
+
+    store = AssetStore(args.store_dir, args.max_bytes)
+    with open(args.output_path, 'w') as f:
+        json.dump(store.ingest_watchface_info(watchface_info), f, indent=4)
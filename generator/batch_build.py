@@ -0,0 +1,293 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO, StringIO
+
+from asset_bundle import AssetBundle
+from asset_store import AssetStore
+from build_memory import MIB, MemoryTracer
+from build_metrics import REGISTRY
+from build_profile import PROFILE_MODES, BuildProfiler
+from build_trace import NULL_TRACER
+from create_watchface import parse_watchface_info, watchface_pbw_name, write_watchface
+from pbw_writer import COMPRESSION_TYPES
+from streaming_json import load_watchface_info
+
+BUNDLE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+INFO_FILENAME = 'watchface_info.json'
+# Jobs queued per worker, so a long JSONL stream isn't read into memory all at once
+JOBS_PER_WORKER = 2
+
+# Per-process state, set up once by _init_worker
+_worker = {}
+
+
+def find_jobs(inputs):
+    """
+    Yields (label, kind, source) for every watchface in inputs. An input is a directory (searched
+    for watchface_info.json files and asset bundles), a glob, a JSONL file with one
+    watchface_info per line, '-' for JSONL on stdin, or a single watchface_info.json/bundle.
+    """
+
+    for path in inputs:
+        if path == '-':
+            yield from _jsonl_jobs('<stdin>', sys.stdin)
+        elif path.endswith('.jsonl'):
+            with open(path, 'r') as f:
+                yield from _jsonl_jobs(path, f)
+        elif os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for name in sorted(file_names):
+                    if name == INFO_FILENAME or name.endswith(BUNDLE_EXTENSIONS):
+                        yield from _file_jobs(os.path.join(dir_path, name))
+        elif glob.has_magic(path):
+            for match in sorted(glob.glob(path, recursive=True)):
+                yield from _file_jobs(match)
+        else:
+            yield from _file_jobs(path)
+
+
+def _file_jobs(path):
+    kind = 'bundle' if path.endswith(BUNDLE_EXTENSIONS) else 'file'
+    yield path, kind, path
+
+
+def _jsonl_jobs(name, lines):
+    for line_number, line in enumerate(lines, start=1):
+        if line.strip():
+            yield f'{name}:{line_number}', 'inline', line
+
+
+def _init_worker(template_pbw_path, output_dir, asset_store_dir, options, profile=None,
+                 memory_budget=None):
+    # Runs once per worker process, so every job shares the loaded template and modules
+    with open(template_pbw_path, 'rb') as f:
+        _worker['template_pbw_stream'] = BytesIO(f.read())
+    _worker['output_dir'] = output_dir
+    _worker['asset_store'] = AssetStore(asset_store_dir) if asset_store_dir else None
+    _worker['options'] = options
+    # (profile directory, profile mode) or None
+    _worker['profile'] = profile
+    _worker['memory_budget'] = memory_budget
+
+
+def _write_output(watchface_info, bundle=None, tracer=NULL_TRACER):
+    # Writes the pbw to a temp file of its own in output_dir, returns (temp path, output path).
+    # run_batch moves it into place, other jobs may have a watchface with the same name.
+    pbw_name = watchface_pbw_name(watchface_info)
+    output_path = os.path.join(_worker['output_dir'], pbw_name)
+    # Not mkstemp, the pbw should get the usual permissions
+    temp_path = os.path.join(_worker['output_dir'], f'.{pbw_name}.{uuid.uuid4().hex}.tmp')
+    f_out = open(temp_path, 'xb')
+    try:
+        with f_out:
+            write_watchface(f_out, watchface_info, _worker['template_pbw_stream'], bundle,
+                            _worker['asset_store'], tracer=tracer, **_worker['options'])
+    except BaseException:
+        # Don't leave half a pbw behind
+        os.unlink(temp_path)
+        raise
+    return temp_path, output_path
+
+
+def build_job(index, label, kind, source):
+    """
+    Build one watchface inside a worker. Never raises, failures are reported in the result. The
+    pbw is left in result['temp_output'] for run_batch to move to result['output'].
+    """
+
+    start = time.perf_counter()
+    result = {'index': index, 'source': label}
+    profiler = None
+    if _worker['profile'] is not None:
+        profiler = BuildProfiler(_worker['profile'][1])
+        profiler.start()
+    tracer = NULL_TRACER
+    if _worker['memory_budget'] is not None:
+        tracer = MemoryTracer(_worker['memory_budget'], snapshot_top=0)
+    try:
+        if kind == 'bundle':
+            with AssetBundle(source) as bundle:
+                temp_path, output_path = _write_output(
+                    parse_watchface_info(bundle.read_watchface_info()), bundle, tracer)
+        elif kind == 'file':
+            with open(source, 'rb') as f:
+                watchface_info = load_watchface_info(f)
+            temp_path, output_path = _write_output(watchface_info, tracer=tracer)
+        else:
+            temp_path, output_path = _write_output(load_watchface_info(StringIO(source)),
+                                                   tracer=tracer)
+        result['status'] = 'ok'
+        result['temp_output'] = temp_path
+        result['output'] = output_path
+        result['size'] = os.path.getsize(temp_path)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+    if tracer is not NULL_TRACER:
+        tracer.close()
+        result['memory_peak'] = tracer.peak_traced
+    result['seconds'] = round(time.perf_counter() - start, 4)
+    if profiler is not None:
+        profiler.stop()
+        result['profile'] = profiler.write(os.path.join(_worker['profile'][0], f'job-{index}'))
+    # Merged into the parent's metrics by run_batch
+    result['metrics'] = REGISTRY.drain()
+    return result
+
+
+def _output_collision(result, other):
+    result['status'] = 'error'
+    result['error'] = f"OutputCollision: {other['source']} has the same pbw name, " \
+                      f"{result['output']}"
+    del result['output'], result['size']
+
+
+def _move_output(result, outputs):
+    """
+    Move a finished job's pbw into place. outputs is {output path: result} of the jobs moved so
+    far. When several jobs have the same pbw name the first in input order keeps it, whichever
+    finishes first, and the others fail. Returns the earlier result that lost its pbw, if any.
+    """
+
+    temp_path = result.pop('temp_output')
+    claimed = outputs.get(result['output'])
+    if claimed is not None and claimed['index'] < result['index']:
+        os.unlink(temp_path)
+        _output_collision(result, claimed)
+        return None
+
+    os.replace(temp_path, result['output'])
+    outputs[result['output']] = result
+    if claimed is not None:
+        _output_collision(claimed, result)
+    return claimed
+
+
+def run_batch(template_pbw_path, inputs, output_dir, workers=None, asset_store_dir=None,
+              profile_dir=None, profile_mode='cprofile', memory_budget=None, **options):
+    """
+    Build every watchface found in inputs (see find_jobs) into output_dir with a pool of worker
+    processes. options are passed on to write_watchface. Returns a report dict with a result per
+    job, in input order. The workers' metrics end up in build_metrics.REGISTRY. With a
+    profile_dir every job is profiled (see BuildProfiler) into profile_dir/job-<index>.* With a
+    memory_budget (bytes) jobs that use more memory than that fail instead of running the
+    worker out of memory, and every result has its memory_peak. When several watchfaces have the
+    same pbw name, the first one in input order is kept and the others fail.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    profile = None
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profile = (profile_dir, profile_mode)
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    results = []
+    # output path -> the result that was moved there
+    outputs = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(template_pbw_path, output_dir, asset_store_dir,
+                                       options, profile, memory_budget)) as executor:
+        pending = {}
+        jobs = enumerate(find_jobs(inputs))
+        jobs_left = True
+        while jobs_left or pending:
+            while jobs_left and len(pending) < workers * JOBS_PER_WORKER:
+                try:
+                    index, (label, kind, source) = next(jobs)
+                except StopIteration:
+                    jobs_left = False
+                    break
+                future = executor.submit(build_job, index, label, kind, source)
+                pending[future] = (index, label)
+
+            if not pending:
+                break
+            done = wait(pending, return_when=FIRST_COMPLETED).done
+            for future in done:
+                index, label = pending.pop(future)
+                try:
+                    result = future.result()
+                    REGISTRY.merge(result.pop('metrics'))
+                except Exception as e:
+                    # The worker itself died (e.g. killed by the OS), not just the build
+                    result = {'index': index, 'source': label, 'status': 'error',
+                              'error': f'{type(e).__name__}: {e}'}
+                if result['status'] == 'ok':
+                    replaced = _move_output(result, outputs)
+                    if replaced is not None:
+                        print(f"[{replaced['status']}] {replaced['source']}: {replaced['error']}")
+                results.append(result)
+                print(f"[{result['status']}] {label}" +
+                      (f": {result['error']}" if result['status'] != 'ok' else ''))
+
+    results.sort(key=lambda r: r['index'])
+
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    return {
+        'jobs': results,
+        'total': len(results),
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'workers': workers,
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='build many watchfaces with a pool of workers')
+
+    parser.add_argument('template_pbw_path', help='path to template pbw')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories, globs, watchface_info.json files, asset bundles or '
+                             'JSONL files (one watchface_info per line, - for stdin)')
+    parser.add_argument('output_dir', help='path to output directory')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--report', help='write a json report with the status and timing of each job')
+    parser.add_argument('--metrics', help='write the cumulative build metrics here, in the '
+                                          'Prometheus text format (e.g. for a textfile collector)')
+    parser.add_argument('--asset-store', help='asset store to resolve {"sha256": ...} assets from')
+    parser.add_argument('--compression', choices=COMPRESSION_TYPES.keys(), default='deflate',
+                        help='how files are stored in the pbws')
+    parser.add_argument('--compression-level', type=int, help='deflate level, 0-9')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='derive uuids and timestamps from the input')
+    parser.add_argument('--profile-dir',
+                        help='profile every job, writes job-<index>.pstats/.collapsed here')
+    parser.add_argument('--profile-mode', choices=PROFILE_MODES, default='cprofile',
+                        help='cprofile is exact but slows builds down, sample has little overhead')
+    parser.add_argument('--memory-budget', type=float, metavar='MIB',
+                        help='fail jobs that use more than this many MiB')
+
+    args = parser.parse_args()
+    # Progress of long builds, e.g. extended fonts, is logged. Forked workers inherit this.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    report = run_batch(args.template_pbw_path, args.inputs, args.output_dir, args.workers,
+                       args.asset_store, args.profile_dir, args.profile_mode,
+                       int(args.memory_budget * MIB) if args.memory_budget else None,
+                       compression=COMPRESSION_TYPES[args.compression],
+                       compresslevel=args.compression_level, reproducible=args.reproducible)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(REGISTRY.render())
+
+    print(f"{report['succeeded']}/{report['total']} watchfaces built in {report['seconds']}s "
+          f"with {report['workers']} workers")
+    sys.exit(1 if report['failed'] else 0)
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import platform as host_platform
+import statistics
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+import png2pblpng
+import stm32_crc
+from create_watchface import create_watchface, load_asset
+from font.face_pool import face_pool
+from pbpack import ResourcePack
+from resources.resource_map.resource_generator_font import FontResourceGenerator
+from resources.resource_map.resource_generator_png import PngResourceGenerator
+from resources.waftools.generate_pbpack import generate_pbpack
+from templates import TEXT_FONT_DICT
+
+GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.join(GENERATOR_DIR, '..', 'samples', 'resources')
+TEMPLATE_PBW = 'template-watchface.pbw'
+SAMPLES = ('googly-eyes', 'hollow-knight', 'horizontal-stripes', 'vertical-stripes')
+# The micro benchmarks use the assets of this sample
+MICRO_SAMPLE = 'hollow-knight'
+FONT_SIZES = (14, 28, 42)
+CRC_BYTES = 1024 * 1024
+# Entry points, and the generators they only import once a font or png is built
+IMPORT_MODULES = ('create_watchface', 'batch_build', 'build_server', 'pbpack',
+                  'resources.resource_map.resource_generator_font',
+                  'resources.resource_map.resource_generator_png')
+RESULTS_VERSION = 1
+# Results of a full run on the reference machine, see --baseline
+BASELINE_PATH = os.path.join(GENERATOR_DIR, 'benchmark_baseline.json')
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+
+
+def load_sample(name):
+    with open(os.path.join(SAMPLES_DIR, name, 'watchface_info.json'), 'r') as f:
+        return json.load(f)
+
+
+def micro_benchmarks():
+    """
+    Yields (name, fn) for the component benchmarks: CRC, png conversion per palette, font build
+    per size and pbpack serialization
+    """
+
+    customization = load_sample(MICRO_SAMPLE)['customization']
+    background = load_asset(customization['background']['image_data'])
+    font = load_asset(customization['text']['font_data'])
+
+    crc_data = bytes(range(256)) * (CRC_BYTES // 256)
+    yield 'micro/crc/1MiB', lambda: stm32_crc.crc32(crc_data)
+
+    for palette in png2pblpng.SUPPORTED_PALETTES:
+        yield (f'micro/png/{palette}',
+               lambda palette=palette: png2pblpng.convert_png_to_pebble_png_bytes(background, palette))
+
+    def build_font(definition):
+        # Start from an empty face pool, so parsing the TTF is part of every run
+        face_pool.clear()
+        FontResourceGenerator.generate_object('basalt', definition)
+
+    for size in FONT_SIZES:
+        font_dict = dict(TEXT_FONT_DICT, name=f'FONT_TEXT_{size}', data=font)
+        definition = FontResourceGenerator.definitions_from_dict('basalt', font_dict)[0]
+        yield f'micro/font/{size}', lambda definition=definition: build_font(definition)
+
+    png_dict = {'name': 'IMAGE_BACKGROUND', 'type': 'png', 'data': background}
+    font_dict = dict(TEXT_FONT_DICT, name='FONT_TEXT_20', data=font)
+    resource_pack = generate_pbpack('basalt', [(png_dict, PngResourceGenerator),
+                                               (font_dict, FontResourceGenerator)])[0]
+
+    def serialize():
+        pack = ResourcePack(False)
+        for content in resource_pack.contents:
+            pack.add_resource(content)
+        pack.serialize(BytesIO())
+    yield 'micro/pbpack/serialize', serialize
+
+
+def macro_benchmarks():
+    """
+    Yields (name, fn) for full builds of every sample, with all of its platforms and with each
+    platform alone
+    """
+
+    with open(os.path.join(SAMPLES_DIR, TEMPLATE_PBW), 'rb') as f:
+        template = f.read()
+
+    for sample in SAMPLES:
+        info = load_sample(sample)
+        yield (f'macro/{sample}/all',
+               lambda info=info: create_watchface(info, BytesIO(template)))
+        for platform in info['metadata']['target_platforms']:
+            platform_info = dict(info, metadata=dict(info['metadata'], target_platforms=[platform]))
+            yield (f'macro/{sample}/{platform}',
+                   lambda info=platform_info: create_watchface(info, BytesIO(template)))
+
+
+def import_seconds(module):
+    """
+    How long importing module and everything it imports takes in a fresh interpreter, as
+    reported by python -X importtime, so interpreter start up isn't counted
+    """
+
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=GENERATOR_DIR, capture_output=True, text=True, check=True).stderr
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        # import time: self [us] | cumulative | imported package
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.strip() == module:
+            return int(cumulative_us) / 1e6
+    raise ValueError(f"python -X importtime didn't report an import of {module}")
+
+
+def import_benchmarks():
+    """
+    Yields (name, fn) for the import time of each of IMPORT_MODULES, fn returns the seconds
+    """
+
+    for module in IMPORT_MODULES:
+        yield f'import/{module}', lambda module=module: import_seconds(module)
+
+
+def summarize(times, repeat):
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'repeat': repeat,
+    }
+
+
+def time_benchmark(fn, repeat, warmup=1):
+    for i in range(warmup):
+        fn()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return summarize(times, repeat)
+
+
+def run_benchmarks(micro=True, macro=True, repeat=DEFAULT_REPEAT, name_filter=None, imports=True):
+    """
+    Runs the benchmarks, returns a results dict (see compare_results) with the timings in seconds
+    """
+
+    benchmarks = []
+    if imports:
+        benchmarks.extend((name, fn, True) for name, fn in import_benchmarks())
+    if micro:
+        benchmarks.extend((name, fn, False) for name, fn in micro_benchmarks())
+    if macro:
+        benchmarks.extend((name, fn, False) for name, fn in macro_benchmarks())
+
+    results = {}
+    for name, fn, measures_itself in benchmarks:
+        if name_filter and name_filter not in name:
+            continue
+        if measures_itself:
+            # Every run is a fresh interpreter, the first one warms up the bytecode cache
+            fn()
+            results[name] = summarize([fn() for i in range(repeat)], repeat)
+        else:
+            results[name] = time_benchmark(fn, repeat)
+        print(f"{name:<40} {results[name]['median'] * 1000:10.2f}ms "
+              f"(min {results[name]['min'] * 1000:.2f}ms)")
+
+    return {
+        'version': RESULTS_VERSION,
+        'python': sys.version.split()[0],
+        'machine': f'{host_platform.system()} {host_platform.machine()}, {os.cpu_count()} cpus',
+        'benchmarks': results,
+    }
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares medians against a baseline results dict. Returns [(name, baseline median, median,
+    ratio)] for every benchmark in both, and the names of those that got slower by more than
+    threshold (0.1 = 10%).
+    """
+
+    rows = []
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['median']
+        ratio = result['median'] / before if before else float('inf')
+        rows.append((name, before, result['median'], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the generator on the bundled samples')
+
+    parser.add_argument('--micro-only', action='store_true', help='only the component benchmarks')
+    parser.add_argument('--macro-only', action='store_true', help='only the full builds')
+    parser.add_argument('--import-only', action='store_true',
+                        help='only the import times (python -X importtime)')
+    parser.add_argument('--filter', help='only benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed runs per benchmark')
+    parser.add_argument('--output', help='write the results json here')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_PATH,
+                        help='results json to compare against (default: the committed '
+                             'benchmark_baseline.json)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown (0.1 = 10%%) of the median that counts as a regression')
+
+    args = parser.parse_args()
+
+    only = args.micro_only or args.macro_only or args.import_only
+    results = run_benchmarks(args.micro_only or not only, args.macro_only or not only, args.repeat,
+                             args.filter, args.import_only or not only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        rows, regressions = compare_results(results, baseline, args.threshold)
+        print()
+        if baseline['machine'] != results['machine'] or baseline['python'] != results['python']:
+            print(f"Baseline is from {baseline['machine']} with Python {baseline['python']}, "
+                  f"timings from another machine are only a rough guide")
+        print(f"{'benchmark':<40} {'baseline':>10} {'now':>10} {'change':>8}")
+        for name, before, after, ratio in rows:
+            flag = '  REGRESSION' if name in regressions else ''
+            print(f"{name:<40} {before * 1000:8.2f}ms {after * 1000:8.2f}ms {(ratio - 1) * 100:+7.1f}%{flag}")
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than {args.threshold * 100:.0f}%")
+            sys.exit(1)
@@ -0,0 +1,195 @@
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 1024 * 1024 * 1024
+KEY_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class BuildCache(object):
+    """
+    Cache of finished pbws keyed by build digest (see digests.watchface_digest). Entries are
+    kept in memory up to max_bytes, and optionally on disk in directory up to max_disk_bytes.
+    Both evict the least recently used pbws first. The directory is scanned once when the cache
+    is created, after that its size is kept track of as pbws are added and evicted, so pbws
+    another process adds to the same directory are only counted from the next scan.
+
+    Only reproducible builds can be cached, otherwise the same input never gives the same pbw.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        # key -> (pbw bytes, pbw name), least recently used first
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        # path -> size of the pbws on disk, least recently used first
+        self.disk_entries = OrderedDict()
+        self.disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key):
+        if not KEY_RE.match(key):
+            raise ValueError("Invalid build cache key {!r}".format(key))
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns (pbw bytes, pbw name) for key, or None if it isn't cached.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._add_to_memory(key, entry)
+        return entry
+
+    def put(self, key, pbw, pbw_name):
+        entry = (bytes(pbw), pbw_name)
+        with self.lock:
+            self._add_to_memory(key, entry)
+        self._write_disk(key, entry)
+
+    def _add_to_memory(self, key, entry):
+        if key in self.entries:
+            self.num_bytes -= len(self.entries.pop(key)[0])
+        if len(entry[0]) > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.num_bytes += len(entry[0])
+        while self.num_bytes > self.max_bytes:
+            oldest_key, (oldest_pbw, oldest_name) = self.entries.popitem(last=False)
+            self.num_bytes -= len(oldest_pbw)
+            self.evictions += 1
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                pbw_name = f.readline().rstrip(b'\n').decode('utf-8')
+                pbw = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self._forget_disk(path)
+            return None
+        self._touch_disk(path)
+        return pbw, pbw_name
+
+    def _write_disk(self, key, entry):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            self._touch_disk(path)
+            return
+
+        pbw, pbw_name = entry
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        header = pbw_name.encode('utf-8') + b'\n'
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                f.write(pbw)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        with self.lock:
+            self._forget_disk(path)
+            self.disk_entries[path] = len(header) + len(pbw)
+            self.disk_bytes += self.disk_entries[path]
+        self.evict_disk()
+
+    def _scan_disk(self):
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.directory):
+            for name in file_names:
+                if not KEY_RE.match(name):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+
+        entries.sort()
+        with self.lock:
+            self.disk_entries = OrderedDict((path, size) for mtime, path, size in entries)
+            self.disk_bytes = sum(self.disk_entries.values())
+
+    def _touch_disk(self, path):
+        # The mtime orders the pbws when the directory is scanned again
+        os.utime(path)
+        with self.lock:
+            if path in self.disk_entries:
+                self.disk_entries.move_to_end(path)
+
+    def _forget_disk(self, path):
+        size = self.disk_entries.pop(path, None)
+        if size is not None:
+            self.disk_bytes -= size
+
+    def evict_disk(self):
+        """
+        Remove least recently used pbws until the disk cache fits in max_disk_bytes.
+        """
+
+        while True:
+            with self.lock:
+                if self.disk_bytes <= self.max_disk_bytes or not self.disk_entries:
+                    return
+                path, size = self.disk_entries.popitem(last=False)
+                self.disk_bytes -= size
+                self.disk_evictions += 1
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_evictions': self.disk_evictions,
+                'entries': len(self.entries),
+                'bytes': self.num_bytes,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_bytes,
+            }
@@ -0,0 +1,53 @@
+import threading
+from concurrent.futures import Future
+
+
+class BuildCoalescer(object):
+    """
+    Lets concurrent identical builds share one run. The first caller for a key runs the build,
+    everyone who asks for the same key while it's running waits for that result (or exception)
+    instead of building again. Nothing is kept once the build finishes, this isn't a cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> Future of the build currently running for it
+        self.in_flight = {}
+        self.builds = 0
+        self.coalesced = 0
+
+    def run(self, key, build, *args, **kwargs):
+        """
+        Returns build(*args, **kwargs), or the result of the identical build already running.
+        """
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self.in_flight[key] = future
+                self.builds += 1
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(build(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future.result()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'builds': self.builds,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.in_flight),
+            }
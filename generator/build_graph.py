@@ -0,0 +1,228 @@
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from io import BytesIO
+
+from build_metrics import PBPACK_BYTES, RESOURCE_REUSE
+from build_trace import NULL_TRACER, Span
+from digests import resource_output_digest
+from pbpack import ResourcePack
+from resources.resource_map.resource_generator import LazyResourceGenerator, get_resource_generator
+
+
+def data_size(data):
+    # data is bytes-like or a BytesIO
+    if hasattr(data, 'getbuffer'):
+        return data.getbuffer().nbytes
+    return memoryview(data).nbytes
+
+
+def _generate_resource(generator, platform, resource_dict):
+    definition = generator.definitions_from_dict(platform, resource_dict)[0]
+    return generator.generate_object(platform, definition).data
+
+
+def _is_process_pool(executor):
+    # Without importing concurrent.futures.process (and multiprocessing with it) when nothing
+    # else has: if it isn't loaded, executor can't be a ProcessPoolExecutor
+    process = sys.modules.get('concurrent.futures.process')
+    return process is not None and isinstance(executor, process.ProcessPoolExecutor)
+
+
+def _generate_resource_in_process(resource_type, platform, resource_dict):
+    # Runs in a ProcessPoolExecutor worker, memoryviews (assets mapped from a bundle, raw data)
+    # can't be pickled on the way in or out
+    data = _generate_resource(get_resource_generator(resource_type), platform, resource_dict)
+    return bytes(data) if isinstance(data, memoryview) else data
+
+
+class ResourceNode(object):
+    """
+    One resource of one platform. fingerprint (digests.resource_fingerprint) finds it among the
+    known resources of earlier builds, digest (digests.resource_output_digest) finds the nodes of
+    other platforms that build to the same bytes. data is set once the graph has run, how it got
+    there ('reused', 'shared' or 'built') in result.
+    """
+
+    def __init__(self, platform, resource_dict, generator, fingerprint):
+        self.platform = platform
+        self.resource_dict = resource_dict
+        self.generator = generator
+        self.fingerprint = fingerprint
+        self.digest = None
+        self.data = None
+        self.result = None
+        self.done = False
+
+
+class PackNode(object):
+    """
+    The pbpack of one platform, assembled as soon as all of its resources are done. pack and
+    stream are what generate_pbpack returns.
+    """
+
+    def __init__(self, platform, resources):
+        self.platform = platform
+        self.resources = resources
+        self.pack = None
+        self.stream = None
+        self.done = False
+
+
+class BuildGraph(object):
+    """
+    Builds the resources and pbpacks of any number of platforms. Every resource is a node with
+    input digests: those found in known_resources ({fingerprint: content}, e.g. from an earlier
+    build) are reused, nodes with the same output digest are built once and shared (memo holds
+    {digest: content} and can be kept across builds), and the rest run on the executor passed to
+    run(), independently of each other. Each pack is assembled as soon as its own resources are
+    done.
+
+    Resources are generated by the generator registered for their 'type' (see
+    ResourceGenerator), so new resource types are scheduled the same way. deadline is checked
+    before each resource is started and before each pack, tracer gets a span per resource and
+    pack like generate_pbpack's.
+    """
+
+    def __init__(self, known_resources=None, memo=None, deadline=None, tracer=NULL_TRACER):
+        self.known_resources = known_resources
+        self.memo = {} if memo is None else memo
+        self.deadline = deadline
+        self.tracer = tracer
+        self.resources = []
+        self.packs = []
+
+    def add_resource(self, platform, resource_dict, generator=None, fingerprint=None):
+        if generator is None:
+            generator = LazyResourceGenerator(resource_dict['type'])
+        node = ResourceNode(platform, resource_dict, generator, fingerprint)
+        self.resources.append(node)
+        return node
+
+    def add_pack(self, platform, resources):
+        """
+        A pbpack of resources (ResourceNodes), in that order
+        """
+
+        node = PackNode(platform, list(resources))
+        self.packs.append(node)
+        return node
+
+    def run(self, executor=None):
+        """
+        Builds every node. With an executor (a concurrent.futures thread or process pool)
+        resources are built concurrently, otherwise one after another in this thread. Tracers
+        that aren't thread_safe (e.g. build_memory.MemoryTracer) always get a serial build.
+        """
+
+        if not self.tracer.thread_safe:
+            executor = None
+
+        # Resources that are already known, shared or alike need building at most once
+        jobs = {}
+        for node in self.resources:
+            if self.known_resources is not None and node.fingerprint in self.known_resources:
+                self._finish(node, self.known_resources[node.fingerprint], 'reused')
+                continue
+            node.digest = resource_output_digest(node.resource_dict, node.generator,
+                                                 node.generator.platform_inputs(node.platform))
+            if node.digest in self.memo:
+                self._finish(node, self.memo[node.digest], 'shared')
+            else:
+                jobs.setdefault(node.digest, []).append(node)
+        self._assemble_ready_packs()
+
+        queue = list(jobs.values())
+        pending = {}
+        try:
+            while queue or pending:
+                # Without an executor, build one resource at a time
+                while queue and (executor is not None or not pending):
+                    nodes = queue.pop(0)
+                    if self.deadline is not None:
+                        self.deadline.check(nodes[0].generator.type)
+                    if executor is None:
+                        self._complete(nodes, self._build(nodes[0]))
+                    elif _is_process_pool(executor):
+                        node = nodes[0]
+                        resource_dict = node.resource_dict
+                        if isinstance(resource_dict['data'], memoryview):
+                            resource_dict = dict(resource_dict, data=bytes(resource_dict['data']))
+                        future = executor.submit(_generate_resource_in_process,
+                                                 node.generator.type, node.platform, resource_dict)
+                        pending[future] = (nodes, time.perf_counter())
+                    else:
+                        pending[executor.submit(self._build, nodes[0])] = (nodes, None)
+
+                if pending:
+                    for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                        nodes, submitted = pending.pop(future)
+                        data = future.result()
+                        if submitted is not None:
+                            self._record_remote_span(nodes[0], submitted, data)
+                        self._complete(nodes, data)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _build(self, node):
+        with self.tracer.span(node.generator.type, 'resource', platform=node.platform,
+                              resource=node.resource_dict['name']) as span:
+            data = _generate_resource(node.generator, node.platform, node.resource_dict)
+            span.set(cached=False, bytes_in=data_size(node.resource_dict['data']),
+                     bytes_out=data_size(data))
+        return data
+
+    def _record_remote_span(self, node, submitted, data):
+        # Built in another process: the span covers the time from submitting to getting the
+        # result back
+        if not self.tracer.enabled:
+            return
+        span = Span(self.tracer, node.generator.type, 'resource',
+                    {'platform': node.platform, 'resource': node.resource_dict['name'],
+                     'cached': False, 'bytes_in': data_size(node.resource_dict['data']),
+                     'bytes_out': data_size(data), 'process': True})
+        span.start = submitted
+        span.seconds = time.perf_counter() - submitted
+        self.tracer.spans.append(span)
+
+    def _complete(self, nodes, data):
+        self.memo[nodes[0].digest] = data
+        self._finish(nodes[0], data, 'built')
+        for node in nodes[1:]:
+            self._finish(node, data, 'shared')
+        self._assemble_ready_packs()
+
+    def _finish(self, node, data, result):
+        node.data = data
+        node.result = result
+        node.done = True
+        if self.known_resources is not None and node.fingerprint is not None:
+            self.known_resources[node.fingerprint] = data
+        RESOURCE_REUSE.inc(result=result)
+        self.tracer.count(f'resource_{result}')
+        if result != 'built':
+            with self.tracer.span(node.generator.type, 'resource', platform=node.platform,
+                                  resource=node.resource_dict['name']) as span:
+                span.set(cached=True, shared=result == 'shared', bytes_out=data_size(data))
+
+    def _assemble_ready_packs(self):
+        for pack_node in self.packs:
+            if not pack_node.done and all(node.done for node in pack_node.resources):
+                self._assemble(pack_node)
+
+    def _assemble(self, pack_node):
+        if self.deadline is not None:
+            self.deadline.check('pack')
+
+        with self.tracer.span('pack', platform=pack_node.platform) as span:
+            pack = ResourcePack(False)
+            for node in pack_node.resources:
+                pack.add_resource(node.data)
+            stream = BytesIO()
+            pack.serialize(stream)
+            span.set(bytes_out=stream.tell())
+        PBPACK_BYTES.observe(stream.tell(), platform=pack_node.platform)
+        pack_node.pack = pack
+        pack_node.stream = stream
+        pack_node.done = True
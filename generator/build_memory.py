@@ -0,0 +1,175 @@
+import os
+import tracemalloc
+
+from build_trace import Span, Tracer
+
+MIB = 1024 * 1024
+# Allocation sites listed per stage in the memory report
+DEFAULT_SNAPSHOT_TOP = 5
+# Platform spans contain the resource spans, snapshots of those say it all
+NO_SNAPSHOT_CATEGORIES = ('platform',)
+
+
+class MemoryBudgetExceeded(Exception):
+    """
+    Raised between build stages when a build uses more memory than its budget. kind is 'python'
+    (tracemalloc's count of Python allocations) or 'rss' (resident memory, which includes
+    FreeType and other C allocations).
+    """
+
+    def __init__(self, stage, used, budget, kind):
+        super(MemoryBudgetExceeded, self).__init__(
+            f"Build used {used / MIB:.2f}MiB of {kind} memory by the end of {stage}, "
+            f"over its {budget / MIB:.2f}MiB budget")
+        self.stage = stage
+        self.used = used
+        self.budget = budget
+        self.kind = kind
+
+    def __reduce__(self):
+        return (MemoryBudgetExceeded, (self.stage, self.used, self.budget, self.kind))
+
+
+def current_rss_bytes():
+    """
+    Resident set size of this process right now, or None where /proc isn't available
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemorySpan(Span):
+    def __enter__(self):
+        self.tracer._enter_span(self)
+        return super(MemorySpan, self).__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(MemorySpan, self).__exit__(exc_type, exc_value, traceback)
+        self.tracer._exit_span(self, failed=exc_type is not None)
+        return False
+
+
+class MemoryTracer(Tracer):
+    """
+    A Tracer that also accounts for memory per span: memory_allocated (Python memory still held
+    at the end of the span), memory_peak (highest Python memory during it, above where it
+    started), rss (change in resident memory, which also sees FreeType's buffers) and, unless
+    snapshot_top is 0, the top allocation sites from tracemalloc snapshots.
+
+    With a budget_bytes it raises MemoryBudgetExceeded at the end of the first span after which
+    the build has used more than that, so a runaway build fails with a clear error instead of
+    getting the worker OOM-killed. tracemalloc is process wide, so this is meant for one build
+    at a time per process. It slows builds down noticeably, snapshots most of all.
+    """
+
+    # tracemalloc's peak and the open spans are shared by every thread
+    thread_safe = False
+
+    def __init__(self, budget_bytes=None, snapshot_top=DEFAULT_SNAPSHOT_TOP):
+        super(MemoryTracer, self).__init__()
+        self.budget_bytes = budget_bytes
+        self.snapshot_top = snapshot_top
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.start_traced = tracemalloc.get_traced_memory()[0]
+        self.start_rss = current_rss_bytes()
+        self.peak_traced = 0
+        self.peak_rss = 0
+        # Highest traced memory seen in each open span, innermost last. tracemalloc only has one
+        # peak, so it's reset at every span boundary and folded into the open spans here.
+        self.open_peaks = []
+
+    def span(self, name, category='stage', **args):
+        return MemorySpan(self, name, category, args)
+
+    def _fold_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        if self.open_peaks:
+            self.open_peaks[-1] = max(self.open_peaks[-1], peak)
+        self.peak_traced = max(self.peak_traced, peak - self.start_traced)
+        return current
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def _enter_span(self, span):
+        # Snapshot before measuring, so the snapshot itself doesn't count towards the span
+        span.snapshot = None
+        if self.snapshot_top and span.category not in NO_SNAPSHOT_CATEGORIES:
+            span.snapshot = self._snapshot()
+        span.start_traced = self._fold_peak()
+        span.start_rss = current_rss_bytes()
+        self.open_peaks.append(span.start_traced)
+
+    def _exit_span(self, span, failed):
+        current = self._fold_peak()
+        peak = self.open_peaks.pop()
+        if self.open_peaks:
+            self.open_peaks[-1] = max(self.open_peaks[-1], peak)
+        span.args['memory_allocated'] = current - span.start_traced
+        span.args['memory_peak'] = peak - span.start_traced
+
+        rss = current_rss_bytes()
+        if rss is not None and span.start_rss is not None:
+            span.args['rss'] = rss - span.start_rss
+            self.peak_rss = max(self.peak_rss, rss - self.start_rss)
+
+        if span.snapshot is not None:
+            differences = self._snapshot().compare_to(span.snapshot, 'lineno')
+            span.args['top_allocations'] = [str(difference) for difference
+                                            in differences[:self.snapshot_top]]
+        span.snapshot = None
+
+        if self.budget_bytes is not None and not failed:
+            stage = span.name
+            if 'resource' in span.args:
+                stage += f" ({span.args['resource']} on {span.args['platform']})"
+            elif 'platform' in span.args:
+                stage += f" on {span.args['platform']}"
+            if self.peak_traced > self.budget_bytes:
+                raise MemoryBudgetExceeded(stage, self.peak_traced, self.budget_bytes, 'python')
+            if self.peak_rss > self.budget_bytes:
+                raise MemoryBudgetExceeded(stage, self.peak_rss, self.budget_bytes, 'rss')
+
+    def close(self):
+        if self.started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def summary(self):
+        totals = super(MemoryTracer, self).summary()
+        for span in self.spans:
+            if 'memory_peak' in span.args:
+                total = totals[span.name]
+                total['memory_peak'] = max(total.get('memory_peak', 0), span.args['memory_peak'])
+        return totals
+
+    def memory_report(self):
+        """
+        Lines describing the memory used by each stage, biggest peak first
+        """
+
+        lines = [f"Build peak: {self.peak_traced / MIB:.2f}MiB python, "
+                 f"{self.peak_rss / MIB:.2f}MiB rss growth"]
+        spans = [span for span in self.spans if 'memory_peak' in span.args]
+        for span in sorted(spans, key=lambda span: -span.args['memory_peak']):
+            label = span.name
+            if 'resource' in span.args:
+                label += f" {span.args['resource']}"
+            if 'platform' in span.args:
+                label += f" ({span.args['platform']})"
+            rss = span.args.get('rss')
+            rss = '' if rss is None else f", rss {rss / MIB:+.2f}MiB"
+            lines.append(f"  {label}: peak {span.args['memory_peak'] / MIB:.2f}MiB, "
+                         f"held {span.args['memory_allocated'] / MIB:+.2f}MiB{rss}")
+            for allocation in span.args.get('top_allocations', ()):
+                lines.append(f"      {allocation}")
+        return lines
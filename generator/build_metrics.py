@@ -0,0 +1,205 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds. Fonts take a good fraction of a second, everything else a few milliseconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values tuple -> value
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labels)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _merge(self, values):
+        for key, value in values.items():
+            self.values[key] = self.values.get(key, 0) + value
+
+    def _lines(self):
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{_format_labels(key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            # [count per bucket (not cumulative, the last one is +Inf), sum]
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """
+        with histogram.time(label=...): ... observes how long the block took. Also works as a
+        decorator, @histogram.time(), to time every call of a function.
+        """
+
+        return _Timer(self, labels)
+
+    def _merge(self, values):
+        for key, (counts, total) in values.items():
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+
+    def _lines(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = key + (('le', _format_value(bound)),)
+                yield f'{self.name}_bucket{_format_labels(labels)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(key)} {cumulative}'
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return fn(*args, **kwargs)
+        return timed
+
+
+class MetricsRegistry(object):
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format. Builds that run
+    in worker processes send their numbers back with drain() and the parent merge()s them, so one
+    registry covers the whole service.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def drain(self):
+        """
+        Returns everything recorded since the last drain, as a picklable dict for merge(), and
+        resets the values.
+        """
+
+        with self.lock:
+            values = {}
+            for name, metric in self.metrics.items():
+                if metric.values:
+                    values[name] = metric.values
+                    metric.values = {}
+            return values
+
+    def merge(self, values):
+        with self.lock:
+            for name, metric_values in values.items():
+                self.metrics[name]._merge(metric_values)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                lines.append(f'# HELP {name} {metric.help}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+                lines.extend(metric._lines())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+BUILDS = REGISTRY.counter('watchface_platform_builds_total',
+                          'Watchface builds, counted once per target platform', ('platform',))
+BUILD_SECONDS = REGISTRY.histogram('watchface_build_seconds',
+                                   'Time to build a whole pbw, cache hits included')
+BUILD_CACHE = REGISTRY.counter('watchface_build_cache_requests_total',
+                               'Build cache lookups by result (hit or miss)', ('result',))
+RESOURCES = REGISTRY.counter('watchface_resources_generated_total',
+                             'Resources generated, by resource type', ('type',))
+RESOURCE_SECONDS = REGISTRY.histogram('watchface_resource_generate_seconds',
+                                      'Time to generate one resource, by resource type', ('type',))
+RESOURCE_REUSE = REGISTRY.counter('watchface_resource_lookups_total',
+                                  'Resources by whether they were reused from an earlier build, '
+                                  'shared with another platform or built', ('result',))
+FONT_GLYPHS = REGISTRY.counter('watchface_font_glyphs_total', 'Glyphs in the generated fonts')
+FONT_FACES = REGISTRY.counter('watchface_font_face_pool_requests_total',
+                              'Font face pool lookups by result (hit or miss)', ('result',))
+FONT_FACE_EVICTIONS = REGISTRY.counter('watchface_font_face_pool_evictions_total',
+                                       'Idle font faces dropped from the face pool')
+IMAGE_PIXELS = REGISTRY.counter('watchface_image_pixels_total', 'Pixels of the converted images')
+PBPACK_BYTES = REGISTRY.histogram('watchface_pbpack_bytes', 'Size of the generated pbpacks',
+                                  ('platform',), BYTES_BUCKETS)
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('watchface_queue_wait_seconds',
+                                        'Time builds spent queued before a worker picked them up',
+                                        ('priority',))
@@ -0,0 +1,180 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+PROFILE_MODES = ('cprofile', 'sample')
+# The sampler needs the GIL to look at the stack, so sampling faster than the interpreter's switch
+# interval (5ms by default) mostly just adds overhead
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP = 15
+# Call paths worth less than this (in seconds) are left out of collapsed stacks made from cProfile
+# data, the call graph of a font build would blow up otherwise
+MIN_PATH_SECONDS = 1e-6
+
+
+def _function_label(filename, line, name):
+    if filename == '~':
+        # Builtins, e.g. <built-in method zlib.crc32>
+        return name
+    return f'{os.path.basename(filename)}:{name}'
+
+
+class _Sampler(object):
+    # Samples the stack of one thread from a background thread every interval seconds
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.seconds = 0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.seconds = time.perf_counter() - self.started
+
+    def seconds_per_sample(self):
+        # Samples come in slower than the interval when the profiled thread holds on to the GIL
+        samples = sum(self.stacks.values())
+        return self.seconds / samples if samples else self.interval
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_function_label(code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+class BuildProfiler(object):
+    """
+    Profiles whatever runs in the calling thread between start() and stop() (or in a with
+    block). mode is 'cprofile' (deterministic, pstats output, collapsed stacks estimated from the
+    call graph) or 'sample' (samples the stack every interval seconds, low overhead, exact
+    collapsed stacks). write(prefix) saves <prefix>.pstats (cprofile only) and
+    <prefix>.collapsed, which flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, mode='cprofile', interval=DEFAULT_SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode}, expected one of {', '.join(PROFILE_MODES)}")
+        self.mode = mode
+        self.interval = interval
+        self.profile = None
+        self.sampler = None
+        self.stats = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = _Sampler(threading.get_ident(), self.interval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            self.stats = pstats.Stats(self.profile)
+        else:
+            self.sampler.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def collapsed_stacks(self):
+        """
+        {'outer;...;inner': weight}, weights are samples or microseconds of cProfile self time
+        """
+
+        if self.mode == 'sample':
+            return {';'.join(stack): count for stack, count in self.sampler.stacks.items()}
+
+        # Spread each function's self time over the paths that lead to it, in proportion to the
+        # time spent in each caller edge. An estimate: cProfile doesn't record whole stacks.
+        stats = self.stats.stats
+        callees = defaultdict(dict)
+        for function, (cc, nc, tt, ct, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees[caller][function] = edge[3]
+
+        collapsed = Counter()
+
+        def walk(function, path, share):
+            tt, ct = stats[function][2], stats[function][3]
+            path = path + (function,)
+            if tt * share >= MIN_PATH_SECONDS:
+                collapsed[';'.join(_function_label(*f) for f in path)] += tt * share * 1e6
+            for callee, edge_seconds in callees[function].items():
+                callee_seconds = stats[callee][3]
+                if callee in path or not callee_seconds:
+                    continue
+                callee_share = share * edge_seconds / callee_seconds
+                if callee_seconds * callee_share >= MIN_PATH_SECONDS:
+                    walk(callee, path, callee_share)
+
+        for function, (cc, nc, tt, ct, callers) in stats.items():
+            if not callers:
+                walk(function, (), 1.0)
+        return {stack: round(weight) for stack, weight in collapsed.items() if round(weight)}
+
+    def top_functions(self, limit=DEFAULT_TOP):
+        """
+        [(function, self seconds, total seconds, calls or None)], most self time first
+        """
+
+        if self.mode == 'cprofile':
+            rows = [(_function_label(*function), tt, ct, nc)
+                    for function, (cc, nc, tt, ct, callers) in self.stats.stats.items()]
+        else:
+            own = Counter()
+            total = Counter()
+            for stack, count in self.sampler.stacks.items():
+                own[stack[-1]] += count
+                for function in set(stack):
+                    total[function] += count
+            seconds = self.sampler.seconds_per_sample()
+            rows = [(function, own[function] * seconds, total[function] * seconds, None)
+                    for function in total]
+        rows.sort(key=lambda row: -row[1])
+        return rows[:limit]
+
+    def print_top(self, limit=DEFAULT_TOP):
+        print(f"{'self s':>9} {'total s':>9} {'calls':>9}  function ({self.mode})")
+        for function, own, total, calls in self.top_functions(limit):
+            calls = '' if calls is None else calls
+            print(f"{own:9.3f} {total:9.3f} {calls:>9}  {function}")
+
+    def write(self, prefix):
+        """
+        Writes the profile next to prefix, returns the paths written
+        """
+
+        paths = []
+        if self.mode == 'cprofile':
+            self.stats.dump_stats(prefix + '.pstats')
+            paths.append(prefix + '.pstats')
+        with open(prefix + '.collapsed', 'w') as f:
+            for stack, weight in sorted(self.collapsed_stacks().items()):
+                f.write(f'{stack} {weight}\n')
+        paths.append(prefix + '.collapsed')
+        return paths
@@ -0,0 +1,283 @@
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from build_metrics import QUEUE_WAIT_SECONDS
+
+# Highest priority first
+PRIORITIES = ('interactive', 'batch')
+DEFAULT_PRIORITY = 'interactive'
+DEFAULT_QUEUE_LIMITS = {'interactive': 32, 'batch': 256}
+# Weight of the latest job in the running average job time
+AVERAGE_WEIGHT = 0.2
+MIN_RETRY_AFTER = 1
+
+
+class SchedulerFull(Exception):
+    """
+    Raised by BuildScheduler.submit when the queue for a priority is full. retry_after is a
+    rough estimate, in seconds, of when there will be room again.
+    """
+
+    def __init__(self, priority, retry_after):
+        super(SchedulerFull, self).__init__(
+            f"The {priority} queue is full, retry in {retry_after}s")
+        self.priority = priority
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return (SchedulerFull, (self.priority, self.retry_after))
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a build runs out of time, either while queued or between build stages.
+    """
+    pass
+
+
+class Deadline(object):
+    """
+    An absolute point in (wall clock) time a build has to finish by. It's picklable, so it can be
+    handed to worker processes. Builds call check(stage) between stages (see
+    create_watchface.build_watchface_files) and give up once it has passed.
+    """
+
+    def __init__(self, timeout):
+        self.expires = time.time() + timeout
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline passed before {stage}")
+
+
+class _Job(object):
+    def __init__(self, fn, args, kwargs, priority, deadline):
+        self.future = Future()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.deadline = deadline
+        self.queued_at = time.perf_counter()
+
+
+class BuildScheduler(object):
+    """
+    Runs jobs on a fixed number of worker threads. Queued jobs are picked by priority (see
+    PRIORITIES), and within a priority round-robin across clients so one client submitting a
+    pile of jobs can't starve the others. Every priority has a bounded queue, submitting to a
+    full one raises SchedulerFull instead of queueing more work.
+    """
+
+    def __init__(self, workers=1, queue_limits=None):
+        self.workers = workers
+        self.queue_limits = dict(DEFAULT_QUEUE_LIMITS, **(queue_limits or {}))
+        self.condition = threading.Condition()
+        # priority -> client -> deque of jobs. The client at the front gets the next job and
+        # then moves to the back.
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.queued = {priority: 0 for priority in PRIORITIES}
+        self.running = 0
+        self.average_seconds = None
+        self.closed = False
+
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.threads = [threading.Thread(target=self._work, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, *args, client=None, priority=DEFAULT_PRIORITY, deadline=None, **kwargs):
+        """
+        Queue fn(*args, **kwargs), returns a Future for its result. Jobs whose deadline passes
+        while they're queued fail with DeadlineExceeded without running.
+        """
+
+        job = _Job(fn, args, kwargs, priority, deadline)
+        with self.condition:
+            self._check_capacity(priority)
+            self.queues[priority].setdefault(client, deque()).append(job)
+            self.queued[priority] += 1
+            self.submitted += 1
+            self.condition.notify()
+        return job.future
+
+    def check_capacity(self, priority=DEFAULT_PRIORITY):
+        """
+        Raise SchedulerFull if a job of priority would be rejected right now, so work can be
+        turned away before anything is spent on preparing it. submit() checks again.
+        """
+
+        with self.condition:
+            self._check_capacity(priority)
+
+    def _check_capacity(self, priority):
+        if priority not in self.queues:
+            raise ValueError(f"Unknown priority {priority}")
+        if self.closed:
+            raise RuntimeError("Scheduler is shut down")
+        if self.queued[priority] >= self.queue_limits[priority]:
+            self.rejected += 1
+            raise SchedulerFull(priority, self._retry_after(priority))
+
+    def _retry_after(self, priority):
+        # Everything queued at this priority or above runs before a new job would
+        ahead = self.running
+        for queued_priority in PRIORITIES[:PRIORITIES.index(priority) + 1]:
+            ahead += self.queued[queued_priority]
+        average_seconds = self.average_seconds or MIN_RETRY_AFTER
+        return max(MIN_RETRY_AFTER, math.ceil(ahead * average_seconds / self.workers))
+
+    def _next_job(self):
+        for priority in PRIORITIES:
+            clients = self.queues[priority]
+            if not clients:
+                continue
+            client, jobs = clients.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                clients[client] = jobs
+            self.queued[priority] -= 1
+            return job
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None and not self.closed:
+                    self.condition.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                self.running += 1
+
+            try:
+                self._run(job)
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def _run(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - job.queued_at, priority=job.priority)
+        if job.deadline is not None and job.deadline.expired():
+            with self.condition:
+                self.expired += 1
+            job.future.set_exception(DeadlineExceeded("Deadline passed while queued"))
+            return
+
+        start = time.perf_counter()
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except BaseException as e:
+            with self.condition:
+                self.failed += 1
+            job.future.set_exception(e)
+        else:
+            with self.condition:
+                self.completed += 1
+            job.future.set_result(result)
+
+        seconds = time.perf_counter() - start
+        with self.condition:
+            if self.average_seconds is None:
+                self.average_seconds = seconds
+            else:
+                self.average_seconds += AVERAGE_WEIGHT * (seconds - self.average_seconds)
+
+    def shutdown(self, wait=True):
+        """
+        Stop taking jobs. Queued jobs still run unless they're cancelled.
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': dict(self.queued),
+                'running': self.running,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'completed': self.completed,
+                'failed': self.failed,
+                'average_seconds': round(self.average_seconds or 0, 4),
+            }
+
+
+if __name__ == "__main__":
+    # Simulate a mix of clients with synthetic jobs, to see priorities, fairness and backpressure
+    import argparse
+
+    parser = argparse.ArgumentParser(description='run synthetic jobs through the build scheduler')
+
+    parser.add_argument('--workers', type=int, default=2, help='number of worker threads')
+    parser.add_argument('--batch-clients', type=int, default=2, help='clients submitting batch jobs')
+    parser.add_argument('--batch-jobs', type=int, default=40, help='batch jobs per batch client')
+    parser.add_argument('--interactive-jobs', type=int, default=10,
+                        help='interactive jobs, submitted after the batch jobs')
+    parser.add_argument('--job-seconds', type=float, default=0.02, help='duration of each job')
+    parser.add_argument('--batch-queue-limit', type=int, default=DEFAULT_QUEUE_LIMITS['batch'])
+    parser.add_argument('--timeout', type=float, help='deadline for every job, in seconds')
+
+    args = parser.parse_args()
+
+    scheduler = BuildScheduler(args.workers, {'batch': args.batch_queue_limit})
+    finished = []
+    finished_lock = threading.Lock()
+
+    def synthetic_job(name, deadline):
+        for stage in ('decode', 'png', 'font', 'pack', 'zip'):
+            if deadline is not None:
+                deadline.check(stage)
+            time.sleep(args.job_seconds / 5)
+        with finished_lock:
+            finished.append(name)
+
+    def submit(name, client, priority):
+        deadline = Deadline(args.timeout) if args.timeout else None
+        try:
+            return scheduler.submit(synthetic_job, name, deadline, client=client,
+                                    priority=priority, deadline=deadline)
+        except SchedulerFull as e:
+            print(f"{name}: rejected, retry after {e.retry_after}s")
+            return None
+
+    futures = []
+    for i in range(args.batch_jobs):
+        for client in range(args.batch_clients):
+            futures.append(submit(f'batch-{client}-{i}', f'batch-{client}', 'batch'))
+    for i in range(args.interactive_jobs):
+        futures.append(submit(f'interactive-{i}', 'designer', 'interactive'))
+
+    for future in futures:
+        if future is not None:
+            try:
+                future.result()
+            except DeadlineExceeded:
+                pass
+    scheduler.shutdown()
+
+    print("Completion order:", ' '.join(finished))
+    print("Stats:", scheduler.stats())
@@ -0,0 +1,482 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+from asset_bundle import AssetBundle
+from asset_store import AssetNotFound
+from build_coalescer import BuildCoalescer
+from build_memory import MIB, MemoryBudgetExceeded, MemoryTracer
+from build_metrics import REGISTRY
+from build_profile import PROFILE_MODES, BuildProfiler
+from build_scheduler import DEFAULT_PRIORITY, DEFAULT_QUEUE_LIMITS, PRIORITIES, BuildScheduler, \
+    Deadline, DeadlineExceeded, SchedulerFull
+from build_trace import Tracer
+from create_watchface import load_asset, load_watchface_info, parse_watchface_info
+from digests import data_digest, watchface_digest
+from pbw_writer import COMPRESSION_TYPES
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+HEALTH_TIMEOUT = 5
+PBW_CONTENT_TYPE = 'application/octet-stream'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+RESPONSE_CHUNK_SIZE = 64 * 1024
+CLIENT_ID_HEADER = 'X-Client-Id'
+PROFILE_HEADER = 'X-Build-Profile'
+MEMORY_PEAK_HEADER = 'X-Build-Memory-Peak'
+# Request keys remembered by the digest of the raw request, so repeats skip parsing the body
+REQUEST_KEY_CACHE_SIZE = 1024
+
+# Per-process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(template_pbw_path, asset_store_dir):
+    # Import the generator (and with it freetype and pypng) and load the template up front, so
+    # requests only pay for the build itself
+    import create_watchface
+    from asset_store import AssetStore
+    from resources.resource_map.resource_generator import preload_resource_generators
+
+    # Workers are spawned, so they don't inherit the server's logging setup
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    preload_resource_generators()
+
+    with open(template_pbw_path, 'rb') as f:
+        _worker['template_pbw_stream'] = BytesIO(f.read())
+    _worker['asset_store'] = AssetStore(asset_store_dir) if asset_store_dir else None
+    _worker['create_watchface'] = create_watchface
+
+
+def _is_json_body(body):
+    return body.lstrip()[:1] == b'{'
+
+
+def _worker_ping():
+    return os.getpid()
+
+
+def _build_body(body, options, deadline, tracer):
+    create_watchface = _worker['create_watchface']
+    template_pbw_stream = _worker['template_pbw_stream']
+    asset_store = _worker['asset_store']
+
+    if _is_json_body(body):
+        with tracer.span('parse'):
+            watchface_info = create_watchface.load_watchface_info(BytesIO(body))
+        return create_watchface.create_watchface(watchface_info, template_pbw_stream,
+                                                 asset_store=asset_store, deadline=deadline,
+                                                 tracer=tracer, **options)
+    return create_watchface.create_watchface_from_bundle(body, template_pbw_stream, asset_store,
+                                                         deadline=deadline, tracer=tracer,
+                                                         **options)
+
+
+def _worker_build(body, options, deadline=None, profile=None, memory_budget=None):
+    """
+    Build a pbw from a request body, either watchface_info json or an asset bundle.
+    Returns a dict of the pbw bytes, pbw_name, timings (the build's Tracer.summary()), metrics
+    (everything this worker recorded since it last sent its metrics back), profile (the files
+    written when profile is a (directory, mode) pair, else None) and memory_peak (the most
+    Python memory the build held at once, when it had a memory_budget in bytes, else None).
+    """
+
+    if memory_budget is None:
+        tracer = Tracer()
+    else:
+        tracer = MemoryTracer(memory_budget, snapshot_top=0)
+    profile_paths = None
+    try:
+        if profile is None:
+            pbw, pbw_name = _build_body(body, options, deadline, tracer)
+        else:
+            # Stops profiling even if the build fails, the worker is reused
+            with BuildProfiler(profile[1]) as profiler:
+                pbw, pbw_name = _build_body(body, options, deadline, tracer)
+            prefix = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{os.path.splitext(pbw_name)[0]}"
+            profile_paths = profiler.write(os.path.join(profile[0], prefix))
+    finally:
+        if memory_budget is not None:
+            tracer.close()
+    return {'pbw': pbw, 'pbw_name': pbw_name, 'timings': tracer.summary(),
+            'metrics': REGISTRY.drain(), 'profile': profile_paths,
+            'memory_peak': None if memory_budget is None else tracer.peak_traced}
+
+
+def server_timing(timings):
+    """
+    A Server-Timing header value for a Tracer.summary(), longest stages first
+    """
+
+    ordered = sorted(timings.items(), key=lambda item: -item[1]['seconds'])
+    return ', '.join(f"{name};dur={total['seconds'] * 1000:.2f}" for name, total in ordered)
+
+
+class BuildError(Exception):
+    """
+    A build request that can't be served, with the HTTP status to answer with.
+    """
+
+    def __init__(self, status, message, **details):
+        super(BuildError, self).__init__(message)
+        self.status = status
+        self.details = details
+
+
+def build_options_from_query(query):
+    """
+    Turn ?compression=stored&level=9&reproducible=1 into create_watchface options.
+    """
+
+    params = parse_qs(query)
+    options = {}
+    if 'compression' in params:
+        compression = params['compression'][-1]
+        if compression not in COMPRESSION_TYPES:
+            raise BuildError(400, f"Unknown compression {compression}")
+        options['compression'] = COMPRESSION_TYPES[compression]
+    if 'level' in params:
+        try:
+            options['compresslevel'] = int(params['level'][-1])
+        except ValueError:
+            raise BuildError(400, "level must be an integer")
+    if 'reproducible' in params:
+        options['reproducible'] = params['reproducible'][-1].lower() in ('1', 'true', 'yes')
+    return options
+
+
+def scheduling_from_query(query):
+    """
+    Turn ?priority=batch&timeout=30 into (priority, timeout in seconds or None).
+    """
+
+    params = parse_qs(query)
+    priority = params.get('priority', [DEFAULT_PRIORITY])[-1]
+    if priority not in PRIORITIES:
+        raise BuildError(400, f"Unknown priority {priority}, expected one of {', '.join(PRIORITIES)}")
+    timeout = None
+    if 'timeout' in params:
+        try:
+            timeout = float(params['timeout'][-1])
+        except ValueError:
+            raise BuildError(400, "timeout must be a number of seconds")
+    return priority, timeout
+
+
+def profile_from_query(query):
+    """
+    ?profile=cprofile|sample (1 means cprofile) to profile the build, returns the mode or None
+    """
+
+    mode = parse_qs(query).get('profile', [None])[-1]
+    if mode in (None, '', '0'):
+        return None
+    if mode == '1':
+        return PROFILE_MODES[0]
+    if mode not in PROFILE_MODES:
+        raise BuildError(400, f"Unknown profile mode {mode}, expected one of {', '.join(PROFILE_MODES)}")
+    return mode
+
+
+class BuildServer(ThreadingHTTPServer):
+    """
+    Local HTTP build service. Requests are handled on threads and the builds themselves run on a
+    pool of pre-started worker processes that already have the generator and template loaded.
+    Identical requests that arrive while the first one is still building wait for its pbw instead
+    of building it again. Builds are queued by priority with bounded queues and taken
+    round-robin across clients, see BuildScheduler.
+
+        POST /build    body is watchface_info json or a zip/tar asset bundle, answers with the pbw
+        GET  /health   answers with worker and request stats
+        GET  /metrics  answers with build_metrics.REGISTRY in the Prometheus text format
+
+    The pbw isn't streamed from the worker: it's built in full, sent back as one result and
+    then written to the client. A build can still fail until it's done, so the status code is
+    only known then, and coalesced requests all answer with the same pbw.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, template_pbw_path, workers=None, asset_store_dir=None,
+                 max_body_bytes=DEFAULT_MAX_BODY_BYTES, max_jobs_per_worker=None,
+                 queue_limits=None, default_timeout=None, profile_dir=None, memory_budget=None):
+        self.workers = workers or os.cpu_count() or 1
+        # Bytes a single build may use, see build_memory.MemoryTracer
+        self.memory_budget = memory_budget
+        self.max_body_bytes = max_body_bytes
+        self.default_timeout = default_timeout
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.started = time.time()
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.coalescer = BuildCoalescer()
+        self.request_keys = OrderedDict()
+        self.request_keys_lock = threading.Lock()
+        # One scheduler thread per worker process, so only as many builds as there are workers
+        # are handed to the pool and everything else waits in the bounded queues
+        self.scheduler = BuildScheduler(self.workers, queue_limits)
+        with open(template_pbw_path, 'rb') as f:
+            self.template_digest = data_digest(f)
+
+        # Spawn rather than fork, the server is threaded. Pool starts every worker right away.
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(self.workers, initializer=_init_worker,
+                                 initargs=(template_pbw_path, asset_store_dir),
+                                 maxtasksperchild=max_jobs_per_worker)
+        # Block until the workers are up, so the first request doesn't pay for the warm up
+        for result in [self.pool.apply_async(_worker_ping) for i in range(self.workers)]:
+            result.get()
+
+        super(BuildServer, self).__init__(server_address, BuildRequestHandler)
+
+    def build(self, body, options, client=None, priority=DEFAULT_PRIORITY, timeout=None,
+              profile_mode=None):
+        """
+        Returns a dict of the pbw bytes, pbw_name, timings and profile (see _worker_build), raises
+        BuildError for requests that can't be built. Coalesced requests get the timings of the
+        build they shared.
+        """
+
+        profile = None
+        if profile_mode is not None:
+            if self.profile_dir is None:
+                raise BuildError(400, "Profiling is off, start the server with --profile-dir")
+            profile = (self.profile_dir, profile_mode)
+        timeout = timeout or self.default_timeout
+        deadline = Deadline(timeout) if timeout else None
+        try:
+            # Turn requests away while their queue is full before parsing anything
+            self.scheduler.check_capacity(priority)
+            key = self.request_key(body, options, profile_mode)
+            return self.coalescer.run(key, self.schedule_build, body, options, client, priority,
+                                      deadline, profile)
+        except SchedulerFull as e:
+            raise BuildError(503, str(e), retry_after=e.retry_after)
+        except DeadlineExceeded as e:
+            raise BuildError(504, f"Build timed out: {e}")
+        except MemoryBudgetExceeded as e:
+            raise BuildError(413, str(e), stage=e.stage, memory_used=e.used,
+                             memory_budget=e.budget)
+        except AssetNotFound as e:
+            raise BuildError(422, f"Asset {e.args[0]} is not in the asset store, upload it again",
+                             missing_asset=e.args[0])
+        except (ValueError, KeyError, TypeError) as e:
+            raise BuildError(400, f"Invalid watchface: {type(e).__name__}: {e}")
+
+    def schedule_build(self, body, options, client, priority, deadline, profile):
+        future = self.scheduler.submit(self.build_on_worker, body, options, deadline, profile,
+                                       client=client, priority=priority, deadline=deadline)
+        return future.result()
+
+    def build_on_worker(self, body, options, deadline, profile):
+        result = self.pool.apply_async(_worker_build, (body, options, deadline, profile,
+                                                        self.memory_budget)).get()
+        REGISTRY.merge(result.pop('metrics'))
+        return result
+
+    def request_key(self, body, options, profile_mode=None):
+        """
+        Requests for the same normalized watchface_info, template, options and profile mode get
+        the same key, whatever form the assets come in. Only the first request with a given body
+        pays for parsing it, the keys of the last REQUEST_KEY_CACHE_SIZE bodies are remembered.
+        """
+
+        body_key = json.dumps([data_digest(body), sorted(options.items()), profile_mode])
+        with self.request_keys_lock:
+            key = self.request_keys.get(body_key)
+            if key is not None:
+                self.request_keys.move_to_end(body_key)
+                return key
+
+        key = self.normalized_request_key(body, options, profile_mode)
+        with self.request_keys_lock:
+            self.request_keys[body_key] = key
+            while len(self.request_keys) > REQUEST_KEY_CACHE_SIZE:
+                self.request_keys.popitem(last=False)
+        return key
+
+    def normalized_request_key(self, body, options, profile_mode):
+        if _is_json_body(body):
+            watchface_info = load_watchface_info(BytesIO(body))
+            digest = watchface_digest(watchface_info, self.template_digest, load_asset)
+        else:
+            with AssetBundle(body) as bundle:
+                watchface_info = parse_watchface_info(bundle.read_watchface_info())
+                digest = watchface_digest(watchface_info, self.template_digest,
+                                          lambda value: load_asset(value, bundle))
+        return data_digest(json.dumps([digest, sorted(options.items()), profile_mode])
+                           .encode('utf-8'))
+
+    def count_request(self, failed=False):
+        with self.stats_lock:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+
+    def health(self):
+        # Raises if the workers don't pick up a job in time
+        self.pool.apply_async(_worker_ping).get(HEALTH_TIMEOUT)
+        return {
+            'status': 'ok',
+            'workers': self.workers,
+            'uptime': round(time.time() - self.started, 1),
+            'requests': self.requests,
+            'failures': self.failures,
+            'coalescing': self.coalescer.stats(),
+            'scheduler': self.scheduler.stats(),
+        }
+
+    def server_close(self):
+        super(BuildServer, self).server_close()
+        self.scheduler.shutdown(wait=False)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'WatchfaceGenerator'
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.send_metrics()
+            return
+        if path != '/health':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            self.send_json(200, self.server.health())
+        except Exception as e:
+            self.send_json(503, {'status': 'unavailable', 'error': str(e)})
+
+    def send_metrics(self):
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/build':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            options = build_options_from_query(url.query)
+            priority, timeout = scheduling_from_query(url.query)
+            profile_mode = profile_from_query(url.query)
+            client = self.headers.get(CLIENT_ID_HEADER, self.client_address[0])
+            result = self.server.build(self.read_body(), options, client, priority, timeout,
+                                       profile_mode)
+        except BuildError as e:
+            self.server.count_request(failed=True)
+            headers = {}
+            if 'retry_after' in e.details:
+                headers['Retry-After'] = str(e.details['retry_after'])
+            self.send_json(e.status, dict(error=str(e), **e.details), headers)
+            return
+        except Exception as e:
+            self.server.count_request(failed=True)
+            self.send_json(500, {'error': f"{type(e).__name__}: {e}"})
+            return
+
+        self.server.count_request()
+        pbw = result['pbw']
+        self.send_response(200)
+        self.send_header('Content-Type', PBW_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(pbw)))
+        self.send_header('Content-Disposition', f'attachment; filename="{result["pbw_name"]}"')
+        self.send_header('Server-Timing', server_timing(result['timings']))
+        if result['profile'] is not None:
+            self.send_header(PROFILE_HEADER, ', '.join(result['profile']))
+        if result['memory_peak'] is not None:
+            self.send_header(MEMORY_PEAK_HEADER, str(result['memory_peak']))
+        self.end_headers()
+        # The whole pbw is already here, write it out without copying it into one big send
+        view = memoryview(pbw)
+        for start in range(0, len(view), RESPONSE_CHUNK_SIZE):
+            self.wfile.write(view[start:start + RESPONSE_CHUNK_SIZE])
+
+    def read_body(self):
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            raise BuildError(411, "Content-Length is required")
+        if length > self.server.max_body_bytes:
+            raise BuildError(413, f"Request body is larger than {self.server.max_body_bytes} bytes")
+        return self.rfile.read(length)
+
+
+def serve(template_pbw_path, host=DEFAULT_HOST, port=DEFAULT_PORT, **server_options):
+    server = BuildServer((host, port), template_pbw_path, **server_options)
+    print(f"Serving watchface builds on http://{host}:{server.server_port} "
+          f"with {server.workers} workers")
+    # Shut the workers down cleanly when asked to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='serve watchface builds over http')
+
+    parser.add_argument('template_pbw_path', help='path to template pbw')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--workers', type=int, help='number of build processes (default: one per cpu)')
+    parser.add_argument('--asset-store', help='asset store to resolve {"sha256": ...} assets from')
+    parser.add_argument('--max-body-bytes', type=int, default=DEFAULT_MAX_BODY_BYTES,
+                        help='largest accepted request body')
+    parser.add_argument('--max-jobs-per-worker', type=int,
+                        help='restart a worker after this many builds')
+    parser.add_argument('--interactive-queue', type=int, default=DEFAULT_QUEUE_LIMITS['interactive'],
+                        help='most interactive builds waiting for a worker')
+    parser.add_argument('--batch-queue', type=int, default=DEFAULT_QUEUE_LIMITS['batch'],
+                        help='most batch builds waiting for a worker')
+    parser.add_argument('--timeout', type=float,
+                        help='default build deadline in seconds, requests can set ?timeout=')
+    parser.add_argument('--profile-dir',
+                        help='allow ?profile=cprofile|sample, profiles are written here')
+    parser.add_argument('--memory-budget', type=float, metavar='MIB',
+                        help='fail builds that use more than this many MiB with a 413 instead of '
+                             'letting them run the worker out of memory')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    serve(args.template_pbw_path, args.host, args.port, workers=args.workers,
+          asset_store_dir=args.asset_store, max_body_bytes=args.max_body_bytes,
+          max_jobs_per_worker=args.max_jobs_per_worker,
+          queue_limits={'interactive': args.interactive_queue, 'batch': args.batch_queue},
+          default_timeout=args.timeout, profile_dir=args.profile_dir,
+          memory_budget=int(args.memory_budget * MIB) if args.memory_budget else None)
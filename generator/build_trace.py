@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """
+    One timed piece of a build. args holds whatever was measured along the way, e.g. bytes_in,
+    bytes_out or cached, set with set(...).
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.get_ident()
+        self.start = None
+        self.seconds = None
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.spans.append(self)
+        return False
+
+    def __getstate__(self):
+        # Tracers are sent back from worker processes, the tracer reference would just be a cycle
+        state = dict(self.__dict__)
+        del state['tracer']
+        return state
+
+
+class Tracer(object):
+    """
+    Collects spans for every stage of a build (decode, each platform, each resource, pack,
+    manifest, zip) and counters such as cache hits. Pass one to create_watchface/write_watchface
+    and read it afterwards: summary() for totals per span name, chrome_trace() for a trace that
+    chrome://tracing or Perfetto can open. Tracers are picklable, so a worker process can send one
+    back with its pbw.
+    """
+
+    enabled = True
+    # Spans can be opened from several threads at once
+    thread_safe = True
+
+    def __init__(self):
+        self.spans = []
+        self.counters = {}
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+
+    def span(self, name, category='stage', **args):
+        """
+        with tracer.span('png', 'resource', platform='basalt') as span: ...; span.set(bytes_out=n)
+        """
+
+        return Span(self, name, category, args)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        """
+        {span name: {'count', 'seconds', and the totals of any bytes_in/bytes_out}}
+        """
+
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, {'category': span.category, 'count': 0,
+                                                  'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += span.seconds
+            for key in ('bytes_in', 'bytes_out'):
+                if key in span.args:
+                    total[key] = total.get(key, 0) + span.args[key]
+        for total in totals.values():
+            total['seconds'] = round(total['seconds'], 6)
+        return totals
+
+    def chrome_trace(self):
+        """
+        The spans as Chrome trace-event JSON (complete "X" events, in microseconds)
+        """
+
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - self.origin) * 1e6, 3),
+                'dur': round(span.seconds * 1e6, 3),
+                'pid': self.pid,
+                'tid': span.thread,
+                'args': span.args,
+            })
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'counters': self.counters},
+        }
+
+    def write_chrome_trace(self, f_out):
+        json.dump(self.chrome_trace(), f_out)
+
+
+class _NullSpan(object):
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullTracer(object):
+    """
+    Stands in for a Tracer when nothing is being measured. Every span is the same do-nothing
+    object, so instrumented code costs next to nothing.
+    """
+
+    enabled = False
+    thread_safe = True
+    _span = _NullSpan()
+
+    def span(self, name, category='stage', **args):
+        return self._span
+
+    def count(self, name, amount=1):
+        pass
+
+
+NULL_TRACER = NullTracer()
@@ -1,22 +1,32 @@
-import argparse
 import time
 import os
+import posixpath
 import stm32_crc
 import json
-import shutil
+import logging
 import struct
 import sys
 import uuid
 import zipfile
-from io import BytesIO, StringIO
-from base64 import decodebytes
+from io import BytesIO
+from binascii import a2b_base64
 from string import Template
-from resources.waftools.generate_pbpack import generate_pbpack
-from resources.resource_map.resource_generator_png import PngResourceGenerator
-from resources.resource_map.resource_generator_font import FontResourceGenerator
-from resources.resource_map.resource_generator_raw import ResourceGeneratorRaw
+from build_graph import BuildGraph
+from resources.resource_map.resource_generator import LazyResourceGenerator
+from pbpack import ResourcePack
 from templates import *
+from asset_bundle import AssetBundle, is_asset_bundle
+from asset_store import ASSET_KEYS, AssetStore
+from streaming_json import load_watchface_info
 from convert_config import convert_config, get_bw_or_color
+from pbw_writer import COMPRESSION_TYPES, write_pbw
+from build_cache import BuildCache
+from build_trace import NULL_TRACER
+from build_metrics import BUILDS, BUILD_CACHE, BUILD_SECONDS
+from digests import data_digest, reproducible_timestamp, reproducible_uuid, resource_fingerprint, \
+    watchface_digest
+
+logger = logging.getLogger(__name__)
 
 PBPACK_FILENAME = "app_resources.pbpack"
 GENERATOR_NAME = "WatchfaceGenerator"
@@ -25,8 +35,16 @@ WATCHFACE_INFO = "watchface_info.json"
 APP_INFO = "appinfo.json"
 APP_BINARY = "pebble-app.bin"
 MANIFEST_VERSION = 2
+# manifest['debug'] key listing the input fingerprint of each resource in the pbpack
+RESOURCE_FINGERPRINTS_KEY = "resource_fingerprints"
+# manifest['debug'] key listing the sha256 of each resource's content in the pbpack
+RESOURCE_DIGESTS_KEY = "resource_digests"
 GENERATED_UUID_PREFIX_BYTES = b'\x13\x37\x13\x37'
 GENERATED_UUID_PREFIX_STR = "13371337"
+# Imported the first time a resource of their type is built rather than reused
+PNG_GENERATOR = LazyResourceGenerator('png')
+FONT_GENERATOR = LazyResourceGenerator('font')
+RAW_GENERATOR = LazyResourceGenerator('raw')
 
 # metadata: (addr, format)
 NAME_ADDR = (0x18, '32s') # truncated to 32 length byte string
@@ -49,21 +67,22 @@ def fstm32crc(path):
         binfile = f.read()
         return stm32_crc.crc32(binfile) & 0xFFFFFFFF
     
-def blen(byte_stream):
-    return byte_stream.getbuffer().nbytes
+def blen(data):
+    # data is any bytes-like object
+    return memoryview(data).nbytes
 
-def stm32crc(byte_stream):
-    binfile = byte_stream.getvalue()
-    return stm32_crc.crc32(binfile) & 0xFFFFFFFF
+def stm32crc(data):
+    return stm32_crc.crc32(memoryview(data)) & 0xFFFFFFFF
     
-def generate_manifest(binary, resources):
-    timestamp = int(time.time())
+def generate_manifest(binary, resources, timestamp=None, debug=None):
+    if timestamp is None:
+        timestamp = int(time.time())
     
     manifest = {
         'manifestVersion' : MANIFEST_VERSION,
         'generatedAt' : timestamp,
         'generatedBy' : GENERATOR_NAME,
-        'debug' : {},
+        'debug' : debug or {},
     }
 
     manifest['application'] = {
@@ -86,9 +105,7 @@ def generate_manifest(binary, resources):
 
     manifest['type'] = 'application'
 
-    manifest_stream = StringIO()
-    json.dump(manifest, manifest_stream)
-    return manifest_stream
+    return json.dumps(manifest).encode('utf-8')
 
 def generate_uuid_string(base_uuid, prefix):
     uuid_str = str(base_uuid)
@@ -101,22 +118,100 @@ def generate_uuid_bytes(base_uuid, prefix):
 def truncate_to_32_bytes(name):
     return name[:30] + '..' if len(name) > 32 else name
 
-def write_value_at_offset(opened_file, offset, format_str, value):
-    opened_file.seek(offset)
-    opened_file.write(struct.pack(format_str, value))
+def write_value_at_offset(buffer, offset, format_str, value):
+    struct.pack_into(format_str, buffer, offset, value)
 
 def convert_base64_to_bytes(data):
-    return BytesIO(decodebytes(bytes(data, "utf-8")))
+    # a2b_base64 reads an ASCII str in place, encoding it first would copy the whole text
+    return a2b_base64(data)
+
+def load_asset(value, bundle=None, asset_store=None):
+    # Assets are either inline base64 strings, {"file": <path>} references into an asset bundle
+    # or {"sha256": <digest>} references into an asset store
+    if isinstance(value, dict):
+        if 'file' in value:
+            if bundle is None:
+                raise ValueError(f"Asset {value['file']} can only be referenced from an asset bundle")
+            return bundle.read(value['file'])
+        if 'sha256' in value:
+            if asset_store is None:
+                raise ValueError(f"Asset {value['sha256']} referenced without an asset store")
+            return asset_store.get(value['sha256'])
+        raise ValueError(f"Unknown asset reference {value}")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # Already decoded by the streaming loader
+        return value
+    return convert_base64_to_bytes(value)
 
 def convert_name(name):
     return name.lower().replace(' ', '-')
 
-def create_watchface(watchface_info_string, template_pbw_stream):
+def parse_watchface_info(watchface_info_string):
+    # watchface_info_string may also be an already parsed dict
+    if isinstance(watchface_info_string, dict):
+        return watchface_info_string
+    return json.loads(watchface_info_string)
+
+def watchface_pbw_name(watchface_info):
+    return convert_name(watchface_info['metadata']['name']) + '.pbw'
+
+def load_previous_resources(previous_pbw):
+    # Returns {fingerprint: content} for every resource in a pbw built by this generator, so an
+    # unchanged resource can be copied over instead of being generated again. Content that
+    # doesn't match the digest its manifest recorded (a pbpack that was changed or swapped since)
+    # is left out and gets rebuilt. The manifest itself is trusted, only pass pbws you built.
+    if isinstance(previous_pbw, (bytes, bytearray, memoryview)):
+        previous_pbw = BytesIO(previous_pbw)
+
+    previous_resources = {}
+    with zipfile.ZipFile(previous_pbw) as pbw_zip:
+        for path in pbw_zip.namelist():
+            if posixpath.basename(path) != MANIFEST_FILENAME:
+                continue
+            debug = json.loads(pbw_zip.read(path)).get('debug', {})
+            fingerprints = debug.get(RESOURCE_FINGERPRINTS_KEY)
+            digests = debug.get(RESOURCE_DIGESTS_KEY)
+            if not fingerprints or not digests or len(fingerprints) != len(digests):
+                continue
+
+            pbpack_path = posixpath.join(posixpath.dirname(path), PBPACK_FILENAME)
+            try:
+                pbpack_stream = BytesIO(pbw_zip.read(pbpack_path))
+                pack = ResourcePack.deserialize(pbpack_stream, is_system=False)
+            except Exception:
+                # Missing or corrupt, build this platform's resources from scratch
+                continue
+            if len(pack.table_entries) != len(fingerprints):
+                continue
+            for fingerprint, digest, entry in zip(fingerprints, digests, pack.table_entries):
+                content = pack.contents[entry.content_index]
+                if data_digest(content) == digest:
+                    previous_resources[fingerprint] = content
+    return previous_resources
+
+def build_watchface_digest(watchface_info, template_pbw_stream, bundle=None, asset_store=None):
+    # Identifies the build for reproducible output and caching
+    return watchface_digest(watchface_info, data_digest(template_pbw_stream),
+                            lambda value: load_asset(value, bundle, asset_store))
+
+def build_watchface_files(watchface_info_string, template_pbw_stream, bundle=None, asset_store=None,
+                          build_digest=None, known_resources=None, deadline=None,
+                          tracer=NULL_TRACER, executor=None):
+    # Returns the files that go into the pbw as [(path, bytes-like data)] and the pbw name.
+    # With a build_digest the uuid (unless given) and timestamps are derived from it, so the same
+    # input always gives the same files. known_resources is a {fingerprint: content} dict of
+    # resources that were already built, they're reused and new ones are added to it.
+    # deadline (a build_scheduler.Deadline) is checked between build stages, tracer (a
+    # build_trace.Tracer) times them. With an executor (a concurrent.futures thread or process
+    # pool) resources are built concurrently, see build_graph.BuildGraph.
     # load the data
-    watchface_info = json.loads(watchface_info_string)
+    if deadline is not None:
+        deadline.check('decode')
+    watchface_info = parse_watchface_info(watchface_info_string)
     pbw_zip = zipfile.ZipFile(template_pbw_stream)
+    customization = watchface_info['customization']
 
-    # filename, relpath, data stream
+    # filename, relpath, bytes-like data
     package_files = []
 
     # generate uuid try to use preexisting if exists
@@ -124,10 +219,18 @@ def create_watchface(watchface_info_string, template_pbw_stream):
     try:
         base_uuid = uuid.UUID(data_uuid)
     except:
-        base_uuid = uuid.uuid1()
+        if build_digest is not None:
+            base_uuid = reproducible_uuid(build_digest)
+        else:
+            # Not uuid1: the prefix overwrites its fast changing time bits, so a long running
+            # process would keep handing out the same uuid
+            base_uuid = uuid.uuid4()
+    timestamp = reproducible_timestamp(build_digest) if build_digest is not None else None
     uuid_str = generate_uuid_string(base_uuid, GENERATED_UUID_PREFIX_STR)
     uuid_bytes = generate_uuid_bytes(base_uuid, GENERATED_UUID_PREFIX_BYTES)
-    print("UUID:", uuid_str)
+    # Logged rather than printed, so builds run as a library (services, load tests) stay quiet
+    # unless logging is set up. The command line logs at INFO.
+    logger.info("UUID: %s", uuid_str)
 
     # setup names
     trunc_name = bytes(truncate_to_32_bytes(watchface_info['metadata']['name']), 'UTF8')
@@ -143,40 +246,55 @@ def create_watchface(watchface_info_string, template_pbw_stream):
         version=watchface_info['metadata'].get('version', '1.0'),
         new_uuid=uuid_str
     )
-    app_info_stream = StringIO(app_info_str)
-    package_files.append((APP_INFO, "", app_info_stream))
-
-    # create packages for each platform
+    package_files.append((APP_INFO, "", app_info_str.encode('utf-8')))
+
+    # Load every asset once, they're shared by all of the platforms
+    with tracer.span('decode') as span:
+        background_data = load_asset(customization["background"]["image_data"], bundle, asset_store)
+        bw_background_data = background_data
+        if "bw_image_data" in customization["background"]:
+            bw_background_data = load_asset(customization["background"]["bw_image_data"], bundle, asset_store)
+        time_font_data = load_asset(customization["clocks"]["digital"]["font_data"], bundle, asset_store)
+        date_font_data = load_asset(customization["date"]["font_data"], bundle, asset_store)
+        text_font_data = load_asset(customization["text"]["font_data"], bundle, asset_store)
+        span.set(bytes_out=blen(background_data) + blen(time_font_data) + blen(date_font_data) +
+                 blen(text_font_data) +
+                 (blen(bw_background_data) if bw_background_data is not background_data else 0))
+
+    # Set up the resources of every platform, then build them all in one graph: fonts and images
+    # that come out the same on several platforms are only built once
+    graph = BuildGraph(known_resources, deadline=deadline, tracer=tracer)
+    platform_packs = []
     for platform in watchface_info['metadata']['target_platforms']:
         if not platform in ('aplite', 'basalt', 'chalk', 'diorite', 'emery'):
             raise ValueError(f"Unknown platform {platform}")
-        
+
+        BUILDS.inc(platform=platform)
         # Set up resource data. These should reflect the appinfo/package.json
         # background png resource
         background_png_dict = BACKGROUND_PNG_DICT.copy()
-        background_png_dict['data'] = convert_base64_to_bytes(get_bw_or_color(watchface_info["customization"]["background"], platform, "image_data")).getvalue()
-        if platform in ('aplite', 'diorite') and "bw_image_data" in watchface_info["customization"]["background"]:
-            background_png_dict['data'] = convert_base64_to_bytes(watchface_info["customization"]["background"]["bw_image_data"]).getvalue()
+        if platform in ('aplite', 'diorite'):
+            background_png_dict['data'] = bw_background_data
         else:
-            background_png_dict['data'] = convert_base64_to_bytes(watchface_info["customization"]["background"]["image_data"]).getvalue()
+            background_png_dict['data'] = background_data
         background_png_dict['targetPlatforms'] = platform
 
         # Time font resource
         time_font_dict = TIME_FONT_DICT.copy()
         time_font_dict['name'] = f'FONT_TIME_{watchface_info["customization"]["clocks"]["digital"]["font_size"]}'
-        time_font_dict['data'] = convert_base64_to_bytes(watchface_info["customization"]["clocks"]["digital"]["font_data"])
+        time_font_dict['data'] = time_font_data
         time_font_dict['targetPlatforms'] = platform
 
         # Date font resource
         date_font_dict = DATE_FONT_DICT.copy()
         date_font_dict['name'] = f'FONT_DATE_{watchface_info["customization"]["date"]["font_size"]}'
-        date_font_dict['data'] = convert_base64_to_bytes(watchface_info["customization"]["date"]["font_data"])
+        date_font_dict['data'] = date_font_data
         date_font_dict['targetPlatforms'] = platform
 
         # Text font resource
         text_font_dict = TEXT_FONT_DICT.copy()
         text_font_dict['name'] = f'FONT_TEXT_{watchface_info["customization"]["text"]["font_size"]}'
-        text_font_dict['data'] = convert_base64_to_bytes(watchface_info["customization"]["text"]["font_data"])
+        text_font_dict['data'] = text_font_data
         text_font_dict['targetPlatforms'] = platform
 
         # Raw Data resource
@@ -185,56 +303,231 @@ def create_watchface(watchface_info_string, template_pbw_stream):
         data_dict['targetPlatforms'] = platform
 
         resource_data = [ # like so: (resource info dict, resource generator type)
-            (background_png_dict, PngResourceGenerator),
-            (time_font_dict, FontResourceGenerator),
-            (date_font_dict, FontResourceGenerator),
-            (text_font_dict, FontResourceGenerator),
-            (data_dict, ResourceGeneratorRaw)
+            (background_png_dict, PNG_GENERATOR),
+            (time_font_dict, FONT_GENERATOR),
+            (date_font_dict, FONT_GENERATOR),
+            (text_font_dict, FONT_GENERATOR),
+            (data_dict, RAW_GENERATOR)
         ]
-        
-        # Generate resource pack, write to pbpack_path
-        resource_pack, pbpack_stream = generate_pbpack(platform, resource_data)
-        package_files.append((PBPACK_FILENAME, f"{platform}/", pbpack_stream))
-
-        # Copy and update binary
-        with pbw_zip.open(os.path.join(f"{platform}/", APP_BINARY)) as f:
-            binary_stream = BytesIO(f.read())
-        write_value_at_offset(binary_stream, NAME_ADDR[0], NAME_ADDR[1], trunc_name)
-        write_value_at_offset(binary_stream, COMPANY_ADDR[0], COMPANY_ADDR[1], trunc_comp)
-        write_value_at_offset(binary_stream, UUID_ADDR[0], UUID_ADDR[1], uuid_bytes)
-        write_value_at_offset(binary_stream, RESOURCE_CRC_ADDR[0], RESOURCE_CRC_ADDR[1], resource_pack.crc)
-        package_files.append((APP_BINARY, f"{platform}/", binary_stream))
-
-        # Generate manifest, write to manifest_path
-        manifest_stream = generate_manifest(binary_stream, pbpack_stream)
-        package_files.append((MANIFEST_FILENAME, f"{platform}/", manifest_stream))
+
+        with tracer.span('fingerprint', platform=platform):
+            fingerprints = [resource_fingerprint(platform, rd, rt) for rd, rt in resource_data]
+        resources = [graph.add_resource(platform, rd, rt, fingerprint)
+                     for (rd, rt), fingerprint in zip(resource_data, fingerprints)]
+        platform_packs.append((platform, fingerprints, graph.add_pack(platform, resources)))
+
+    # Generate the resource packs
+    graph.run(executor)
+
+    for platform, fingerprints, pack in platform_packs:
+        with tracer.span('platform', 'platform', platform=platform):
+            pbpack_data = pack.stream.getbuffer()
+            package_files.append((PBPACK_FILENAME, f"{platform}/", pbpack_data))
+
+            # Copy and update binary
+            with tracer.span('binary', platform=platform) as span:
+                binary_info = pbw_zip.getinfo(os.path.join(f"{platform}/", APP_BINARY))
+                binary = bytearray(binary_info.file_size)
+                with pbw_zip.open(binary_info) as f:
+                    f.readinto(binary)
+                write_value_at_offset(binary, NAME_ADDR[0], NAME_ADDR[1], trunc_name)
+                write_value_at_offset(binary, COMPANY_ADDR[0], COMPANY_ADDR[1], trunc_comp)
+                write_value_at_offset(binary, UUID_ADDR[0], UUID_ADDR[1], uuid_bytes)
+                write_value_at_offset(binary, RESOURCE_CRC_ADDR[0], RESOURCE_CRC_ADDR[1], pack.pack.crc)
+                span.set(bytes_out=len(binary))
+            package_files.append((APP_BINARY, f"{platform}/", binary))
+
+            # Generate manifest, write to manifest_path. Mostly the CRCs of the binary and pbpack.
+            with tracer.span('manifest', platform=platform) as span:
+                digests = [data_digest(resource.data) for resource in pack.resources]
+                manifest_data = generate_manifest(binary, pbpack_data, timestamp,
+                                                  {RESOURCE_FINGERPRINTS_KEY: fingerprints,
+                                                   RESOURCE_DIGESTS_KEY: digests})
+                span.set(bytes_in=len(binary) + blen(pbpack_data))
+            package_files.append((MANIFEST_FILENAME, f"{platform}/", manifest_data))
 
     pbw_zip.close()
 
-    # And wrap it all into a pbw
-    pbw_name = convert_name(watchface_info['metadata']['name']) + '.pbw'
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        for filename, rel_path, data_stream in package_files:
-            file_path = os.path.join(rel_path, filename)
-            zip_file.writestr(file_path, data_stream.getvalue())
-        zip_file.comment = bytes(pbw_name, "UTF-8")
+    pbw_name = watchface_pbw_name(watchface_info)
+    entries = [(os.path.join(rel_path, filename), data)
+               for filename, rel_path, data in package_files]
+    return entries, pbw_name
+
+@BUILD_SECONDS.time()
+def write_watchface(f_out, watchface_info_string, template_pbw_stream, bundle=None,
+                    asset_store=None, compression=zipfile.ZIP_DEFLATED, compresslevel=None,
+                    reproducible=False, cache=None, previous_pbw=None, known_resources=None,
+                    deadline=None, tracer=NULL_TRACER, executor=None):
+    # Streams the pbw to the binary stream f_out (a file, socket file, ...), returns the pbw name.
+    # A BuildCache implies reproducible output, nothing else could ever be a hit.
+    # previous_pbw (a path, bytes or binary file) is an earlier build of this watchface to reuse
+    # unchanged resources from, known_resources is shared between builds (see
+    # build_watchface_files). tracer (a build_trace.Tracer) collects timings of every stage,
+    # executor builds resources concurrently.
+    watchface_info = parse_watchface_info(watchface_info_string)
+
+    build_digest = None
+    if reproducible or cache is not None:
+        with tracer.span('digest'):
+            build_digest = build_watchface_digest(watchface_info, template_pbw_stream, bundle,
+                                                  asset_store)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = data_digest(f"{build_digest}:{compression}:{compresslevel}".encode('utf-8'))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            tracer.count('cache_hit')
+            BUILD_CACHE.inc(result='hit')
+            pbw, pbw_name = cached
+            f_out.write(pbw)
+            return pbw_name
+        tracer.count('cache_miss')
+        BUILD_CACHE.inc(result='miss')
+
+    if previous_pbw is not None:
+        if known_resources is None:
+            known_resources = {}
+        with tracer.span('previous_pbw'):
+            known_resources.update(load_previous_resources(previous_pbw))
+
+    entries, pbw_name = build_watchface_files(watchface_info, template_pbw_stream, bundle,
+                                              asset_store, build_digest, known_resources, deadline,
+                                              tracer, executor)
+    if deadline is not None:
+        deadline.check('zip')
+    date_time = None
+    if build_digest is not None:
+        date_time = time.gmtime(reproducible_timestamp(build_digest))[:6]
+
+    if cache is None:
+        with tracer.span('zip') as span:
+            size = write_pbw(f_out, entries, bytes(pbw_name, "UTF-8"), compression, compresslevel,
+                             date_time)
+            span.set(bytes_in=sum(blen(data) for path, data in entries), bytes_out=size)
+        return pbw_name
 
+    zip_buffer = BytesIO()
+    with tracer.span('zip') as span:
+        size = write_pbw(zip_buffer, entries, bytes(pbw_name, "UTF-8"), compression, compresslevel,
+                         date_time)
+        span.set(bytes_in=sum(blen(data) for path, data in entries), bytes_out=size)
+    cache.put(cache_key, zip_buffer.getbuffer(), pbw_name)
+    f_out.write(zip_buffer.getbuffer())
+    return pbw_name
+
+def create_watchface(watchface_info_string, template_pbw_stream, bundle=None, asset_store=None,
+                     compression=zipfile.ZIP_DEFLATED, compresslevel=None, reproducible=False,
+                     cache=None, previous_pbw=None, deadline=None, tracer=NULL_TRACER,
+                     executor=None):
+    zip_buffer = BytesIO()
+    pbw_name = write_watchface(zip_buffer, watchface_info_string, template_pbw_stream, bundle,
+                               asset_store, compression, compresslevel, reproducible, cache,
+                               previous_pbw, deadline=deadline, tracer=tracer,
+                               executor=executor)
     return zip_buffer.getvalue(), pbw_name
 
+def load_watchface_assets(watchface_info, bundle=None, asset_store=None):
+    # Returns a copy of watchface_info with every asset loaded as bytes, so several builds from it
+    # don't decode or read the assets again
+    def load(value, key=None):
+        if key in ASSET_KEYS:
+            return load_asset(value, bundle, asset_store)
+        if isinstance(value, dict):
+            return {k: load(v, k) for k, v in value.items()}
+        return value
+
+    return load(watchface_info)
+
+def merge_overlay(base, overlay):
+    # Returns base with overlay merged in: nested dicts are merged, anything else (including
+    # assets) is replaced. Unchanged parts are shared with base, which isn't modified.
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict) and key not in ASSET_KEYS:
+            merged[key] = merge_overlay(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def create_watchface_variants(watchface_info_string, overlays, template_pbw_stream, bundle=None,
+                              asset_store=None, previous_pbw=None, **options):
+    # Builds one pbw per overlay, each overlay is merged into the base watchface_info's
+    # customization. Returns a list of (pbw, pbw name). Fonts and images that are the same for
+    # every variant are built once, so usually only the DATA resource and the app binary
+    # metadata are generated per variant. options (compression, reproducible, cache) are passed on
+    # to write_watchface.
+    watchface_info = load_watchface_assets(parse_watchface_info(watchface_info_string), bundle,
+                                           asset_store)
+    known_resources = {}
+    if previous_pbw is not None:
+        known_resources.update(load_previous_resources(previous_pbw))
+
+    variants = []
+    for overlay in overlays:
+        variant_info = dict(watchface_info)
+        variant_info['customization'] = merge_overlay(watchface_info['customization'], overlay)
+
+        zip_buffer = BytesIO()
+        pbw_name = write_watchface(zip_buffer, variant_info, template_pbw_stream, bundle,
+                                   asset_store, known_resources=known_resources, **options)
+        variants.append((zip_buffer.getvalue(), pbw_name))
+    return variants
+
+def create_watchface_from_bundle(bundle_source, template_pbw_stream, asset_store=None, **options):
+    # bundle_source is a path, bytes or a binary file holding a zip/tar asset bundle.
+    # options (compression, reproducible, ...) are passed on to create_watchface
+    with AssetBundle(bundle_source) as bundle:
+        return create_watchface(bundle.read_watchface_info(), template_pbw_stream, bundle,
+                                asset_store, **options)
+
+def create_watchface_from_stream(info_stream, template_pbw_stream, asset_store=None, **options):
+    # Assets are decoded while the JSON is read, so the base64 text is never held all at once
+    return create_watchface(load_watchface_info(info_stream), template_pbw_stream,
+                            asset_store=asset_store, **options)
         
 if __name__ == "__main__":
+    # Only the command line needs these, importing create_watchface doesn't pay for them
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    from build_memory import DEFAULT_SNAPSHOT_TOP, MIB, MemoryBudgetExceeded, MemoryTracer
+    from build_profile import DEFAULT_TOP, PROFILE_MODES, BuildProfiler
+    from build_trace import Tracer
+
     parser = argparse.ArgumentParser(description='generate pbpack and manifest')
 
     parser.add_argument('template_pbw_path', help='path to template pbw')
-    parser.add_argument('info_path', help='path to watchface_info.json')
+    parser.add_argument('info_path', help='path to watchface_info.json, or to a zip/tar asset bundle')
     parser.add_argument('output_dir', help='path to output directory')
+    parser.add_argument('--asset-store', help='asset store to resolve {"sha256": ...} assets from')
+    parser.add_argument('--compression', choices=COMPRESSION_TYPES.keys(), default='deflate',
+                        help='how files are stored in the pbw')
+    parser.add_argument('--compression-level', type=int, help='deflate level, 0-9')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='derive the uuid and timestamps from the input, so the same input gives the same pbw')
+    parser.add_argument('--cache-dir', help='cache built pbws here (implies --reproducible)')
+    parser.add_argument('--previous-pbw',
+                        help='earlier build of this watchface, unchanged resources are copied from it')
+    parser.add_argument('--trace',
+                        help='write a Chrome trace (chrome://tracing, Perfetto) of the build stages here')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='profile the build, writes PREFIX.pstats (cprofile) and PREFIX.collapsed '
+                             '(for flamegraphs) and prints the hottest functions')
+    parser.add_argument('--profile-mode', choices=PROFILE_MODES, default='cprofile',
+                        help='cprofile is exact but slows the build down, sample has little overhead')
+    parser.add_argument('--profile-top', type=int, default=DEFAULT_TOP,
+                        help='number of functions to print')
+    parser.add_argument('--jobs', type=int,
+                        help='build independent resources (fonts, images) on this many processes')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='account for the memory used by each build stage with tracemalloc and '
+                             'print it, with the top allocation sites of each stage')
+    parser.add_argument('--memory-budget', type=float, metavar='MIB',
+                        help='abort the build once it has used more than this many MiB')
 
     args = parser.parse_args()
-
-    # load watchface info from file
-    with open(args.info_path, 'r') as f:
-        watchface_info_string = f.read()
+    # The uuid and the progress of long builds, e.g. extended fonts, are logged
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     # load template pbw from file
     with open(args.template_pbw_path, "rb") as f:
@@ -244,7 +537,62 @@ if __name__ == "__main__":
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    pbw, pbw_name = create_watchface(watchface_info_string, template_pbw_stream)
-    
-    with open(os.path.join(args.output_dir, pbw_name), 'wb') as f:
-        f.write(pbw)
\ No newline at end of file
+    asset_store = AssetStore(args.asset_store) if args.asset_store else None
+    compression = COMPRESSION_TYPES[args.compression]
+
+    cache = BuildCache(directory=args.cache_dir) if args.cache_dir else None
+    if args.memory_report or args.memory_budget:
+        budget = int(args.memory_budget * MIB) if args.memory_budget else None
+        tracer = MemoryTracer(budget, snapshot_top=DEFAULT_SNAPSHOT_TOP if args.memory_report else 0)
+    else:
+        tracer = Tracer() if args.trace else NULL_TRACER
+    executor = ProcessPoolExecutor(args.jobs) if args.jobs else None
+    options = dict(compression=compression, compresslevel=args.compression_level,
+                   reproducible=args.reproducible, cache=cache, previous_pbw=args.previous_pbw,
+                   tracer=tracer, executor=executor)
+
+    profiler = BuildProfiler(args.profile_mode) if args.profile else None
+    if profiler is not None:
+        profiler.start()
+
+    output_path = None
+    try:
+        if is_asset_bundle(args.info_path):
+            with AssetBundle(args.info_path) as bundle:
+                watchface_info = parse_watchface_info(bundle.read_watchface_info())
+                output_path = os.path.join(args.output_dir, watchface_pbw_name(watchface_info))
+                with open(output_path, 'wb') as f_out:
+                    write_watchface(f_out, watchface_info, template_pbw_stream, bundle, asset_store,
+                                    **options)
+        else:
+            # stream watchface info from file
+            with open(args.info_path, 'rb') as f, tracer.span('parse'):
+                watchface_info = load_watchface_info(f)
+            output_path = os.path.join(args.output_dir, watchface_pbw_name(watchface_info))
+            with open(output_path, 'wb') as f_out:
+                write_watchface(f_out, watchface_info, template_pbw_stream,
+                                asset_store=asset_store, **options)
+    except MemoryBudgetExceeded as e:
+        if output_path is not None and os.path.exists(output_path):
+            os.unlink(output_path)
+        sys.exit(f"Error: {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if profiler is not None:
+        profiler.stop()
+        print("Profile written to", ', '.join(profiler.write(args.profile)))
+        profiler.print_top(args.profile_top)
+
+    if cache is not None:
+        print("Build cache:", cache.stats())
+
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            tracer.write_chrome_trace(f)
+        for name, total in sorted(tracer.summary().items(), key=lambda item: -item[1]['seconds']):
+            print(f"{name:>12} {total['seconds'] * 1000:9.2f}ms  x{total['count']}")
+
+    if args.memory_report:
+        print('\n'.join(tracer.memory_report()))
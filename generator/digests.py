@@ -0,0 +1,116 @@
+import hashlib
+import json
+import uuid
+
+from asset_store import ASSET_KEYS
+
+# Bump this when a generator change alters the output for the same input, so old cached and
+# reproducible builds aren't mistaken for new ones.
+BUILD_FORMAT_VERSION = 2
+
+# Reproducible uuids are uuid5s in this namespace
+REPRODUCIBLE_UUID_NAMESPACE = uuid.UUID('6f0c3b9e-5a8e-4d6b-9a41-2c7f1e0b8d53')
+# Reproducible timestamps fall within a year of this (2024-01-01 UTC), so a changed watchface
+# still gets a different resource timestamp.
+REPRODUCIBLE_EPOCH = 1704067200
+REPRODUCIBLE_SPAN = 365 * 24 * 60 * 60
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def data_digest(data):
+    """
+    sha256 hex digest of a bytes-like object or a seekable binary stream
+    """
+
+    if hasattr(data, 'getbuffer'):
+        data = data.getbuffer()
+    elif hasattr(data, 'read'):
+        digest = hashlib.sha256()
+        position = data.tell()
+        data.seek(0)
+        for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        data.seek(position)
+        return digest.hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_watchface_info(watchface_info, load_asset):
+    """
+    Returns a copy of watchface_info with every asset replaced by {"sha256": <digest>}, so the
+    same watchface gives the same result whether its assets are inline base64, bundle files or
+    asset store references. load_asset(value) returns the bytes of an asset value.
+    """
+
+    def normalize(value, key=None):
+        if key in ASSET_KEYS:
+            if isinstance(value, dict) and 'sha256' in value:
+                # Already content addressed, no need to load it
+                return {'sha256': value['sha256']}
+            return {'sha256': data_digest(load_asset(value))}
+        if isinstance(value, dict):
+            return {k: normalize(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+
+    return normalize(watchface_info)
+
+
+def watchface_digest(watchface_info, template_digest, load_asset):
+    """
+    Digest of everything that goes into a build: the normalized watchface_info, the template
+    pbw (template_digest is its data_digest) and the build format version.
+    """
+
+    normalized = normalize_watchface_info(watchface_info, load_asset)
+    build_input = {
+        'version': BUILD_FORMAT_VERSION,
+        'template': template_digest,
+        'watchface_info': normalized,
+    }
+    return data_digest(json.dumps(build_input, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+
+def reproducible_uuid(build_digest):
+    return uuid.uuid5(REPRODUCIBLE_UUID_NAMESPACE, build_digest)
+
+
+def reproducible_timestamp(build_digest):
+    return REPRODUCIBLE_EPOCH + int(build_digest[:8], 16) % REPRODUCIBLE_SPAN
+
+
+def resource_fingerprint(platform, resource_dict, generator_type):
+    """
+    Digest of everything that goes into one resource: its definition, its data, the platform and
+    the generator that builds it. Resources with the same fingerprint build to the same bytes.
+    """
+
+    definition = {key: value for key, value in resource_dict.items() if key != 'data'}
+    resource_input = {
+        'version': BUILD_FORMAT_VERSION,
+        'platform': platform,
+        'generator': generator_type.type,
+        'definition': definition,
+        'data': data_digest(resource_dict['data']),
+    }
+    return data_digest(json.dumps(resource_input, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+
+def resource_output_digest(resource_dict, generator_type, platform_inputs):
+    """
+    Digest of what a resource's bytes depend on. Like resource_fingerprint, but the platform is
+    replaced by the platform properties the generator reads (ResourceGenerator.platform_inputs), so
+    a resource that builds to the same bytes on several platforms has the same digest on each.
+    """
+
+    definition = {key: value for key, value in resource_dict.items()
+                  if key not in ('data', 'targetPlatforms')}
+    resource_input = {
+        'version': BUILD_FORMAT_VERSION,
+        'platform_inputs': platform_inputs,
+        'generator': generator_type.type,
+        'definition': definition,
+        'data': data_digest(resource_dict['data']),
+    }
+    return data_digest(json.dumps(resource_input, sort_keys=True, separators=(',', ':')).encode('utf-8'))
@@ -0,0 +1,105 @@
+import freetype
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from threading import Lock
+
+from build_metrics import FONT_FACE_EVICTIONS, FONT_FACES
+
+DEFAULT_MAX_FACES = 8
+
+
+class FacePool(object):
+    """
+    Bounded pool of parsed freetype.Face objects keyed by the sha256 of the TTF data.
+
+    A face is handed out to one user at a time and goes back to the pool when they're done, so
+    the pool is safe to share between threads. Rendering with the faces still has to be
+    serialized per process (FontResourceGenerator.lock, or one font worker per process).
+
+    Hits, misses and evictions are also counted in build_metrics.
+    """
+
+    def __init__(self, max_faces=DEFAULT_MAX_FACES):
+        self.max_faces = max_faces
+        self.lock = Lock()
+        # digest -> list of idle faces, least recently used digest first
+        self.idle_faces = OrderedDict()
+        self.num_idle = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def face(self, data, pixel_height):
+        """
+        Check out a face for data, sized to pixel_height. A new face is parsed on a miss.
+        """
+
+        # Hash the buffer in place, a memoryview of a mapped bundle is only copied on a miss
+        font_data = data.getbuffer() if hasattr(data, 'getbuffer') else data
+        digest = hashlib.sha256(font_data).digest()
+
+        face = None
+        with self.lock:
+            faces = self.idle_faces.get(digest)
+            if faces:
+                face = faces.pop()
+                self.num_idle -= 1
+                if not faces:
+                    del self.idle_faces[digest]
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if face is None:
+            FONT_FACES.inc(result='miss')
+            face = freetype.Face(BytesIO(font_data))
+        else:
+            FONT_FACES.inc(result='hit')
+
+        # The previous user may have rendered at a different size
+        face.set_pixel_sizes(0, pixel_height)
+
+        try:
+            yield face
+        finally:
+            self._release(digest, face)
+
+    def _release(self, digest, face):
+        evicted = 0
+        with self.lock:
+            self.idle_faces.setdefault(digest, []).append(face)
+            self.idle_faces.move_to_end(digest)
+            self.num_idle += 1
+
+            while self.num_idle > self.max_faces:
+                oldest_digest, faces = next(iter(self.idle_faces.items()))
+                faces.pop(0)
+                if not faces:
+                    del self.idle_faces[oldest_digest]
+                self.num_idle -= 1
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            FONT_FACE_EVICTIONS.inc(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.idle_faces.clear()
+            self.num_idle = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle_faces': self.num_idle,
+                'max_faces': self.max_faces,
+            }
+
+
+# Process wide pool. Font worker processes each end up with their own copy.
+face_pool = FacePool()
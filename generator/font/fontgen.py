@@ -14,7 +14,6 @@
 # limitations under the License.
 
 
-import argparse
 import freetype
 import os
 import re
@@ -22,6 +21,8 @@ import struct
 import sys
 import itertools
 import json
+import collections
+import functools
 from math import ceil
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
@@ -94,10 +95,28 @@ FEATURE_OFFSET_16 = 0x01
 FEATURE_RLE4 = 0x02
 
 
+# The largest hash table FontInfo can describe. Fonts get the smallest table that keeps their
+# buckets at HASH_BUCKET_TARGET_SIZE glyphs or fewer, see choose_hash_table_size().
 HASH_TABLE_SIZE = 255
+HASH_BUCKET_TARGET_SIZE = 4
 OFFSET_TABLE_MAX_SIZE = 128
-MAX_GLYPHS_EXTENDED = HASH_TABLE_SIZE * OFFSET_TABLE_MAX_SIZE
+
+# (uint8_t) hash value, (uint8_t) offset_table_size, (uint16_t) offset
+HASH_TABLE_ENTRY = struct.Struct('<BBH')
+MAX_OFFSET_TABLE_OFFSET = 0xFFFF
+# The 16 bit hash table offsets limit the size of the offset tables, not the hash table size or
+# the bucket size. A font this big has a glyph table over 64k, so its offset table entries are a
+# 2 byte codepoint and a 4 byte offset. The wildcard glyph comes on top of max_glyphs. Codepoints
+# over MAX_2_BYTES_CODEPOINT make entries 8 bytes, such fonts run out of room sooner and fail in
+# build_tables().
+MAX_GLYPHS_EXTENDED = (MAX_OFFSET_TABLE_OFFSET + 1) // 6 - 1
 MAX_GLYPHS = 256
+# Glyphs are rendered one by one either way, batches only set how often progress is reported
+GLYPH_BATCH_SIZE = 512
+
+# Everything build_tables() produces, used to pick between builds with auto compression
+FONT_TABLE_ATTRS = ('glyph_table', 'hash_table', 'offset_tables', 'number_of_glyphs',
+                    'codepoint_bytes', 'offset_size_bytes', 'features', 'table_size')
 
 def grouper(n, iterable, fillvalue=None):
     """grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"""
@@ -107,6 +126,48 @@ def grouper(n, iterable, fillvalue=None):
 def hasher(codepoint, num_glyphs):
     return (codepoint % num_glyphs)
 
+def longest_bucket(codepoints, table_size, limit=None):
+    """
+    Entries in the fullest bucket of a table_size hash table. Counting stops as soon as a bucket
+    holds more than limit entries, the count returned is then only known to be over limit.
+    """
+
+    counts = [0] * table_size
+    longest = 0
+    for cp in codepoints:
+        bucket = hasher(cp, table_size)
+        counts[bucket] += 1
+        if counts[bucket] > longest:
+            longest = counts[bucket]
+            if limit is not None and longest > limit:
+                break
+    return longest
+
+def choose_hash_table_size(codepoints):
+    """
+    Pick the hash table size for a set of codepoints. Every hash table entry costs 4 bytes, so
+    use the smallest table whose longest bucket is at most HASH_BUCKET_TARGET_SIZE entries. If no
+    table size gets there, use the one with the shortest longest bucket.
+    """
+
+    # Auto compression builds the tables twice for the same glyphs
+    return _choose_hash_table_size(tuple(codepoints))
+
+@functools.lru_cache(maxsize=32)
+def _choose_hash_table_size(codepoints):
+    smallest_size = -(-len(codepoints) // HASH_BUCKET_TARGET_SIZE)
+    best_size, best_longest = None, None
+    for table_size in range(min(max(smallest_size, 1), HASH_TABLE_SIZE), HASH_TABLE_SIZE + 1):
+        # A size is out as soon as one of its buckets is as long as the best one so far
+        limit = None if best_longest is None else best_longest - 1
+        longest = longest_bucket(codepoints, table_size, limit)
+        if longest <= HASH_BUCKET_TARGET_SIZE:
+            return table_size
+        if best_longest is None or longest < best_longest:
+            best_size, best_longest = table_size, longest
+
+    return best_size
+
 def bits(x):
     data = []
     for i in range(8):
@@ -114,14 +175,32 @@ def bits(x):
         x = x >> 1
     return data
 
+# Bitmap rows unpacked to one byte per pixel, MSB first
+BYTE_BITS = [bytes(bits(x)) for x in range(256)]
+BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+
+RLE4_MAX_RUN = 2**(4-1)
+RLE4_RUNS = re.compile(b'\x00+|\x01+')
+# Run length of the unit in the low/high nibble of a packed RLE4 byte
+RLE4_LOW_UNIT_LENGTHS = bytes((b & 0x07) + 1 for b in range(256))
+RLE4_HIGH_UNIT_LENGTHS = bytes(((b >> 4) & 0x07) + 1 for b in range(256))
+
+
+class RLE4Error(Exception):
+    pass
+
+
 class Font:
-    def __init__(self, data, height, max_glyphs, max_glyph_size, legacy):
+    def __init__(self, data, height, max_glyphs, max_glyph_size, legacy, face=None):
         self.version = FONT_VERSION_3
         self.max_height = int(height)
         self.legacy = legacy
         self.data = data
-        self.face = freetype.Face(self.data)
-        self.face.set_pixel_sizes(0, self.max_height)
+        if face is None:
+            # Not pooled (see font.face_pool), parse our own copy of the font
+            face = freetype.Face(self.data)
+            face.set_pixel_sizes(0, self.max_height)
+        self.face = face
         self.name = self.face.family_name + b"_" + self.face.style_name
         self.wildcard_codepoint = WILDCARD_CODEPOINT
         self.number_of_glyphs = 0
@@ -132,11 +211,14 @@ class Font:
         self.codepoint_bytes = 2
         self.max_glyphs = max_glyphs
         self.max_glyph_size = max_glyph_size
-        self.glyph_table = []
-        self.hash_table = [0] * self.table_size
-        self.offset_tables = [[] for i in range(self.table_size)]
+        self.glyph_table = bytearray()
+        self.hash_table = bytearray()
+        self.offset_tables = bytearray()
         self.offset_size_bytes = 4
         self.features = 0
+        self.auto_compression = False
+        # gindex -> render_glyph() result, only kept while building with auto compression
+        self.rendered_glyphs = None
 
         self.glyph_header = ''.join((
             '<',  # little_endian
@@ -152,6 +234,9 @@ class Font:
             raise Exception("Compression being set but version != 3 ({})". format(self.version))
         if engine == 'RLE4':
             self.features |= FEATURE_RLE4
+        elif engine == 'auto':
+            # Decided in build_tables, RLE4 is only kept if it makes the font smaller
+            self.auto_compression = True
         else:
             raise Exception("Unsupported compression engine: '{}'. Font {}".format(engine,
                             self.name))
@@ -175,7 +260,7 @@ class Font:
     def set_codepoint_list(self, list_path):
         codepoints_file = open(list_path)
         codepoints_json = json.load(codepoints_file)
-        self.codepoints = [int(cp) for cp in codepoints_json["codepoints"]]
+        self.codepoints = frozenset(int(cp) for cp in codepoints_json["codepoints"])
 
     def is_supported_glyph(self, codepoint):
         return (self.face.get_char_index(codepoint) > 0 or
@@ -186,43 +271,35 @@ class Font:
         # symbol and the length of the run. The length of each run of symbols is limited to
         # [1..2**(RLElen-1)]. For RLE4, the length is 3 bits (0-7), or 1-8 consecutive symbols.
         # For example: 11110111 is compressed to 1*4, 0*1, 1*3. or [(1, 4), (0, 1), (1, 3)]
-
-        RLE_LEN = 2**(4-1)  # TODO possibly make this a parameter.
-        # It would likely be a good idea to look into the 'bitstream' package for lengths that won't
-        # easily fit into a byte/short/int.
-
-        # First, generate a list of tuples (bit, count).
-        unit_list = [(name, len(list(group))) for name, group in itertools.groupby(bitmap)]
-
-        # Second, generate a list of RLE tuples where count <= RLE_LEN. This intermediate step will
-        # make it much easier to implement the binary stream packer below.
-        rle_unit_list = []
-        for name, length in unit_list:
-            while length > 0:
-                unit_len = min(length, RLE_LEN)
-                rle_unit_list.append((name, unit_len))
-                length -= unit_len
+        #
+        # Each unit is packed into a nibble: (symbol << 3) | (length - 1)
+        bitmap = bytes(bitmap)
+
+        units = bytearray()
+        for run in RLE4_RUNS.findall(bitmap):
+            symbol = run[0] << 3
+            length = len(run)
+            while length > RLE4_MAX_RUN:
+                units.append(symbol | (RLE4_MAX_RUN - 1))
+                length -= RLE4_MAX_RUN
+            units.append(symbol | (length - 1))
 
         # Note that num_units does not include the padding added below.
-        num_units = len(rle_unit_list)
+        num_units = len(units)
 
-        # If the list is odd, add a padding unit
+        # If the list is odd, add a padding unit (0 * 1)
         if (num_units % 2) == 1:
-            rle_unit_list.append((0, 1))
+            units.append(0)
 
-        # Now pack the tuples into a binary stream. We can't pack nibbles, so join two
-        glyph_packed = []
-        it = iter(rle_unit_list)
-        for name, length in it:
-            name2, length2 = next(it)
-            packed_byte = name << 3 | (length - 1) | name2 << 7 | (length2 - 1) << 4
-            glyph_packed.append(struct.pack('<B', packed_byte))
+        # We can't pack nibbles, so join two units per byte, first unit in the low nibble
+        low_units = int.from_bytes(units[0::2], 'little')
+        high_units = int.from_bytes(units[1::2], 'little') << 4
+        glyph_packed = bytearray((low_units | high_units).to_bytes(len(units) // 2, 'little'))
 
         # Pad out to the nearest 4 bytes
-        while (len(glyph_packed) % 4) > 0:
-            glyph_packed.append(struct.pack('<B', 0))
+        glyph_packed.extend(bytes(-len(glyph_packed) % 4))
 
-        return (glyph_packed, num_units)
+        return (bytes(glyph_packed), num_units)
 
     # Make sure that we will be able to decompress the glyph in-place
     def check_decompress_glyph_RLE4(self, glyph_packed, width, rle_units):
@@ -231,65 +308,51 @@ class Font:
         # Make sure that we can decode the encoded glyph to end up with the following arrangement:
         #  [ <header> |       <decoded glyph>          ]
         # without overwriting the unprocessed encoded glyph in the process
+        #
+        # The decoder reads one byte (two units) at a time, and writes an output byte whenever it
+        # has 8 or more decoded bits. A unit holds at most 8 bits, so unit i causes at most one
+        # write, at dst = header_size + (bits decoded before unit i) // 8. By then the decoder has
+        # consumed i // 2 + 1 input bytes, so src = src_start + i // 2 + 1. Rather than simulating
+        # the decode we only need to check dst < src for every unit.
 
         header_size = struct.calcsize(self.glyph_header)
-        dst_ptr = header_size
-        src_ptr = self.max_glyph_size - len(glyph_packed)
-
-        def glyph_packed_iterator(tbl, num):
-            for i in range(0, num):
-                yield struct.unpack('<B', tbl[i])[0]
-
-        # Generate glyph buffer. Ignore the header
-        bitmap = [0] * self.max_glyph_size
-        bitmap[-len(glyph_packed):] = glyph_packed_iterator(glyph_packed, len(glyph_packed))
-
-        out_num_bits = 0
-        out = 0
-        total_length = 0
-        while rle_units > 0:
-            if src_ptr >= self.max_glyph_size:
-                raise Exception("Error: input stream too large for buffer. Font {}".
+        src_start = self.max_glyph_size - len(glyph_packed)
+        if src_start < 0:
+            raise RLE4Error("Error: input stream too large for buffer. Font {}".
+                            format(self.name))
+
+        unit_lengths = bytearray(2 * len(glyph_packed))
+        unit_lengths[0::2] = glyph_packed.translate(RLE4_LOW_UNIT_LENGTHS)
+        unit_lengths[1::2] = glyph_packed.translate(RLE4_HIGH_UNIT_LENGTHS)
+        del unit_lengths[rle_units:]
+
+        # Only the units that finish an output byte write anything, and each of those must leave
+        # dst behind src: header_size + bytes_decoded - 1 < src_start + i // 2 + 1
+        bytes_decoded = [0]
+        bytes_decoded.extend(total_bits >> 3 for total_bits in itertools.accumulate(unit_lengths))
+        for i in range(len(unit_lengths)):
+            if bytes_decoded[i + 1] > bytes_decoded[i] and \
+                    header_size + bytes_decoded[i + 1] - 1 >= src_start + (i >> 1) + 1:
+                raise RLE4Error("Error: unable to RLE4 decode in place! Overrun. Font {}".
                                 format(self.name))
+        total_bits = sum(unit_lengths)
 
-            unit_pair = bitmap[src_ptr]
-            src_ptr += 1
-            for i in range(min(rle_units, 2)):
-                colour = (unit_pair >> 3) & 1
-                length = (unit_pair & 0x07) + 1
-                total_length += length
-
-                if colour:
-                    # Generate the bitpattern 111...
-                    add = (1 << length) - 1
-                    out |= (add << out_num_bits)
-                out_num_bits += length
-
-                if out_num_bits >= 8:
-                    if dst_ptr >= src_ptr:
-                        raise Exception("Error: unable to RLE4 decode in place! Overrun. Font {}".
-                                        format(self.name))
-                    if dst_ptr >= self.max_glyph_size:
-                        raise Exception("Error: output bitmap too large for buffer. Font {}".
-                                        format(self.name))
-                    bitmap[dst_ptr] = (out & 0xFF)
-                    dst_ptr += 1
-                    out >>= 8
-                    out_num_bits -= 8
-
-                unit_pair >>= 4
-                rle_units -= 1
-
-        while out_num_bits > 0:
-            bitmap[dst_ptr] = (out & 0xFF)
-            dst_ptr += 1
-            out >>= 8
-            out_num_bits -= 8
+        if header_size + ((total_bits + 7) >> 3) > self.max_glyph_size:
+            raise RLE4Error("Error: output bitmap too large for buffer. Font {}".
+                            format(self.name))
 
         # Success! We can in-place decode this glyph
         return True
 
-    def glyph_bits(self, codepoint, gindex):
+    def render_glyph(self, gindex):
+        """
+        Render a glyph with freetype. Returns its metrics and a bitmap with one byte (0 or 1)
+        per pixel.
+        """
+
+        if self.rendered_glyphs is not None and gindex in self.rendered_glyphs:
+            return self.rendered_glyphs[gindex]
+
         flags = (freetype.FT_LOAD_RENDER if self.legacy else
             freetype.FT_LOAD_RENDER | freetype.FT_LOAD_MONOCHROME | freetype.FT_LOAD_TARGET_MONO)
         self.face.load_glyph(gindex, flags)
@@ -303,37 +366,46 @@ class Font:
         bottom = self.max_height - self.face.glyph.bitmap_top
         pixel_mode = self.face.glyph.bitmap.pixel_mode
 
-        glyph_packed = []
+        glyph_bitmap = b''
         if height and width:
-            glyph_bitmap = []
+            # freetype-py copies the whole buffer into a new list on every access, grab it once
+            buffer = bitmap.buffer
             if pixel_mode == 1:  # monochrome font, 1 bit per pixel
-                for i in range(bitmap.rows):
-                    row = []
-                    for j in range(bitmap.pitch):
-                        row.extend(bits(bitmap.buffer[i*bitmap.pitch+j]))
-                    glyph_bitmap.extend(row[:bitmap.width])
+                pitch = bitmap.pitch
+                glyph_bitmap = b''.join(
+                    b''.join(BYTE_BITS[b] for b in buffer[i * pitch:(i + 1) * pitch])[:width]
+                    for i in range(height))
             elif pixel_mode == 2:  # grey font, 255 bits per pixel
-                for val in bitmap.buffer:
-                    glyph_bitmap.extend([1 if val > 127 else 0])
+                glyph_bitmap = bytes(1 if val > 127 else 0 for val in buffer)
             else:
                 # freetype-py should never give us a value not in (1,2)
                 raise Exception("Unsupported pixel mode: {}. Font {}".
                                 format(pixel_mode, self.name))
 
+        rendered = (width, height, left, bottom, advance, glyph_bitmap)
+        if self.rendered_glyphs is not None:
+            self.rendered_glyphs[gindex] = rendered
+        return rendered
+
+    def glyph_bits(self, codepoint, gindex):
+        width, height, left, bottom, advance, glyph_bitmap = self.render_glyph(gindex)
+
+        glyph_packed = b''
+        if height and width:
             if (self.features & FEATURE_RLE4):
                 # HACK WARNING: override the height with the number of RLE4 units.
                 glyph_packed, height = self.compress_glyph_RLE4(glyph_bitmap)
                 if height > 255:
-                    raise Exception("Unable to RLE4 compress -- more than 255 units required"
+                    raise RLE4Error("Unable to RLE4 compress -- more than 255 units required"
                                     "({}). Font {}".format(height, self.name))
                 # Check that we can in-place decompress. Will raise an exception if not.
                 self.check_decompress_glyph_RLE4(glyph_packed, width, height)
             else:
-                for word in grouper(32, glyph_bitmap, 0):
-                    w = 0
-                    for index, bit in enumerate(word):
-                        w |= bit << index
-                    glyph_packed.append(struct.pack('<I', w))
+                # Pack the bits LSB first into 32-bit words
+                bit_chars = glyph_bitmap.translate(BIT_CHARS)
+                bit_chars += b'0' * (-len(bit_chars) % 32)
+                glyph_packed = struct.pack('<%dI' % (len(bit_chars) // 32), *(
+                    int(bit_chars[i:i + 32][::-1], 2) for i in range(0, len(bit_chars), 32)))
 
                 # Confirm that we're smaller than the cache size
                 size = ((width * height) + (8 - 1)) // 8
@@ -343,7 +415,7 @@ class Font:
 
         glyph_header = struct.pack(self.glyph_header, width, height, left, bottom, advance)
 
-        return glyph_header + b''.join(glyph_packed)
+        return glyph_header + glyph_packed
 
     def fontinfo_bits(self):
         if self.version == FONT_VERSION_2:
@@ -366,45 +438,44 @@ class Font:
                           self.features)
 
 
-    def build_tables(self):
-        def build_hash_table(bucket_sizes):
-            acc = 0
-            for i in range(self.table_size):
-                bucket_size = bucket_sizes[i]
-                self.hash_table[i] = (struct.pack('<BBH', i, bucket_size, acc))
-                acc += bucket_size * (self.offset_size_bytes + self.codepoint_bytes)
-
-        def build_offset_tables(glyph_entries):
-            offset_table_format = '<'
-            offset_table_format += 'L' if self.codepoint_bytes == 4 else 'H'
-            offset_table_format += 'L' if self.offset_size_bytes == 4 else 'H'
-
-            bucket_sizes = [0] * self.table_size
-            for entry in glyph_entries:
-                codepoint, offset = entry
-                glyph_hash = hasher(codepoint, self.table_size)
-                self.offset_tables[glyph_hash].append(
-                        struct.pack(offset_table_format, codepoint, offset))
-                bucket_sizes[glyph_hash] = bucket_sizes[glyph_hash] + 1
-                if bucket_sizes[glyph_hash] > OFFSET_TABLE_MAX_SIZE:
-                    print("error: %d > 127" % bucket_sizes[glyph_hash])
-            return bucket_sizes
-
-        def add_glyph(codepoint, next_offset, gindex, glyph_indices_lookup):
-            offset = next_offset
-            if gindex not in glyph_indices_lookup:
-                glyph_bits = self.glyph_bits(codepoint, gindex)
-                glyph_indices_lookup[gindex] = offset
-                self.glyph_table.append(glyph_bits)
-                next_offset += len(glyph_bits)
-            else:
-                offset = glyph_indices_lookup[gindex]
+    def build_tables(self, progress=None):
+        """
+        Render the glyphs and build the font tables. progress, if given, is called with
+        (glyphs_done, glyphs_total) after every batch of GLYPH_BATCH_SIZE glyphs.
+        """
 
-            if (codepoint > MAX_2_BYTES_CODEPOINT):
-                self.codepoint_bytes = 4
+        if not self.auto_compression:
+            self._build_tables(progress)
+            return
 
-            self.number_of_glyphs += 1
-            return offset, next_offset, glyph_indices_lookup
+        # Render every glyph once and pack the font both ways. Uncompressed goes first so
+        # that RLE4 only wins if it's actually smaller.
+        self.rendered_glyphs = {}
+        candidates = []
+        errors = []
+        for compression in (0, FEATURE_RLE4):
+            self.features = (self.features & ~FEATURE_RLE4) | compression
+            try:
+                self._build_tables(progress)
+            except Exception as e:
+                errors.append(e)
+                continue
+            tables = {attr: getattr(self, attr) for attr in FONT_TABLE_ATTRS}
+            candidates.append((self.bitstring_size(), tables))
+            # Only report progress for the first pass, the second one doesn't render anything
+            progress = None
+        self.rendered_glyphs = None
+
+        if not candidates:
+            raise errors[0]
+        size, tables = min(candidates, key=lambda candidate: candidate[0])
+        for attr, value in tables.items():
+            setattr(self, attr, value)
+
+    def collect_glyphs(self):
+        """
+        Returns the (codepoint, gindex) of every glyph going into the font, wildcard first.
+        """
 
         def codepoint_is_in_subset(codepoint):
            if (codepoint not in (WILDCARD_CODEPOINT, ELLIPSIS_CODEPOINT)):
@@ -419,23 +490,12 @@ class Font:
                  return False
            return True
 
-        glyph_entries = []
-        # MJZ: The 0th offset of the glyph table is 32-bits of
-        # padding, no idea why.
-        self.glyph_table.append(struct.pack('<I', 0))
-        self.number_of_glyphs = 0
-        glyph_indices_lookup = dict()
-        next_offset = 4
+        glyphs = [(WILDCARD_CODEPOINT, 0)]
         codepoint, gindex = self.face.get_first_char()
 
-        # add wildcard_glyph
-        offset, next_offset, glyph_indices_lookup = add_glyph(WILDCARD_CODEPOINT, next_offset, 0,
-                                                              glyph_indices_lookup)
-        glyph_entries.append((WILDCARD_CODEPOINT, offset))
-
         while gindex:
             # Hard limit on the number of glyphs in a font
-            if (self.number_of_glyphs > self.max_glyphs):
+            if (len(glyphs) > self.max_glyphs):
                 break
 
             if (codepoint is WILDCARD_CODEPOINT):
@@ -447,28 +507,79 @@ class Font:
                                 format(self.name))
 
             if (codepoint_is_in_subset(codepoint)):
-                offset, next_offset, glyph_indices_lookup = add_glyph(codepoint, next_offset,
-                                                                      gindex, glyph_indices_lookup)
-                glyph_entries.append((codepoint, offset))
+                glyphs.append((codepoint, gindex))
 
             codepoint, gindex = self.face.get_next_char(codepoint, gindex)
 
+        return glyphs
+
+    def _build_tables(self, progress=None):
+        self.codepoint_bytes = 2
+        self.offset_size_bytes = 4
+        self.features &= ~FEATURE_OFFSET_16
+
+        glyphs = self.collect_glyphs()
+
+        # MJZ: The 0th offset of the glyph table is 32-bits of
+        # padding, no idea why.
+        self.glyph_table = bytearray(4)
+        glyph_entries = []
+        glyph_offsets = {}
+        for batch_start in range(0, len(glyphs), GLYPH_BATCH_SIZE):
+            for codepoint, gindex in glyphs[batch_start:batch_start + GLYPH_BATCH_SIZE]:
+                # Glyphs shared between codepoints are only stored once
+                offset = glyph_offsets.get(gindex)
+                if offset is None:
+                    offset = len(self.glyph_table)
+                    glyph_offsets[gindex] = offset
+                    self.glyph_table += self.glyph_bits(codepoint, gindex)
+
+                if (codepoint > MAX_2_BYTES_CODEPOINT):
+                    self.codepoint_bytes = 4
+
+                glyph_entries.append((codepoint, offset))
+
+            self.number_of_glyphs = len(glyph_entries)
+            if progress is not None:
+                progress(self.number_of_glyphs, len(glyphs))
+
         # Decide if we need 2 byte or 4 byte offsets
-        glyph_data_bytes = sum(len(glyph) for glyph in self.glyph_table)
-        if self.version == FONT_VERSION_3 and glyph_data_bytes < 65536:
+        if self.version == FONT_VERSION_3 and len(self.glyph_table) < 65536:
             self.features |= FEATURE_OFFSET_16
             self.offset_size_bytes = 2
 
-        # Make sure the entries are sorted by codepoint
-        sorted_entries = sorted(glyph_entries, key=lambda entry: entry[0])
-        hash_bucket_sizes = build_offset_tables(sorted_entries)
-        build_hash_table(hash_bucket_sizes)
+        # Size the hash table for the glyphs we ended up with
+        codepoints = [codepoint for codepoint, offset in glyph_entries]
+        self.table_size = choose_hash_table_size(codepoints)
+        bucket_sizes = collections.Counter(hasher(cp, self.table_size) for cp in codepoints)
+        if max(bucket_sizes.values()) > OFFSET_TABLE_MAX_SIZE:
+            raise Exception("Too many glyphs ({}): a hash bucket would hold more than {}. Font {}".
+                            format(len(codepoints), OFFSET_TABLE_MAX_SIZE, self.name))
+
+        # The offset tables are laid out bucket by bucket, sorted by codepoint within a bucket
+        offset_entry = struct.Struct('<' + ('L' if self.codepoint_bytes == 4 else 'H') +
+                                     ('L' if self.offset_size_bytes == 4 else 'H'))
+        glyph_entries.sort(key=lambda entry: (hasher(entry[0], self.table_size), entry[0]))
+        self.offset_tables = bytearray(len(glyph_entries) * offset_entry.size)
+        for i, (codepoint, offset) in enumerate(glyph_entries):
+            offset_entry.pack_into(self.offset_tables, i * offset_entry.size, codepoint, offset)
+
+        self.hash_table = bytearray(HASH_TABLE_ENTRY.size * self.table_size)
+        offset_table_offset = 0
+        for i in range(self.table_size):
+            if offset_table_offset > MAX_OFFSET_TABLE_OFFSET:
+                raise Exception("Too many glyphs ({}): offset tables don't fit in {} bytes. "
+                                "Font {}".format(len(glyph_entries), MAX_OFFSET_TABLE_OFFSET + 1,
+                                                 self.name))
+            HASH_TABLE_ENTRY.pack_into(self.hash_table, i * HASH_TABLE_ENTRY.size,
+                                       i, bucket_sizes[i], offset_table_offset)
+            offset_table_offset += bucket_sizes[i] * offset_entry.size
+
+    def bitstring_parts(self):
+        return (self.fontinfo_bits(), self.hash_table, self.offset_tables, self.glyph_table)
+
+    def bitstring_size(self):
+        return sum(len(part) for part in self.bitstring_parts())
 
     def bitstring(self):
-        btstr = self.fontinfo_bits()
-        btstr += b''.join(self.hash_table)
-        for table in self.offset_tables:
-            btstr += b''.join(table)
-        btstr += b''.join(self.glyph_table)
-
-        return btstr
+        return b''.join(self.bitstring_parts())
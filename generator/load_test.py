@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import urllib.request
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import png
+
+from create_watchface import create_watchface
+from rusage import cpu_seconds, peak_rss_bytes
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples', 'resources')
+TEMPLATE_PBW = 'template-watchface.pbw'
+SEED_SAMPLES = ('googly-eyes', 'hollow-knight', 'horizontal-stripes', 'vertical-stripes')
+PLATFORMS = ('aplite', 'basalt', 'chalk', 'diorite')
+MODES = ('thread', 'process', 'service')
+# Every pebble colour has 2 bits per channel
+PEBBLE_CHANNEL_VALUES = (0x00, 0x55, 0xAA, 0xFF)
+MAX_IMAGE_SIZE = 200
+MAX_IMAGE_COLOURS = 64
+FONT_SIZES = {'digital': (20, 60), 'date': (14, 36), 'text': (12, 28)}
+BLOCK_SIZE = 8
+PERCENTILES = (50, 90, 99)
+
+# Per-process state of the process mode workers, set up once by _init_worker
+_worker = {}
+
+
+def load_seeds():
+    seeds = []
+    for name in SEED_SAMPLES:
+        with open(os.path.join(SAMPLES_DIR, name, 'watchface_info.json'), 'r') as f:
+            seeds.append(json.load(f))
+    return seeds
+
+
+def random_colour(rng):
+    return tuple(rng.choice(PEBBLE_CHANNEL_VALUES) for channel in range(3))
+
+
+def random_hex_colour(rng):
+    return '#' + ''.join(f'{channel:02X}' for channel in random_colour(rng))
+
+
+def synthesize_png(rng, width, height, colours):
+    """
+    base64 of a width x height palette png of random BLOCK_SIZE blocks in up to colours colours
+    """
+
+    palette = list({random_colour(rng) for i in range(colours)})
+    blocks = [[rng.randrange(len(palette)) for x in range(0, width, BLOCK_SIZE)]
+              for y in range(0, height, BLOCK_SIZE)]
+    rows = [[blocks[y // BLOCK_SIZE][x // BLOCK_SIZE] for x in range(width)] for y in range(height)]
+    out = BytesIO()
+    png.Writer(width, height, palette=palette, bitdepth=8).write(out, rows)
+    return b64encode(out.getvalue()).decode('ascii')
+
+
+def synthesize_watchface_info(rng, seeds, index):
+    """
+    A random but valid watchface_info: fonts and positions come from a seed sample, the
+    background is generated with a random size and colour count, and the font sizes, enabled
+    elements and target platforms are picked at random
+    """
+
+    seed = rng.choice(seeds)
+    font_donor = rng.choice(seeds)['customization']
+    customization = json.loads(json.dumps(seed['customization']))
+
+    width = rng.randint(BLOCK_SIZE, MAX_IMAGE_SIZE)
+    height = rng.randint(BLOCK_SIZE, MAX_IMAGE_SIZE)
+    background = customization['background']
+    background['image_data'] = synthesize_png(rng, width, height,
+                                              rng.randint(2, MAX_IMAGE_COLOURS))
+    background['bw_image_data'] = synthesize_png(rng, width, height, 2)
+    background['width'] = width
+    background['height'] = height
+    background['colour'] = random_hex_colour(rng)
+
+    fonts = {'digital': customization['clocks']['digital'],
+             'date': customization['date'],
+             'text': customization['text']}
+    donor_fonts = {'digital': font_donor['clocks']['digital'],
+                   'date': font_donor['date'],
+                   'text': font_donor['text']}
+    for name, element in fonts.items():
+        element['font_data'] = donor_fonts[name]['font_data']
+        element['font_size'] = rng.randint(*FONT_SIZES[name])
+        element['enabled'] = rng.random() < 0.8
+        element['colour'] = random_hex_colour(rng)
+    customization['clocks']['analogue']['enabled'] = rng.random() < 0.5
+    customization['text']['text'] = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ')
+                                            for i in range(rng.randint(0, 30)))
+
+    platforms = [platform for platform in PLATFORMS if rng.random() < 0.6]
+    return {
+        'metadata': {
+            'target_platforms': platforms or [rng.choice(PLATFORMS)],
+            'name': f'Load Test {index}',
+            'author': 'Watchface Generator',
+        },
+        'customization': customization,
+    }
+
+
+def _init_worker(template_pbw):
+    _worker['template_pbw'] = template_pbw
+
+
+def _build_in_worker(info_json):
+    create_watchface(info_json, BytesIO(_worker['template_pbw']))
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_load(documents, mode='thread', concurrency=1, url=None):
+    """
+    Builds every document (watchface_info json strings) with concurrency builds in flight at
+    once, returns a report of throughput, latency percentiles, CPU time and peak RSS. mode is
+    'thread' (create_watchface on threads in this process), 'process' (a pool of worker
+    processes) or 'service' (POSTs to a build_server.py at url).
+    """
+
+    with open(os.path.join(SAMPLES_DIR, TEMPLATE_PBW), 'rb') as f:
+        template_pbw = f.read()
+
+    if mode == 'thread':
+        _init_worker(template_pbw)
+        executor = ThreadPoolExecutor(concurrency)
+        build = _build_in_worker
+    elif mode == 'process':
+        executor = ProcessPoolExecutor(concurrency, initializer=_init_worker,
+                                       initargs=(template_pbw,))
+        # Start every worker before the clock starts
+        list(executor.map(time.sleep, [0.1] * concurrency))
+        build = _build_in_worker
+    elif mode == 'service':
+        executor = ThreadPoolExecutor(concurrency)
+        build = lambda info_json: _build_on_service(url, info_json)
+    else:
+        raise ValueError(f"Unknown mode {mode}")
+
+    latencies = []
+    errors = []
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    with executor:
+        futures = {}
+        for info_json in documents:
+            futures[executor.submit(_timed, build, info_json)] = info_json
+        for future in as_completed(futures):
+            latency, error = future.result()
+            latencies.append(latency)
+            if error is not None:
+                errors.append(error)
+    seconds = time.perf_counter() - start
+
+    cpu_end = cpu_seconds()
+    report = {
+        'mode': mode,
+        'concurrency': concurrency,
+        'builds': len(documents),
+        'errors': len(errors),
+        'seconds': round(seconds, 3),
+        'builds_per_second': round(len(documents) / seconds, 3),
+        'latency_ms': {f'p{p}': round(percentile(latencies, p) * 1000, 2) for p in PERCENTILES},
+        'cpu_seconds': None if cpu_start is None else round(cpu_end - cpu_start, 3),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+    report['latency_ms']['mean'] = round(statistics.mean(latencies) * 1000, 2)
+    report['latency_ms']['max'] = round(max(latencies) * 1000, 2)
+    if mode == 'process' and cpu_start is not None:
+        # The workers have exited by now, so their usage is in the children's
+        report['worker_cpu_seconds'] = round(cpu_seconds(children=True), 3)
+        report['worker_peak_rss_bytes'] = peak_rss_bytes(children=True)
+    if errors:
+        report['first_error'] = errors[0]
+    return report
+
+
+def _timed(build, info_json):
+    # Runs where the build runs (a thread, worker process or service client), so the latency is
+    # that of one build while concurrency builds are in flight, without waiting for a free slot
+    start = time.perf_counter()
+    try:
+        build(info_json)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return time.perf_counter() - start, error
+
+
+def _build_on_service(url, info_json):
+    request = urllib.request.Request(url.rstrip('/') + '/build', data=info_json.encode('utf-8'),
+                                     method='POST')
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='measure build throughput and latency under load')
+
+    parser.add_argument('--mode', choices=MODES, default='process',
+                        help='build on threads, worker processes or a running build_server.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='build service for --mode service')
+    parser.add_argument('--builds', type=int, default=20, help='number of watchfaces to build')
+    parser.add_argument('--concurrency', type=int, default=os.cpu_count() or 1,
+                        help='builds in flight at once')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic watchfaces')
+    parser.add_argument('--save-documents', help='also write the synthetic watchface_infos as JSONL')
+    parser.add_argument('--output', help='write the report json here')
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    seeds = load_seeds()
+    documents = [json.dumps(synthesize_watchface_info(rng, seeds, i)) for i in range(args.builds)]
+    if args.save_documents:
+        with open(args.save_documents, 'w') as f:
+            f.writelines(document + '\n' for document in documents)
+
+    report = run_load(documents, args.mode, args.concurrency, args.url)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    sys.exit(1 if report['errors'] else 0)
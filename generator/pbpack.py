@@ -14,7 +14,6 @@
 # limitations under the License.
 
 
-import argparse
 import stm32_crc
 import struct
 import time
@@ -68,8 +67,8 @@ class ResourcePack(object):
     MANIFEST_SIZE_BYTES = 12
 
     def get_content_crc(self):
-        all_contents = self.serialize_content()
-        return stm32_crc.crc32(all_contents)
+        # Same as the CRC of serialize_content(), without joining all of the content
+        return stm32_crc.crc32_parts(self.iter_content())
 
     def serialize_manifest(self, crc=None, timestamp=None):
         fmt = self.MANIFEST_FMT
@@ -89,22 +88,26 @@ class ResourcePack(object):
 
         return table_data
 
-    def serialize_content(self):
+    def iter_content(self):
         """
-        Serialize the content in the order dictated by offsets in the table entries
+        Yield each unique piece of content in the order dictated by offsets in the table entries
         """
 
         serialized_content_indexes = set()
-        serialized_content = []
         for entry in sorted(self.table_entries, key=lambda e: e.offset):
             if entry.content_index in serialized_content_indexes:
                 continue
 
             serialized_content_indexes.add(entry.content_index)
 
-            serialized_content.append(self.contents[entry.content_index])
+            yield self.contents[entry.content_index]
+
+    def serialize_content(self):
+        """
+        Serialize the content in the order dictated by offsets in the table entries
+        """
 
-        return b"".join(serialized_content)
+        return b"".join(self.iter_content())
 
     @classmethod
     def deserialize(cls, f_in, is_system=True):
@@ -214,7 +217,9 @@ class ResourcePack(object):
 
         f_out.write(self.serialize_manifest(self.crc))
         f_out.write(self.serialize_table())
-        f_out.write(self.serialize_content())
+        # Write the content piece by piece rather than joining it, large fonts can be megabytes
+        for content in self.iter_content():
+            f_out.write(content)
 
         return self.crc
 
@@ -223,12 +228,11 @@ class ResourcePack(object):
             raise Exception("Cannot add additional resource, " +
                             "resource pack has already been finalized")
 
-        # If resource already is present, add to table only
-        try:
-            # Try to find the index for this content if it already exists. If it doesn't we'll
-            # throw the ValueError.
+        # If resource already is present, add to table only. Check before calling index(), the
+        # ValueError it raises otherwise holds a repr of the whole content.
+        if content in self.contents:
             content_index = self.contents.index(content)
-        except ValueError:
+        else:
             # This content is completely new, add it to the contents list.
             self.contents.append(content)
             content_index = len(self.contents) - 1
@@ -276,6 +280,8 @@ class ResourcePack(object):
 
 
 if __name__ == '__main__':
+    import argparse
+
     parser = argparse.ArgumentParser(description='dump pbpack metadata')
 
     parser.add_argument('pbpack_path', help='path to pbpack to dump')
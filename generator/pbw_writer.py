@@ -0,0 +1,139 @@
+import os
+import stat
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Zip records, see APPNOTE.TXT 4.3.7, 4.3.12 and 4.3.16
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP_CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+ZIP_END_RECORD = struct.Struct('<4sHHHHIIH')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+ZIP_END_RECORD_SIGNATURE = b'PK\x05\x06'
+ZIP_VERSION = 20
+# Version made by: the high byte is the host system, 3 (Unix) so readers honour the mode in
+# ZIP_EXTERNAL_ATTR
+ZIP_VERSION_MADE_BY = 3 << 8 | ZIP_VERSION
+ZIP_UTF8_FLAG = 0x800
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+# A regular file, -rw-r--r--
+ZIP_EXTERNAL_ATTR = (stat.S_IFREG | 0o644) << 16
+# Threads compressing entries, shared by every write_pbw in the process
+COMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+
+COMPRESSION_TYPES = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
+
+
+_compress_executor = None
+_compress_executor_lock = threading.Lock()
+
+
+def _shared_compress_executor():
+    global _compress_executor
+    with _compress_executor_lock:
+        if _compress_executor is None:
+            _compress_executor = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS,
+                                                    thread_name_prefix='pbw-compress')
+        return _compress_executor
+
+
+def _forget_compress_executor():
+    # A forked child has the executor but none of its threads, it needs a new one
+    global _compress_executor, _compress_executor_lock
+    _compress_executor = None
+    _compress_executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_compress_executor)
+
+
+def _compress(data, compression, compresslevel):
+    """
+    Returns (crc, compressed data) for one entry. zlib releases the GIL, so this runs in
+    parallel across threads.
+    """
+
+    crc = zlib.crc32(data)
+    if compression == zipfile.ZIP_STORED:
+        return crc, data
+    if compresslevel is None:
+        compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return crc, compressor.compress(data) + compressor.flush()
+
+
+def write_pbw(f_out, entries, comment=b'', compression=zipfile.ZIP_DEFLATED, compresslevel=None,
+              date_time=None, executor=None):
+    """
+    Write a zip archive of entries, a list of (path, bytes-like data), to the binary stream f_out.
+    f_out only needs write(), so it can be a file, a socket file or a response body. Entries are
+    compressed in parallel on executor (by default a thread pool shared by all builds in the
+    process) and written in order as soon as they're ready.
+
+    Returns the number of bytes written.
+    """
+
+    if len(entries) > ZIP_MAX_ENTRIES:
+        raise ValueError("Too many files for a pbw: {}".format(len(entries)))
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+    dos_date, dos_time = _dos_date_time(date_time)
+
+    if executor is None:
+        executor = _shared_compress_executor()
+
+    offset = 0
+    central_directory = []
+    futures = [executor.submit(_compress, data, compression, compresslevel)
+               for path, data in entries]
+    try:
+        for (path, data), future in zip(entries, futures):
+            crc, compressed = future.result()
+            name = path.encode('utf-8')
+            size = memoryview(data).nbytes
+            compressed_size = memoryview(compressed).nbytes
+            if max(size, compressed_size, offset) > ZIP_MAX_SIZE:
+                raise ValueError("{} is too large for a pbw".format(path))
+            flags = 0 if name.isascii() else ZIP_UTF8_FLAG
+
+            f_out.write(ZIP_LOCAL_HEADER.pack(
+                ZIP_LOCAL_HEADER_SIGNATURE, ZIP_VERSION, flags, compression, dos_time, dos_date,
+                crc, compressed_size, size, len(name), 0))
+            f_out.write(name)
+            f_out.write(compressed)
+
+            central_directory.append(ZIP_CENTRAL_HEADER.pack(
+                ZIP_CENTRAL_HEADER_SIGNATURE, ZIP_VERSION_MADE_BY, ZIP_VERSION, flags,
+                compression, dos_time, dos_date, crc, compressed_size, size, len(name), 0, 0, 0,
+                0, ZIP_EXTERNAL_ATTR, offset) + name)
+            offset += ZIP_LOCAL_HEADER.size + len(name) + compressed_size
+    finally:
+        # If writing failed (e.g. the client went away), don't leave the rest on the shared pool
+        for future in futures:
+            future.cancel()
+
+    central_directory = b''.join(central_directory)
+    if offset > ZIP_MAX_SIZE:
+        raise ValueError("pbw is too large")
+    f_out.write(central_directory)
+    f_out.write(ZIP_END_RECORD.pack(
+        ZIP_END_RECORD_SIGNATURE, 0, 0, len(entries), len(entries), len(central_directory),
+        offset, len(comment)))
+    f_out.write(comment)
+
+    return offset + len(central_directory) + ZIP_END_RECORD.size + len(comment)
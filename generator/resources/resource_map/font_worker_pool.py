@@ -0,0 +1,138 @@
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from threading import Lock
+
+from build_metrics import REGISTRY
+from resources.resource_map.resource_generator_font import build_font_bitstring, \
+    font_params_from_definition
+
+# How many TTF files each worker keeps around so repeat builds can be sent by digest only.
+WORKER_FONT_CACHE_SIZE = 16
+
+
+class FontDataMissing(Exception):
+    """
+    Raised by a worker that was sent a digest for a font it hasn't seen yet.
+    """
+    pass
+
+
+# Per-process state, only populated inside the worker processes.
+_worker_fonts = OrderedDict()
+
+
+def _init_worker():
+    # A forked worker starts with a copy of the parent's metrics, only send back its own
+    REGISTRY.drain()
+
+
+def _worker_build_font(digest, data, params):
+    if data is None:
+        data = _worker_fonts.get(digest)
+        if data is None:
+            raise FontDataMissing(digest)
+        _worker_fonts.move_to_end(digest)
+    else:
+        _worker_fonts[digest] = data
+        while len(_worker_fonts) > WORKER_FONT_CACHE_SIZE:
+            _worker_fonts.popitem(last=False)
+
+    # Each worker is single threaded and owns its freetype instance, so no lock is needed here.
+    # The metrics recorded while building (e.g. face pool hits) go back with the font.
+    return build_font_bitstring(BytesIO(data), params), REGISTRY.drain()
+
+
+def _font_bytes(data):
+    if hasattr(data, 'getvalue'):
+        return data.getvalue()
+    if hasattr(data, 'read'):
+        return data.read()
+    return bytes(data)
+
+
+class FontWorkerPool(object):
+    """
+    A pool of long-lived font worker processes, each with its own FreeType instance. Hand it to
+    FontResourceGenerator.set_worker_pool() to let concurrent builds compile fonts in parallel.
+
+    Each font is always built by the same worker, picked by its digest, so the TTF data only has
+    to be sent to that worker once.
+    """
+
+    def __init__(self, max_workers=None, mp_context=None):
+        if mp_context is None:
+            # Don't fork: a fork from a threaded server could copy freetype mid-build.
+            mp_context = multiprocessing.get_context('spawn')
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        # One single process executor per worker, so a build can be sent to a particular worker
+        self.executors = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context,
+                                              initializer=_init_worker)
+                          for _ in range(max_workers)]
+        self.lock = Lock()
+        # Per worker, the digests it was sent most recently first, mirroring its font cache. Only
+        # these are sent by digest alone.
+        self.sent_digests = [OrderedDict() for _ in self.executors]
+        self.digest_hits = 0
+        self.data_sends = 0
+        self.retries = 0
+
+    def build_font_data(self, data, definition):
+        data = _font_bytes(data)
+        params = font_params_from_definition(definition)
+        digest = hashlib.sha256(data).hexdigest()
+        worker = int(digest[:8], 16) % len(self.executors)
+        executor = self.executors[worker]
+        sent_digests = self.sent_digests[worker]
+
+        with self.lock:
+            send_digest_only = digest in sent_digests
+
+        if send_digest_only:
+            try:
+                font_data, metrics = executor.submit(_worker_build_font, digest, None,
+                                                     params).result()
+                REGISTRY.merge(metrics)
+                with self.lock:
+                    sent_digests.move_to_end(digest)
+                    self.digest_hits += 1
+                return font_data
+            except FontDataMissing:
+                # The worker dropped the font (builds finished in a different order than they
+                # were sent, or the worker was replaced), fall back to sending the data.
+                with self.lock:
+                    self.retries += 1
+
+        font_data, metrics = executor.submit(_worker_build_font, digest, data, params).result()
+        REGISTRY.merge(metrics)
+        with self.lock:
+            sent_digests[digest] = True
+            sent_digests.move_to_end(digest)
+            while len(sent_digests) > WORKER_FONT_CACHE_SIZE:
+                sent_digests.popitem(last=False)
+            self.data_sends += 1
+        return font_data
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': len(self.executors),
+                'digest_hits': self.digest_hits,
+                'data_sends': self.data_sends,
+                'retries': self.retries,
+            }
+
+    def shutdown(self, wait=True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib
 import os
+import time
 
+from build_metrics import RESOURCES, RESOURCE_SECONDS
 from resources.find_resource_filename import find_most_specific_filename
 from resources.types.resource_definition import ResourceDefinition, StorageType
 
@@ -21,6 +24,54 @@ from resources.types.resource_definition import ResourceDefinition, StorageType
 # metaclass with a 'type' attribute set.
 _ResourceGenerators = {}
 
+# The module that registers the generator of each type, imported the first time it's needed.
+# The font generator pulls in freetype and the png one pypng, so builds only pay for those once
+# they actually generate a font or a png.
+_ResourceGeneratorModules = {
+    'png': 'resources.resource_map.resource_generator_png',
+    'font': 'resources.resource_map.resource_generator_font',
+    'raw': 'resources.resource_map.resource_generator_raw',
+}
+
+
+def get_resource_generator(resource_type):
+    """
+    The generator class registered for resource_type, importing its module if need be
+    """
+
+    if resource_type not in _ResourceGenerators:
+        if resource_type not in _ResourceGeneratorModules:
+            raise ValueError(f"Unknown resource type {resource_type}")
+        importlib.import_module(_ResourceGeneratorModules[resource_type])
+    return _ResourceGenerators[resource_type]
+
+
+def preload_resource_generators():
+    """
+    Imports every generator now, for long-lived processes that would rather not pay for the
+    imports during their first build
+    """
+
+    for resource_type in _ResourceGeneratorModules:
+        get_resource_generator(resource_type)
+
+
+class LazyResourceGenerator(object):
+    """
+    Stands in for the generator class of resource_type. type is known up front, so resources can
+    be fingerprinted and reused from an earlier build without the generator ever being imported;
+    anything else is looked up on the class, importing it on first use.
+    """
+
+    def __init__(self, resource_type):
+        self.type = resource_type
+
+    def __getattr__(self, name):
+        return getattr(get_resource_generator(self.type), name)
+
+    def __repr__(self):
+        return f'LazyResourceGenerator({self.type!r})'
+
 
 class ResourceGeneratorMetaclass(type):
     type = None
@@ -31,6 +82,22 @@ class ResourceGeneratorMetaclass(type):
         if cls.type:
             _ResourceGenerators[cls.type] = cls
 
+        # Every generate_object implementation is measured, whatever the generator
+        if 'generate_object' in dict:
+            cls.generate_object = classmethod(_measured(dict['generate_object']))
+
+
+def _measured(generate_object):
+    # generate_object is the staticmethod or classmethod as found in the class body
+    def measured_generate_object(cls, platform, definition):
+        start = time.perf_counter()
+        resource = generate_object.__get__(None, cls)(platform, definition)
+        RESOURCE_SECONDS.observe(time.perf_counter() - start, type=cls.type)
+        RESOURCES.inc(type=cls.type)
+        cls.count_object(resource)
+        return resource
+    return measured_generate_object
+
 # Instatiate the metaclass into a baseclass we can use elsewhere.
 ResourceGeneratorBase = ResourceGeneratorMetaclass('ResourceGenerator', (object,), {})
 
@@ -74,3 +141,21 @@ class ResourceGenerator(ResourceGeneratorBase):
         Stub implementation of generate_object. Subclasses must override this method.
         """
         raise NotImplemented('%r missing a generate_object implementation' % cls)
+
+    @classmethod
+    def platform_inputs(cls, platform):
+        """
+        What generate_object's output depends on about platform, as a JSON-able value. Resources
+        whose definition, data and platform inputs match are built once and shared between
+        platforms (see build_graph). Defaults to the platform itself, generators that only read
+        some of its properties can return just those.
+        """
+        return platform
+
+    @classmethod
+    def count_object(cls, resource):
+        """
+        Called with every generated ResourceObject. Subclasses can override this to record
+        type specific metrics (see build_metrics).
+        """
+        pass
@@ -16,13 +16,74 @@ from resources.types.resource_object import ResourceObject
 from resources.resource_map.resource_generator import ResourceGenerator
 
 from font.fontgen import Font, MAX_GLYPHS_EXTENDED, MAX_GLYPHS
+from font.face_pool import face_pool
 
 from pebble_sdk_platform import pebble_platforms, maybe_import_internal
+from rusage import peak_rss_bytes
 
+from build_metrics import FONT_GLYPHS
 from threading import Lock
 
+import logging
 import os
 import re
+import struct
+
+logger = logging.getLogger(__name__)
+
+# The definition attributes that affect the compiled font. These are all plain values, so they
+# can be shipped to a font worker process along with the TTF data.
+FONT_PARAMS = ('name', 'max_glyph_size', 'character_list', 'character_regex', 'compatibility',
+               'compress', 'extended', 'tracking_adjust')
+
+
+def font_params_from_definition(definition):
+    return {param: getattr(definition, param) for param in FONT_PARAMS}
+
+
+def build_font_bitstring(data, params):
+    """
+    Compile TTF data into a pebble font. Callers are responsible for making sure only one
+    thread per process is using freetype at a time.
+    """
+
+    height = FontResourceGenerator._get_font_height_from_name(params['name'])
+    is_legacy = params['compatibility'] == "2.7"
+    max_glyphs = MAX_GLYPHS_EXTENDED if params['extended'] else MAX_GLYPHS
+
+    with face_pool.face(data, height) as face:
+        font = Font(data, height, max_glyphs, params['max_glyph_size'], is_legacy, face=face)
+
+        if params['character_regex'] is not None:
+            font.set_regex_filter(params['character_regex'].encode('utf8'))
+
+        if params['character_list'] is not None:
+            font.set_codepoint_list(params['character_list'])
+
+        if params['compress']:
+            font.set_compression(params['compress'])
+
+        if params['tracking_adjust'] is not None:
+            font.set_tracking_adjust(params['tracking_adjust'])
+
+        progress = None
+        if params['extended']:
+            # Extended (e.g. CJK) fonts can take a while, let people know how it's going
+            progress = _font_progress_reporter(params['name'])
+
+        font.build_tables(progress)
+        return font.bitstring()
+
+
+def _font_progress_reporter(name):
+    def report(glyphs_done, glyphs_total):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        peak_rss = peak_rss_bytes()
+        peak_rss_str = "unknown" if peak_rss is None else "{:.1f} MiB".format(peak_rss / 2**20)
+        logger.info("Font %s: rendered %d/%d glyphs, peak RSS %s", name, glyphs_done,
+                    glyphs_total, peak_rss_str)
+    return report
 
 
 class FontResourceGenerator(ResourceGenerator):
@@ -32,6 +93,9 @@ class FontResourceGenerator(ResourceGenerator):
 
     type = 'font'
     lock = Lock()
+    # Optional FontWorkerPool. When set, fonts are built in worker processes, each with its own
+    # FreeType instance, so concurrent builds don't queue behind the lock.
+    worker_pool = None
 
     @staticmethod
     def definitions_from_dict(platform, definition_dict):
@@ -68,32 +132,33 @@ class FontResourceGenerator(ResourceGenerator):
 
         return ResourceObject(definition, font_data)
 
+    @classmethod
+    def platform_inputs(cls, platform):
+        # definitions_from_dict only takes the glyph size limit from the platform
+        return {'max_glyph_size': pebble_platforms[platform]['MAX_FONT_GLYPH_SIZE']}
+
+    @classmethod
+    def count_object(cls, resource):
+        # The glyph count is in the font info header: version, max height, number of glyphs
+        FONT_GLYPHS.inc(struct.unpack_from('<BBH', resource.data)[2])
+
     @classmethod
     def build_font_data(cls, data, definition):
+        if cls.worker_pool is not None:
+            return cls.worker_pool.build_font_data(data, definition)
+
         # PBL-23964: it turns out that font generation is not thread-safe with freetype
         # 2.4 (and possibly later versions). To avoid running into this, we use a lock.
         with cls.lock:
-            height = FontResourceGenerator._get_font_height_from_name(definition.name)
-            is_legacy = definition.compatibility == "2.7"
-            max_glyphs = MAX_GLYPHS_EXTENDED if definition.extended else MAX_GLYPHS
-
-            font = Font(data, height, max_glyphs, definition.max_glyph_size, is_legacy)
-
-            if definition.character_regex is not None:
-                font.set_regex_filter(definition.character_regex.encode('utf8'))
-
-            if definition.character_list is not None:
-                font.set_codepoint_list(definition.character_list)
-
-            if definition.compress:
-                font.set_compression(definition.compress)
-
-            if definition.tracking_adjust is not None:
-                font.set_tracking_adjust(definition.tracking_adjust)
-
-            font.build_tables()
-            return font.bitstring()
+            return build_font_bitstring(data, font_params_from_definition(definition))
 
+    @classmethod
+    def set_worker_pool(cls, worker_pool):
+        """
+        Route font builds through a FontWorkerPool instead of the in-process, lock-guarded path.
+        Pass None to go back to building fonts in-process.
+        """
+        cls.worker_pool = worker_pool
 
     @staticmethod
     def _get_font_height_from_name(name):
@@ -16,8 +16,14 @@ from resources.types.resource_object import ResourceObject
 from resources.resource_map.resource_generator import ResourceGenerator
 
 from pebble_sdk_platform import pebble_platforms
+from build_metrics import IMAGE_PIXELS
 
 import png2pblpng
+import struct
+
+# Width and height in the IHDR chunk, right after the png signature and the chunk's length and type
+PNG_SIZE = struct.Struct('>II')
+PNG_SIZE_OFFSET = 16
 
 class PngResourceGenerator(ResourceGenerator):
     type = 'png'
@@ -29,3 +35,13 @@ class PngResourceGenerator(ResourceGenerator):
         image_bytes = png2pblpng.convert_png_to_pebble_png_bytes(definition.data,
                                                                  palette_name)
         return ResourceObject(definition, image_bytes)
+
+    @classmethod
+    def platform_inputs(cls, platform):
+        # Only the palette depends on the platform
+        return {'color': 'color' in pebble_platforms[platform]['TAGS']}
+
+    @classmethod
+    def count_object(cls, resource):
+        width, height = PNG_SIZE.unpack_from(resource.data, PNG_SIZE_OFFSET)
+        IMAGE_PIXELS.inc(width * height)
@@ -20,4 +20,13 @@ class ResourceGeneratorRaw(ResourceGenerator):
     
     @staticmethod
     def generate_object(platform, definition):
-        return ResourceObject(definition, definition.data.getvalue())
+        data = definition.data
+        if hasattr(data, 'getbuffer'):
+            # Use the stream's buffer directly instead of copying it out with getvalue()
+            data = data.getbuffer()
+        return ResourceObject(definition, data)
+
+    @classmethod
+    def platform_inputs(cls, platform):
+        # The data goes into the pack as is
+        return None
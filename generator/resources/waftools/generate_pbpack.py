@@ -12,8 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pbpack import ResourcePack
-from io import BytesIO
+from build_graph import BuildGraph
+from build_trace import NULL_TRACER
 # from resources.resource_map.my_resource_generator import definitions_from_dict, generate_object
 
 # params:
@@ -21,16 +21,26 @@ from io import BytesIO
 #   resource_data: tuple of (resource dict, resource generator type)
 #   resource_source_path: resource directory
 #   output_file: where to save the pbpack
+#   fingerprints: optional input fingerprint for each resource in resource_data
+#   known_resources: optional dict of fingerprint -> content of resources that were already built
+#       (e.g. by an earlier build). Resources with a matching fingerprint are copied from here
+#       instead of being generated again, newly generated ones are added to it
+#   deadline: optional build_scheduler.Deadline, checked before each resource that is built
+#       (stage named after the generator type, e.g. 'png', 'font') and before packing
+#   tracer: optional build_trace.Tracer, gets a span per resource (named after the generator type)
+#       and one for packing
+#   executor: optional concurrent.futures executor to build the resources on concurrently
 # returns: ResourcePack, byte stream
-def generate_pbpack(platform, resource_data):
-    pack = ResourcePack(False)
+# A single platform BuildGraph, see build_graph for building several platforms at once.
+def generate_pbpack(platform, resource_data, fingerprints=None, known_resources=None,
+                    deadline=None, tracer=NULL_TRACER, executor=None):
+    if fingerprints is None:
+        fingerprints = [None] * len(resource_data)
 
-    for rd, rt in resource_data:
-        d = rt.definitions_from_dict(platform, rd)[0]
-        resource = rt.generate_object(platform, d)
-        pack.add_resource(resource.data)
+    graph = BuildGraph(known_resources, deadline=deadline, tracer=tracer)
+    resources = [graph.add_resource(platform, rd, rt, fingerprint)
+                 for (rd, rt), fingerprint in zip(resource_data, fingerprints)]
+    pack = graph.add_pack(platform, resources)
+    graph.run(executor)
 
-    serialized_stream = BytesIO()
-    pack.serialize(serialized_stream)
-
-    return pack, serialized_stream
\ No newline at end of file
+    return pack.pack, pack.stream
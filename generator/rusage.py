@@ -0,0 +1,38 @@
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def _usage(children):
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+
+def peak_rss_bytes(children=False):
+    """
+    Peak resident set size of this process in bytes, or None if we can't tell. With children,
+    the peak of the largest child process that has been waited for.
+    """
+
+    if resource is None:
+        return None
+
+    max_rss = _usage(children).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def cpu_seconds(children=False):
+    """
+    User plus system CPU time of this process (or of its waited for children), or None if we
+    can't tell.
+    """
+
+    if resource is None:
+        return None
+
+    usage = _usage(children)
+    return usage.ru_utime + usage.ru_stime
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import zlib
+
 CRC_POLY = 0x04C11DB7
 
 def precompute_table(bits):
@@ -28,26 +31,73 @@ def precompute_table(bits):
 
 lookup_table = precompute_table(8)
 
+# The STM32 CRC feeds each word to a MSB-first CRC-32, last byte first. Reversing the bits of the
+# whole word turns that into the reflected CRC-32 zlib implements in C, with the same polynomial.
+bit_reverse_table = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+# An array typecode for 32 bit words
+WORD_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+# Bytes bit-reversed at a time, a multiple of the word size
+CRC_CHUNK_SIZE = 16 * 1024
+
+def reverse_bits32(value):
+    return int('{:032b}'.format(value)[::-1], 2)
+
 def process_word(data, crc=0xffffffff):
     if (len(data) < 4):
         # The CRC data is "padded" in a very unique and confusing fashion.
-        data = data[::-1] + b'\0' * (4 - len(data))
+        data = bytes(data[::-1]) + b'\0' * (4 - len(data))
 
     for b in reversed(data):
         crc = ((crc << 8) ^ lookup_table[(crc >> 24) ^ b]) & 0xffffffff
     return crc
 
 def process_buffer(buf, c=0xffffffff):
-    word_count = (len(buf) + 3) // 4
+    buf = memoryview(buf).cast('B')
+    whole_words = len(buf) - len(buf) % 4
+
+    # Reverse the bits of every byte, then the bytes of every word. This goes a chunk at a time,
+    # so the reversed copies stay small however big buf is.
+    reflected_crc = reverse_bits32(c) ^ 0xffffffff
+    for start in range(0, whole_words, CRC_CHUNK_SIZE):
+        chunk = buf[start:min(start + CRC_CHUNK_SIZE, whole_words)]
+        words = array.array(WORD_TYPECODE, chunk.tobytes().translate(bit_reverse_table))
+        words.byteswap()
+        reflected_crc = zlib.crc32(words, reflected_crc)
+    crc = reverse_bits32(reflected_crc ^ 0xffffffff)
 
-    crc = c
-    for i in range(word_count):
-        crc = process_word(buf[i * 4 : (i + 1) * 4], crc)
+    if whole_words < len(buf):
+        crc = process_word(buf[whole_words:], crc)
     return crc
 
 def crc32(data):
     return process_buffer(data)
 
+def crc32_parts(parts):
+    """
+    crc32 of the concatenation of parts (bytes-like objects), without joining them
+    """
+
+    crc = 0xffffffff
+    # A word split between parts is finished with the start of the next part
+    partial_word = b''
+    for part in parts:
+        part = memoryview(part).cast('B')
+        if partial_word:
+            taken = 4 - len(partial_word)
+            partial_word += part[:taken].tobytes()
+            part = part[taken:]
+            if len(partial_word) < 4:
+                continue
+            crc = process_word(partial_word, crc)
+            partial_word = b''
+        whole_words = len(part) - len(part) % 4
+        crc = process_buffer(part[:whole_words], crc)
+        partial_word = part[whole_words:].tobytes()
+
+    if partial_word:
+        crc = process_word(partial_word, crc)
+    return crc
+
 if __name__ == '__main__':
     import sys
 
@@ -0,0 +1,267 @@
+import binascii
+import io
+import mmap
+import re
+import tempfile
+
+from asset_store import ASSET_KEYS
+
+READ_CHUNK_SIZE = 64 * 1024
+# Decoded assets bigger than this are moved out of memory into a temp file
+DEFAULT_SPOOL_THRESHOLD = 8 * 1024 * 1024
+# Longest number/literal we expect, so we know how much to buffer before matching one
+MAX_SCALAR_LENGTH = 64
+
+STRING_SPECIAL_RE = re.compile(r'["\\]')
+HEX4_RE = re.compile(r'[0-9a-fA-F]{4}')
+NUMBER_RE = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?')
+WHITESPACE = ' \t\r\n'
+STRIP_WHITESPACE = str.maketrans('', '', WHITESPACE)
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+LITERALS = (('true', True), ('false', False), ('null', None))
+
+
+class _Base64Sink(object):
+    """
+    Decodes base64 text fed in pieces. The decoded bytes are kept in memory until they grow past
+    spool_threshold, then they're moved to a temp file.
+    """
+
+    def __init__(self, spool_threshold):
+        self.spool_threshold = spool_threshold
+        self.pending = ''
+        self.buffer = bytearray()
+        self.file = None
+
+    def write(self, text):
+        self.pending += text.translate(STRIP_WHITESPACE)
+        usable = len(self.pending) - len(self.pending) % 4
+        if usable:
+            self._write_bytes(binascii.a2b_base64(self.pending[:usable]))
+            self.pending = self.pending[usable:]
+
+    def _write_bytes(self, data):
+        if self.file is not None:
+            self.file.write(data)
+            return
+
+        self.buffer += data
+        if len(self.buffer) > self.spool_threshold:
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.buffer)
+            self.buffer = None
+
+    def finish(self):
+        if self.pending:
+            # Let binascii complain about bad padding
+            self._write_bytes(binascii.a2b_base64(self.pending))
+
+        if self.file is None:
+            return self.buffer
+
+        self.file.flush()
+        mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file.close()
+        return memoryview(mapped)
+
+
+class _StreamingParser(object):
+    def __init__(self, stream, spool_threshold):
+        self.stream = stream
+        self.spool_threshold = spool_threshold
+        self.buffer = ''
+        self.pos = 0
+        # Characters dropped from the front of the buffer, only used for error messages
+        self.consumed = 0
+
+    def error(self, message):
+        raise ValueError("Invalid watchface_info JSON at offset {}: {}".format(
+            self.consumed + self.pos, message))
+
+    def fill(self):
+        chunk = self.stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def ensure(self, count):
+        while len(self.buffer) - self.pos < count:
+            if not self.fill():
+                return False
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or '' at the end of the input.
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            self.error("expected {!r}".format(char))
+        self.pos += 1
+
+    def parse_document(self):
+        value = self.parse_value()
+        if self.peek() != '':
+            self.error("trailing data")
+        return value
+
+    def parse_value(self, key=None):
+        char = self.peek()
+        if char == '{':
+            return self.parse_object()
+        if char == '[':
+            return self.parse_array()
+        if char == '"':
+            if key in ASSET_KEYS:
+                sink = _Base64Sink(self.spool_threshold)
+                self.parse_string(sink.write)
+                return sink.finish()
+            pieces = []
+            self.parse_string(pieces.append)
+            return ''.join(pieces)
+        if char == '':
+            self.error("unexpected end of input")
+        return self.parse_scalar()
+
+    def parse_object(self):
+        self.expect('{')
+        result = {}
+        if self.peek() == '}':
+            self.pos += 1
+            return result
+
+        while True:
+            if self.peek() != '"':
+                self.error("expected a key")
+            pieces = []
+            self.parse_string(pieces.append)
+            key = ''.join(pieces)
+            self.expect(':')
+            result[key] = self.parse_value(key)
+
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return result
+            if char != ',':
+                self.error("expected ',' or '}'")
+
+    def parse_array(self):
+        self.expect('[')
+        result = []
+        if self.peek() == ']':
+            self.pos += 1
+            return result
+
+        while True:
+            result.append(self.parse_value())
+
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return result
+            if char != ',':
+                self.error("expected ',' or ']'")
+
+    def parse_string(self, write):
+        """
+        Parse a string starting at the opening quote, passing the unescaped contents to write
+        piece by piece.
+        """
+
+        self.pos += 1
+        while True:
+            match = STRING_SPECIAL_RE.search(self.buffer, self.pos)
+            if match is None:
+                write(self.buffer[self.pos:])
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    self.error("unterminated string")
+                continue
+
+            end = match.start()
+            write(self.buffer[self.pos:end])
+            self.pos = end
+            if self.buffer[end] == '"':
+                self.pos += 1
+                return
+
+            if not self.ensure(2):
+                self.error("unterminated string")
+            escape = self.buffer[self.pos + 1]
+            if escape == 'u':
+                code = self.parse_unicode_escape()
+                # Characters outside the BMP are escaped as a UTF-16 surrogate pair. Like json,
+                # keep a high surrogate as it is when no low surrogate follows.
+                if 0xD800 <= code <= 0xDBFF and self.ensure(6) and \
+                        self.buffer.startswith('\\u', self.pos) and \
+                        HEX4_RE.fullmatch(self.buffer, self.pos + 2, self.pos + 6):
+                    low = int(self.buffer[self.pos + 2:self.pos + 6], 16)
+                    if 0xDC00 <= low <= 0xDFFF:
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                        self.pos += 6
+                write(chr(code))
+            elif escape in ESCAPES:
+                write(ESCAPES[escape])
+                self.pos += 2
+            else:
+                self.error("invalid escape")
+
+    def parse_unicode_escape(self):
+        """
+        Parse a \\uXXXX escape at the current position and return its code unit.
+        """
+
+        if not self.ensure(6):
+            self.error("unterminated string")
+        if not HEX4_RE.fullmatch(self.buffer, self.pos + 2, self.pos + 6):
+            self.error("invalid \\u escape")
+        code = int(self.buffer[self.pos + 2:self.pos + 6], 16)
+        self.pos += 6
+        return code
+
+    def parse_scalar(self):
+        self.ensure(MAX_SCALAR_LENGTH)
+        for literal, value in LITERALS:
+            if self.buffer.startswith(literal, self.pos):
+                self.pos += len(literal)
+                return value
+
+        match = NUMBER_RE.match(self.buffer, self.pos)
+        if match is None:
+            self.error("unexpected character {!r}".format(self.buffer[self.pos]))
+        self.pos = match.end()
+        if match.group(1) or match.group(2):
+            return float(match.group(0))
+        return int(match.group(0))
+
+
+def load_watchface_info(stream, spool_threshold=DEFAULT_SPOOL_THRESHOLD):
+    """
+    Parse watchface_info JSON from a text or binary stream without holding the whole document
+    in memory. Asset values (image_data, font_data, ...) are base64 decoded while they're read,
+    so they come back as bytes-like objects rather than base64 strings. Large assets end up in
+    memory-mapped temp files.
+    """
+
+    if not isinstance(stream.read(0), bytes):
+        return _StreamingParser(stream, spool_threshold).parse_document()
+
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        return _StreamingParser(text_stream, spool_threshold).parse_document()
+    finally:
+        # Don't let the wrapper close the caller's stream
+        text_stream.detach()
@@ -59,17 +59,20 @@ BACKGROUND_PNG_DICT = {
 TIME_FONT_DICT = {
     'name': f'FONT_TIME_PLACEHOLDER',
     'type': 'font',
-    'characterRegex': '[0-9:]'
+    'characterRegex': '[0-9:]',
+    'compress': 'auto'
 }
 
 DATE_FONT_DICT = {
     'name': f'FONT_DATE_PLACEHOLDER',
-    'type': 'font'
+    'type': 'font',
+    'compress': 'auto'
 }
 
 TEXT_FONT_DICT = {
     'name': f'FONT_TEXT_PLACEHOLDER',
-    'type': 'font'
+    'type': 'font',
+    'compress': 'auto'
 }
 
 DATA_DICT = {
@@ -0,0 +1,123 @@
+import base64
+import json
+import os
+import re
+import sys
+import tarfile
+import zipfile
+from io import BytesIO
+
+import pytest
+
+# The generator modules import each other as top level modules
+GENERATOR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if GENERATOR_DIR not in sys.path:
+    sys.path.insert(0, GENERATOR_DIR)
+
+SAMPLES_DIR = os.path.join(os.path.dirname(GENERATOR_DIR), 'samples', 'resources')
+TEMPLATE_PBW_PATH = os.path.join(SAMPLES_DIR, 'template-watchface.pbw')
+
+HELP_RE = re.compile(r'# HELP ([a-zA-Z_:][a-zA-Z0-9_:]*) .+')
+TYPE_RE = re.compile(r'# TYPE ([a-zA-Z_:][a-zA-Z0-9_:]*) (counter|histogram)')
+SAMPLE_RE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def load_sample(name):
+    """
+    The parsed watchface_info.json of one of the samples, e.g. 'horizontal-stripes'
+    """
+
+    with open(os.path.join(SAMPLES_DIR, name, 'watchface_info.json')) as f:
+        return json.load(f)
+
+
+def bundle_files(name):
+    """
+    A sample as {path: bytes} for an asset bundle, its assets moved out of watchface_info.json
+    into files
+    """
+
+    info = load_sample(name)
+    customization = info['customization']
+    files = {}
+    for section, path in ((customization['background'], 'background.png'),
+                          (customization['clocks']['digital'], 'fonts/time.ttf'),
+                          (customization['date'], 'fonts/date.ttf'),
+                          (customization['text'], 'fonts/text.ttf')):
+        key = 'image_data' if 'image_data' in section else 'font_data'
+        files[path] = base64.b64decode(section[key])
+        section[key] = {'file': path}
+    files['watchface_info.json'] = json.dumps(info).encode('utf-8')
+    return files
+
+
+def make_bundle(kind, files):
+    """
+    files as a bundle of kind (stored.zip, deflated.zip, plain.tar or compressed.tar.gz)
+    """
+
+    output = BytesIO()
+    if kind.endswith('.zip'):
+        compression = zipfile.ZIP_STORED if kind.startswith('stored') else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(output, 'w', compression) as bundle:
+            for name, data in files.items():
+                bundle.writestr('face/' + name, data)
+    else:
+        with tarfile.open(fileobj=output, mode='w:gz' if kind.endswith('.gz') else 'w') as bundle:
+            for name, data in files.items():
+                member = tarfile.TarInfo('face/' + name)
+                member.size = len(data)
+                bundle.addfile(member, BytesIO(data))
+    return output.getvalue()
+
+
+def parse_exposition(text):
+    """
+    Check text is in the Prometheus text format, returns {(sample name, labels): value} with
+    labels as a tuple of (name, value) pairs
+    """
+
+    assert text.endswith('\n')
+    samples = {}
+    families = {}
+    family = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            family = HELP_RE.fullmatch(line).group(1)
+            assert family not in families
+            continue
+        if line.startswith('# TYPE '):
+            name, kind = TYPE_RE.fullmatch(line).groups()
+            assert name == family
+            families[name] = kind
+            continue
+
+        name, labels, value = SAMPLE_RE.fullmatch(line).groups()
+        suffixes = ('_bucket', '_sum', '_count') if families[family] == 'histogram' else ('',)
+        assert name in [family + suffix for suffix in suffixes]
+        labels = labels or ''
+        assert ''.join(match.group(0) for match in LABEL_RE.finditer(labels)) == labels
+        labels = tuple(match.groups() for match in LABEL_RE.finditer(labels))
+        samples[(name, labels)] = float(value)
+
+    # Histogram buckets are cumulative and end with +Inf, which is the count
+    for name, kind in families.items():
+        if kind != 'histogram':
+            continue
+        series = {labels[:-1] for (sample, labels) in samples if sample == name + '_bucket'}
+        for labels in series:
+            buckets = [(dict(bucket_labels)['le'], value) for (sample, bucket_labels), value
+                       in samples.items() if sample == name + '_bucket' and
+                       bucket_labels[:-1] == labels]
+            assert buckets[-1][0] == '+Inf'
+            counts = [value for le, value in buckets]
+            assert counts == sorted(counts)
+            assert counts[-1] == samples[(name + '_count', labels)]
+    return samples
+
+
+@pytest.fixture
+def template_pbw_stream():
+    with open(TEMPLATE_PBW_PATH, 'rb') as f:
+        return BytesIO(f.read())
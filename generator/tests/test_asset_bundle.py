@@ -0,0 +1,79 @@
+import io
+import json
+
+import pytest
+
+from asset_bundle import AssetBundle
+from conftest import bundle_files, load_sample, make_bundle
+from create_watchface import create_watchface, create_watchface_from_bundle
+
+SAMPLE = 'horizontal-stripes'
+# kind: whether assets come back as memoryviews into the archive
+KINDS = {'stored.zip': True, 'deflated.zip': False, 'plain.tar': True, 'compressed.tar.gz': False}
+
+
+@pytest.mark.parametrize('kind', KINDS)
+@pytest.mark.parametrize('source_type', ['path', 'bytes', 'file'])
+def test_read_assets(kind, source_type, tmp_path):
+    files = bundle_files(SAMPLE)
+    data = make_bundle(kind, files)
+    path = tmp_path / kind
+    path.write_bytes(data)
+    source = {'path': str(path), 'bytes': data}.get(source_type)
+    if source_type == 'file':
+        source = open(path, 'rb')
+
+    with AssetBundle(source) as bundle:
+        assert json.loads(bundle.read_watchface_info()) == json.loads(files['watchface_info.json'])
+        for name, content in files.items():
+            asset = bundle.read(name)
+            assert bytes(asset) == content
+            assert isinstance(asset, memoryview) == KINDS[kind]
+            del asset
+    if source_type == 'file':
+        source.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_bundle_builds_like_inline_assets(kind, template_pbw_stream):
+    bundle = make_bundle(kind, bundle_files(SAMPLE))
+    assert create_watchface_from_bundle(bundle, template_pbw_stream, reproducible=True) == \
+        create_watchface(load_sample(SAMPLE), template_pbw_stream, reproducible=True)
+
+
+@pytest.mark.parametrize('name', ['../watchface_info.json', '/etc/passwd', 'fonts/../../x',
+                                  '..'])
+def test_paths_outside_the_info_directory(name):
+    with AssetBundle(make_bundle('stored.zip', bundle_files(SAMPLE))) as bundle:
+        with pytest.raises(ValueError, match='outside of the directory'):
+            bundle.read(name)
+
+
+def test_missing_asset():
+    with AssetBundle(make_bundle('plain.tar', bundle_files(SAMPLE))) as bundle:
+        with pytest.raises(ValueError, match='not found'):
+            bundle.read('fonts/missing.ttf')
+
+
+def test_empty_bundle(tmp_path):
+    path = tmp_path / 'empty.zip'
+    path.write_bytes(b'')
+    for source in (str(path), b'', io.BytesIO()):
+        with pytest.raises(ValueError, match='Asset bundle is empty'):
+            AssetBundle(source)
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_truncated_bundle(kind, tmp_path):
+    files = bundle_files(SAMPLE)
+    data = make_bundle(kind, files)
+    path = tmp_path / kind
+    # Every cut either fails with a bundle error or, when only padding was cut, reads the same
+    for end in range(1, len(data), 4093):
+        path.write_bytes(data[:end])
+        try:
+            with AssetBundle(str(path)) as bundle:
+                for name, content in files.items():
+                    assert bytes(bundle.read(name)) == content
+        except ValueError as e:
+            assert 'bundle' in str(e)
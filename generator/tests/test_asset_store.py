@@ -0,0 +1,94 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+from asset_store import AssetNotFound, AssetStore
+from conftest import load_sample
+
+
+def store_files(root):
+    return sorted(name for dir_path, dir_names, file_names in os.walk(root)
+                  for name in file_names)
+
+
+def test_put_and_get(tmp_path):
+    store = AssetStore(str(tmp_path))
+    digest = store.put(b'asset')
+
+    assert digest == hashlib.sha256(b'asset').hexdigest()
+    assert digest in store
+    assert store.get(digest) == b'asset'
+    with pytest.raises(AssetNotFound):
+        store.get(hashlib.sha256(b'other').hexdigest())
+    with pytest.raises(ValueError):
+        store.get('../../etc/passwd')
+    assert store.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_duplicates_are_stored_once(tmp_path):
+    store = AssetStore(str(tmp_path))
+    info = load_sample('horizontal-stripes')
+    customization = info['customization']
+
+    ingested = store.ingest_watchface_info(info)
+
+    # The sample's three fonts are the same file
+    fonts = [ingested['customization'][section]['font_data'] for section in ('date', 'text')]
+    fonts.append(ingested['customization']['clocks']['digital']['font_data'])
+    assert fonts[0] == fonts[1] == fonts[2]
+    assert store_files(str(tmp_path)) == sorted({fonts[0]['sha256'],
+                                                 ingested['customization']['background']
+                                                 ['image_data']['sha256']})
+    assert store.get(fonts[0]['sha256']) == base64.b64decode(customization['date']['font_data'])
+    # The input is left as it was
+    assert isinstance(customization['date']['font_data'], str)
+    assert store.ingest_watchface_info(info) == ingested
+
+
+def test_failed_write_leaves_nothing(tmp_path, monkeypatch):
+    store = AssetStore(str(tmp_path))
+
+    def fail(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        store.put(b'asset')
+
+    assert hashlib.sha256(b'asset').hexdigest() not in store
+    assert store_files(str(tmp_path)) == []
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = AssetStore(str(tmp_path), max_bytes=250)
+    digests = [store.put(bytes([i]) * 100) for i in range(2)]
+    os.utime(store._path(digests[0]), (1000, 1000))
+    os.utime(store._path(digests[1]), (900, 900))
+
+    digests.append(store.put(b'\x02' * 100))
+
+    assert [digest in store for digest in digests] == [True, False, True]
+    assert store.stats()['evictions'] == 1
+
+
+def test_ingest_keeps_its_own_assets(tmp_path, monkeypatch):
+    info = load_sample('horizontal-stripes')
+    font_size = len(base64.b64decode(info['customization']['date']['font_data']))
+    # Room for the old asset or the watchface's font, not both
+    store = AssetStore(str(tmp_path), max_bytes=font_size + 10)
+    old = store.put(b'old asset')
+    os.utime(store._path(old), (1000, 1000))
+    walks = []
+    walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda root: walks.append(root) or walk(root))
+
+    ingested = store.ingest_watchface_info(info)
+
+    # Evicted once, after everything was stored
+    assert len(walks) == 1
+    assert old not in store
+    # Over max_bytes, but every asset the watchface references is still there
+    for section in ('background', 'date'):
+        value = ingested['customization'][section]
+        assert value.get('image_data', value.get('font_data'))['sha256'] in store
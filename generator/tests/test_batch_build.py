@@ -0,0 +1,56 @@
+import copy
+import json
+import os
+
+from batch_build import _move_output, run_batch
+from conftest import TEMPLATE_PBW_PATH, load_sample
+from create_watchface import create_watchface, watchface_pbw_name
+
+SAMPLE = 'horizontal-stripes'
+
+
+def write_info(path, watchface_info):
+    with open(path, 'w') as f:
+        json.dump(watchface_info, f)
+    return str(path)
+
+
+def test_same_pbw_name(tmp_path, template_pbw_stream):
+    first = load_sample(SAMPLE)
+    second = copy.deepcopy(first)
+    second['customization']['date']['enabled'] = True
+    broken = copy.deepcopy(first)
+    broken['customization']['background']['image_data'] = 'AAAA'
+    inputs = [write_info(tmp_path / f'{name}.json', info)
+              for name, info in (('first', first), ('second', second), ('broken', broken))]
+    output_dir = tmp_path / 'out'
+
+    report = run_batch(TEMPLATE_PBW_PATH, inputs, str(output_dir), workers=2, reproducible=True)
+
+    pbw_name = watchface_pbw_name(first)
+    assert [job['status'] for job in report['jobs']] == ['ok', 'error', 'error']
+    assert report['jobs'][0]['output'] == str(output_dir / pbw_name)
+    assert report['jobs'][1]['error'].startswith(f'OutputCollision: {inputs[0]}')
+    # The failing job leaves the pbw it shares a name with alone
+    assert os.listdir(output_dir) == [pbw_name]
+    pbw, _ = create_watchface(first, template_pbw_stream, reproducible=True)
+    assert (output_dir / pbw_name).read_bytes() == pbw
+
+
+def test_first_input_wins_whatever_finishes_first(tmp_path):
+    output = str(tmp_path / 'face.pbw')
+    results = []
+    for index in (1, 0, 2):
+        temp_path = tmp_path / f'.face.pbw.{index}.tmp'
+        temp_path.write_bytes(b'job %d' % index)
+        results.append({'index': index, 'source': f'job-{index}', 'status': 'ok',
+                        'temp_output': str(temp_path), 'output': output, 'size': 5})
+    outputs = {}
+
+    assert _move_output(results[0], outputs) is None
+    assert _move_output(results[1], outputs) is results[0]
+    assert _move_output(results[2], outputs) is None
+
+    assert [result['status'] for result in results] == ['error', 'ok', 'error']
+    assert os.listdir(tmp_path) == ['face.pbw']
+    assert (tmp_path / 'face.pbw').read_bytes() == b'job 0'
@@ -0,0 +1,25 @@
+import json
+
+from benchmark import (BASELINE_PATH, compare_results, import_benchmarks, macro_benchmarks,
+                       micro_benchmarks)
+from font.face_pool import face_pool
+
+
+def test_baseline_covers_every_benchmark():
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    names = [name for benchmarks in (import_benchmarks(), micro_benchmarks(), macro_benchmarks())
+             for name, fn in benchmarks]
+
+    assert sorted(baseline['benchmarks']) == sorted(names)
+    rows, regressions = compare_results(baseline, baseline)
+    assert len(rows) == len(names)
+    assert regressions == []
+
+
+def test_font_benchmark_loads_the_face_every_run():
+    build_font = dict(micro_benchmarks())['micro/font/14']
+    build_font()
+    misses = face_pool.stats()['misses']
+    build_font()
+    assert face_pool.stats()['misses'] == misses + 1
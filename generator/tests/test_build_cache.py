@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+from build_cache import BuildCache
+from conftest import load_sample
+from create_watchface import create_watchface
+
+
+def key(name):
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+
+def test_memory_hits_and_misses():
+    cache = BuildCache()
+    assert cache.get(key('a')) is None
+    cache.put(key('a'), memoryview(b'pbw a'), 'a.pbw')
+
+    assert cache.get(key('a')) == (b'pbw a', 'a.pbw')
+    assert cache.stats()['memory_hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_memory_evicts_least_recently_used():
+    cache = BuildCache(max_bytes=10)
+    cache.put(key('a'), b'aaaa', 'a.pbw')
+    cache.put(key('b'), b'bbbb', 'b.pbw')
+    cache.get(key('a'))
+    cache.put(key('c'), b'cccc', 'c.pbw')
+
+    assert cache.get(key('b')) is None
+    assert cache.get(key('a')) is not None
+    assert cache.get(key('c')) is not None
+    # Too big to keep at all
+    cache.put(key('d'), b'd' * 11, 'd.pbw')
+    assert cache.get(key('d')) is None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 8
+
+
+def test_disk_hit_after_restart(tmp_path):
+    BuildCache(directory=str(tmp_path)).put(key('a'), b'pbw a', 'a.pbw')
+
+    cache = BuildCache(directory=str(tmp_path))
+    assert cache.get(key('a')) == (b'pbw a', 'a.pbw')
+    assert cache.get(key('a')) == (b'pbw a', 'a.pbw')
+    assert cache.stats()['disk_hits'] == 1
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_disk_evicts_oldest_mtime_first(tmp_path, monkeypatch):
+    cache = BuildCache(directory=str(tmp_path))
+    for age, name in enumerate('abc'):
+        cache.put(key(name), b'x' * 100, f'{name}.pbw')
+        # a is the oldest
+        os.utime(cache._path(key(name)), (1000 - age * 100, 1000 - age * 100))
+    os.utime(cache._path(key('b')), (500, 500))
+
+    # Sizes are taken from the one scan on opening, not from walking the directory on every put
+    cache = BuildCache(max_bytes=0, directory=str(tmp_path), max_disk_bytes=3 * 106)
+    assert cache.stats()['disk_bytes'] == 3 * 106
+    monkeypatch.setattr(os, 'walk', None)
+    cache.get(key('c'))
+    cache.put(key('d'), b'x' * 100, 'd.pbw')
+
+    assert cache.get(key('b')) is None
+    for name in 'acd':
+        assert cache.get(key(name)) is not None
+    cache.put(key('e'), b'x' * 200, 'e.pbw')
+    assert cache.get(key('a')) is None
+    assert cache.get(key('c')) is None
+    assert cache.stats()['disk_evictions'] == 3
+    assert cache.stats()['disk_bytes'] == 106 + 206
+    assert [os.path.exists(cache._path(key(name))) for name in 'abcde'] == \
+        [False, False, False, True, True]
+
+
+def test_reproducible_builds(template_pbw_stream, tmp_path):
+    info = load_sample('horizontal-stripes')
+    pbw, pbw_name = create_watchface(info, template_pbw_stream, reproducible=True)
+    assert create_watchface(info, template_pbw_stream, reproducible=True) == (pbw, pbw_name)
+    changed = dict(info, metadata=dict(info['metadata'], author='Someone else'))
+    assert create_watchface(changed, template_pbw_stream, reproducible=True)[0] != pbw
+
+    # Cached builds are the same pbw, whether from memory or from disk after a restart
+    cache = BuildCache(directory=str(tmp_path))
+    assert create_watchface(info, template_pbw_stream, cache=cache) == (pbw, pbw_name)
+    assert create_watchface(info, template_pbw_stream, cache=cache) == (pbw, pbw_name)
+    cache = BuildCache(directory=str(tmp_path))
+    assert create_watchface(info, template_pbw_stream, cache=cache) == (pbw, pbw_name)
+    assert cache.stats()['disk_hits'] == 1
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from build_coalescer import BuildCoalescer
+
+TIMEOUT = 10
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def run_concurrently(coalescer, key, build, count):
+    """
+    Start count threads running build through coalescer, returns the threads and a list their
+    results (or exceptions) end up in
+    """
+
+    results = []
+
+    def run():
+        try:
+            results.append(coalescer.run(key, build))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=run) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_identical_builds_share_one_run():
+    coalescer = BuildCoalescer()
+    release = threading.Event()
+    builds = []
+
+    def build():
+        builds.append(1)
+        assert release.wait(TIMEOUT)
+        return object()
+
+    threads, results = run_concurrently(coalescer, 'face', build, 4)
+    wait_for(lambda: coalescer.stats()['coalesced'] == 3)
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert len(builds) == 1
+    assert len(results) == 4 and all(result is results[0] for result in results)
+    assert coalescer.stats() == {'builds': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_different_keys_build_separately():
+    coalescer = BuildCoalescer()
+    assert coalescer.run('a', lambda: 1) == 1
+    assert coalescer.run('b', lambda: 2) == 2
+    # Finished builds aren't kept
+    assert coalescer.run('a', lambda: 3) == 3
+    assert coalescer.stats() == {'builds': 3, 'coalesced': 0, 'in_flight': 0}
+
+
+def test_failures_are_shared_and_not_kept():
+    coalescer = BuildCoalescer()
+    release = threading.Event()
+
+    def build():
+        assert release.wait(TIMEOUT)
+        raise ValueError("bad watchface")
+
+    threads, results = run_concurrently(coalescer, 'face', build, 3)
+    wait_for(lambda: coalescer.stats()['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert len(results) == 3 and all(isinstance(result, ValueError) for result in results)
+    assert coalescer.run('face', lambda: 'fixed') == 'fixed'
+    with pytest.raises(KeyError):
+        coalescer.run('face', lambda: {}['missing'])
@@ -0,0 +1,146 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from build_graph import BuildGraph
+from build_trace import Tracer
+from conftest import bundle_files, load_sample, make_bundle
+from create_watchface import create_watchface, create_watchface_from_bundle
+
+
+class FakeGenerator(object):
+    """
+    Builds resource_dict['data'] upper-cased. With per_platform the output depends on the
+    platform, so nothing is shared between platforms.
+    """
+
+    type = 'fake'
+
+    def __init__(self, per_platform=False, before_build=None):
+        self.per_platform = per_platform
+        self.before_build = before_build
+        self.built = []
+        self.lock = threading.Lock()
+
+    def definitions_from_dict(self, platform, resource_dict):
+        return [SimpleNamespace(name=resource_dict['name'], data=resource_dict['data'])]
+
+    def generate_object(self, platform, definition):
+        if self.before_build is not None:
+            self.before_build(definition.name)
+        with self.lock:
+            self.built.append((platform, definition.name))
+        data = bytes(definition.data).upper()
+        if self.per_platform:
+            data += platform.encode('ascii')
+        return SimpleNamespace(data=data)
+
+    def platform_inputs(self, platform):
+        return {'platform': platform} if self.per_platform else {}
+
+
+def resource(name, data):
+    return {'name': name, 'type': 'raw', 'data': data}
+
+
+def test_alike_resources_are_built_once():
+    generator = FakeGenerator()
+    tracer = Tracer()
+    graph = BuildGraph(tracer=tracer)
+    nodes = {platform: graph.add_resource(platform, resource('A', b'a'), generator)
+             for platform in ('basalt', 'chalk')}
+    packs = [graph.add_pack(platform, [node]) for platform, node in nodes.items()]
+
+    graph.run()
+
+    assert generator.built == [('basalt', 'A')]
+    assert [node.result for node in nodes.values()] == ['built', 'shared']
+    assert nodes['chalk'].data is nodes['basalt'].data
+    assert packs[0].stream.getvalue() == packs[1].stream.getvalue()
+    assert tracer.counters == {'resource_built': 1, 'resource_shared': 1}
+
+
+def test_known_resources_are_reused():
+    generator = FakeGenerator(per_platform=True)
+    known_resources = {'fingerprint-a': b'from an earlier build'}
+    graph = BuildGraph(known_resources)
+    reused = graph.add_resource('basalt', resource('A', b'a'), generator, 'fingerprint-a')
+    built = graph.add_resource('basalt', resource('B', b'b'), generator, 'fingerprint-b')
+    pack = graph.add_pack('basalt', [reused, built])
+
+    graph.run()
+
+    assert generator.built == [('basalt', 'B')]
+    assert (reused.result, built.result) == ('reused', 'built')
+    assert reused.data == b'from an earlier build'
+    # Newly built resources are added for the next build
+    assert known_resources['fingerprint-b'] == b'Bbasalt'
+    assert pack.done
+
+
+def test_memo_is_shared_between_graphs():
+    generator = FakeGenerator()
+    memo = {}
+    for expected in ('built', 'shared'):
+        graph = BuildGraph(memo=memo)
+        node = graph.add_resource('basalt', resource('A', b'a'), generator)
+        graph.run()
+        assert node.result == expected
+    assert len(generator.built) == 1
+
+
+def test_pack_assembled_when_its_own_resources_are_done():
+    # basalt's only resource is quick, chalk's waits until basalt's pack is ready
+    graph = BuildGraph()
+    basalt_pack = []
+    seen = {}
+
+    def before_build(name):
+        if name == 'slow':
+            deadline = time.monotonic() + 10
+            while not basalt_pack[0].done and time.monotonic() < deadline:
+                time.sleep(0.001)
+            seen['basalt_done'] = basalt_pack[0].done
+            seen['chalk_done'] = chalk_pack.done
+
+    generator = FakeGenerator(per_platform=True, before_build=before_build)
+    quick = graph.add_resource('basalt', resource('quick', b'q'), generator)
+    slow = graph.add_resource('chalk', resource('slow', b's'), generator)
+    basalt_pack.append(graph.add_pack('basalt', [quick]))
+    chalk_pack = graph.add_pack('chalk', [slow])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        graph.run(executor)
+
+    assert seen == {'basalt_done': True, 'chalk_done': False}
+    assert chalk_pack.done
+
+
+@pytest.mark.parametrize('sample', ['googly-eyes', 'horizontal-stripes'])
+def test_serial_thread_and_process_builds_match(sample, template_pbw_stream):
+    info = load_sample(sample)
+    tracer = Tracer()
+    serial = create_watchface(info, template_pbw_stream, reproducible=True, tracer=tracer)
+    if sample == 'googly-eyes':
+        # Its platforms have fonts in common
+        assert tracer.counters['resource_shared'] > 0
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert create_watchface(info, template_pbw_stream, reproducible=True,
+                                executor=executor) == serial
+    tracer = Tracer()
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert create_watchface(info, template_pbw_stream, reproducible=True, executor=executor,
+                                tracer=tracer) == serial
+    assert any(span.args.get('process') for span in tracer.spans)
+
+
+def test_process_build_of_memoryview_assets(template_pbw_stream):
+    # Assets in a stored zip are memoryviews into the archive, they can't be pickled as they are
+    bundle = make_bundle('stored.zip', bundle_files('horizontal-stripes'))
+    serial = create_watchface_from_bundle(bundle, template_pbw_stream, reproducible=True)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert create_watchface_from_bundle(bundle, template_pbw_stream, reproducible=True,
+                                            executor=executor) == serial
@@ -0,0 +1,76 @@
+import os
+import pickle
+import subprocess
+import sys
+from io import BytesIO
+
+import pytest
+
+from batch_build import run_batch
+from build_memory import MIB, MemoryBudgetExceeded, MemoryTracer
+from conftest import GENERATOR_DIR, SAMPLES_DIR, TEMPLATE_PBW_PATH, load_sample
+from create_watchface import watchface_pbw_name, write_watchface
+
+SAMPLE = 'hollow-knight'
+# Decoding the sample's assets alone takes more than this
+TINY_BUDGET = 64 * 1024
+
+
+def test_budget_exceeded(template_pbw_stream):
+    tracer = MemoryTracer(TINY_BUDGET, snapshot_top=0)
+    try:
+        with pytest.raises(MemoryBudgetExceeded) as e:
+            write_watchface(BytesIO(), load_sample(SAMPLE), template_pbw_stream, tracer=tracer)
+    finally:
+        tracer.close()
+
+    assert e.value.budget == TINY_BUDGET
+    assert e.value.used > TINY_BUDGET
+    assert e.value.kind in ('python', 'rss')
+    assert e.value.stage
+    # Sent back from worker processes as is
+    copy = pickle.loads(pickle.dumps(e.value))
+    assert (copy.stage, copy.used, copy.budget, copy.kind, str(copy)) == \
+        (e.value.stage, e.value.used, e.value.budget, e.value.kind, str(e.value))
+
+
+def test_within_budget(template_pbw_stream):
+    tracer = MemoryTracer(512 * MIB, snapshot_top=0)
+    try:
+        write_watchface(BytesIO(), load_sample(SAMPLE), template_pbw_stream, tracer=tracer)
+    finally:
+        tracer.close()
+    assert 0 < tracer.peak_traced < 512 * MIB
+
+
+def run_cli(output_dir, memory_budget):
+    return subprocess.run(
+        [sys.executable, 'create_watchface.py', TEMPLATE_PBW_PATH,
+         os.path.join(SAMPLES_DIR, SAMPLE, 'watchface_info.json'), str(output_dir),
+         '--memory-budget', str(memory_budget)],
+        cwd=GENERATOR_DIR, capture_output=True, text=True)
+
+
+def test_cli_leaves_no_partial_pbw(tmp_path):
+    result = run_cli(tmp_path, TINY_BUDGET / MIB)
+    assert result.returncode != 0
+    assert 'Error: Build used' in result.stderr
+    assert os.listdir(tmp_path) == []
+
+    result = run_cli(tmp_path, 512)
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(tmp_path) == [watchface_pbw_name(load_sample(SAMPLE))]
+
+
+def test_batch_leaves_no_partial_pbw(tmp_path):
+    output_dir = tmp_path / 'out'
+    info_path = os.path.join(SAMPLES_DIR, SAMPLE, 'watchface_info.json')
+    report = run_batch(TEMPLATE_PBW_PATH, [info_path], str(output_dir), workers=1,
+                       memory_budget=TINY_BUDGET)
+
+    assert report['failed'] == 1
+    result, = report['jobs']
+    assert result['status'] == 'error'
+    assert result['error'].startswith('MemoryBudgetExceeded: ')
+    assert result['memory_peak'] > TINY_BUDGET
+    assert os.listdir(output_dir) == []
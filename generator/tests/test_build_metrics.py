@@ -0,0 +1,86 @@
+import pytest
+
+from build_metrics import REGISTRY, MetricsRegistry
+from conftest import load_sample, parse_exposition
+from create_watchface import create_watchface
+
+
+@pytest.fixture
+def registry():
+    # Only count what the test does
+    REGISTRY.drain()
+    yield REGISTRY
+    REGISTRY.drain()
+
+
+def test_sample_build_metrics(registry, template_pbw_stream):
+    pbw, pbw_name = create_watchface(load_sample('horizontal-stripes'), template_pbw_stream)
+    samples = parse_exposition(registry.render())
+
+    assert samples[('watchface_platform_builds_total', (('platform', 'basalt'),))] == 1
+    assert samples[('watchface_build_seconds_count', ())] == 1
+    for resource_type, count in (('font', 3), ('png', 1), ('raw', 1)):
+        labels = (('type', resource_type),)
+        assert samples[('watchface_resources_generated_total', labels)] == count
+        assert samples[('watchface_resource_generate_seconds_count', labels)] == count
+    assert samples[('watchface_font_glyphs_total', ())] > 0
+    # Counted without known_resources too
+    assert samples[('watchface_resource_lookups_total', (('result', 'built'),))] == 5
+    # One 180x180 background
+    assert samples[('watchface_image_pixels_total', ())] == 180 * 180
+    assert samples[('watchface_pbpack_bytes_count', (('platform', 'basalt'),))] == 1
+    assert 16384 < samples[('watchface_pbpack_bytes_sum', (('platform', 'basalt'),))] <= 65536
+    assert samples[('watchface_pbpack_bytes_bucket', (('platform', 'basalt'), ('le', '16384')))] \
+        == 0
+    assert samples[('watchface_pbpack_bytes_bucket', (('platform', 'basalt'), ('le', '65536')))] \
+        == 1
+
+
+def test_exposition_format():
+    registry = MetricsRegistry()
+    counter = registry.counter('test_requests_total', 'Requests', ('path',))
+    histogram = registry.histogram('test_seconds', 'Time', buckets=(0.1, 1))
+    counter.inc(path='/build')
+    counter.inc(2, path='/a "quoted"\\path\n')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == '\n'.join([
+        '# HELP test_requests_total Requests',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{path="/a \\"quoted\\"\\\\path\\n"} 2',
+        'test_requests_total{path="/build"} 1',
+        '# HELP test_seconds Time',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.55',
+        'test_seconds_count 3',
+    ]) + '\n'
+    parse_exposition(registry.render())
+
+    with pytest.raises(ValueError):
+        counter.inc(method='GET')
+    with pytest.raises(ValueError):
+        registry.counter('test_requests_total', 'Again')
+
+
+def test_drain_and_merge():
+    worker = MetricsRegistry()
+    parent = MetricsRegistry()
+    for registry in (worker, parent):
+        registry.counter('test_builds_total', 'Builds')
+        registry.histogram('test_seconds', 'Time', buckets=(1,))
+
+    worker.metrics['test_builds_total'].inc(3)
+    worker.metrics['test_seconds'].observe(0.5)
+    parent.metrics['test_builds_total'].inc()
+    parent.merge(worker.drain())
+    parent.merge(worker.drain())
+
+    samples = parse_exposition(parent.render())
+    assert samples[('test_builds_total', ())] == 4
+    assert samples[('test_seconds_count', ())] == 1
+    assert parse_exposition(worker.render()) == {}
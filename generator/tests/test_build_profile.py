@@ -0,0 +1,83 @@
+import os
+import pstats
+import time
+
+import pytest
+
+from build_profile import BuildProfiler
+from conftest import load_sample
+from create_watchface import create_watchface
+
+MODULE = os.path.basename(__file__)
+BUSY_SECONDS = 0.3
+
+
+def busy_leaf(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += 1
+    return total
+
+
+def busy_caller(seconds):
+    return busy_leaf(seconds)
+
+
+def test_sample_mode(tmp_path):
+    with BuildProfiler('sample', interval=0.002) as profiler:
+        busy_caller(BUSY_SECONDS)
+
+    collapsed = profiler.collapsed_stacks()
+    assert collapsed and all(weight > 0 for weight in collapsed.values())
+    # Stacks run from the outermost frame in, and this thread spent nearly all its time here
+    busy = {stack: weight for stack, weight in collapsed.items()
+            if stack.endswith(f'{MODULE}:busy_caller;{MODULE}:busy_leaf')}
+    assert sum(busy.values()) >= 0.8 * sum(collapsed.values())
+    assert all(stack.split(';').index(f'{MODULE}:test_sample_mode') <
+               stack.split(';').index(f'{MODULE}:busy_caller') for stack in busy)
+
+    top = profiler.top_functions()
+    function, own, total, calls = top[0]
+    assert function == f'{MODULE}:busy_leaf'
+    assert calls is None
+    assert own <= total
+    # Samples are scaled to the time the profiler ran
+    assert 0.5 * BUSY_SECONDS <= sum(row[1] for row in profiler.top_functions(None)) <= \
+        1.5 * BUSY_SECONDS
+    rows = {row[0]: row for row in profiler.top_functions(None)}
+    assert rows[f'{MODULE}:busy_caller'][1] < rows[f'{MODULE}:busy_caller'][2]
+
+    paths = profiler.write(str(tmp_path / 'build'))
+    assert paths == [str(tmp_path / 'build.collapsed')]
+    with open(paths[0]) as f:
+        lines = f.read().splitlines()
+    assert {line.rsplit(' ', 1)[0]: int(line.rsplit(' ', 1)[1]) for line in lines} == collapsed
+
+
+def test_sample_mode_build(template_pbw_stream):
+    with BuildProfiler('sample', interval=0.001) as profiler:
+        create_watchface(load_sample('hollow-knight'), template_pbw_stream)
+
+    stacks = list(profiler.collapsed_stacks())
+    assert any('create_watchface.py:build_watchface_files' in stack for stack in stacks)
+    assert any('build_graph.py:run' in stack for stack in stacks)
+
+
+def test_cprofile_mode(tmp_path):
+    with BuildProfiler('cprofile') as profiler:
+        busy_caller(0.05)
+
+    assert any(stack.endswith(f'{MODULE}:busy_caller;{MODULE}:busy_leaf')
+               for stack in profiler.collapsed_stacks())
+    rows = {row[0]: row for row in profiler.top_functions(None)}
+    assert rows[f'{MODULE}:busy_leaf'][3] == 1
+
+    paths = profiler.write(str(tmp_path / 'build'))
+    assert paths == [str(tmp_path / 'build.pstats'), str(tmp_path / 'build.collapsed')]
+    pstats.Stats(paths[0])
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        BuildProfiler('perf')
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from build_scheduler import MIN_RETRY_AFTER, BuildScheduler, Deadline, DeadlineExceeded, \
+    SchedulerFull
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = BuildScheduler(workers=1, queue_limits={'interactive': 4, 'batch': 2})
+    yield scheduler
+    scheduler.shutdown()
+
+
+def occupy(scheduler):
+    """
+    Keep the scheduler's only worker busy until the returned event is set, so jobs submitted
+    meanwhile are queued
+    """
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        assert release.wait(TIMEOUT)
+
+    future = scheduler.submit(block, client='blocker')
+    assert started.wait(TIMEOUT)
+    return release, future
+
+
+def test_priority_order(scheduler):
+    release, blocker = occupy(scheduler)
+    order = []
+    futures = [scheduler.submit(order.append, 'batch-0', priority='batch'),
+               scheduler.submit(order.append, 'interactive-0', priority='interactive'),
+               scheduler.submit(order.append, 'batch-1', priority='batch'),
+               scheduler.submit(order.append, 'interactive-1', priority='interactive')]
+    release.set()
+    for future in [blocker] + futures:
+        future.result(TIMEOUT)
+
+    assert order == ['interactive-0', 'interactive-1', 'batch-0', 'batch-1']
+
+
+def test_clients_take_turns(scheduler):
+    release, blocker = occupy(scheduler)
+    order = []
+    futures = [scheduler.submit(order.append, name, client=name[0])
+               for name in ('a0', 'a1', 'a2', 'b0')]
+    release.set()
+    for future in [blocker] + futures:
+        future.result(TIMEOUT)
+
+    assert order == ['a0', 'b0', 'a1', 'a2']
+
+
+def test_full_queue_rejects_with_retry_after(scheduler):
+    release, blocker = occupy(scheduler)
+    futures = [scheduler.submit(lambda: 'batch', priority='batch') for i in range(2)]
+    # One job running and two queued ahead of a new batch job, 2s each
+    scheduler.average_seconds = 2
+
+    with pytest.raises(SchedulerFull) as e:
+        scheduler.submit(lambda: 'rejected', priority='batch')
+    assert e.value.priority == 'batch'
+    assert e.value.retry_after == 6
+    with pytest.raises(SchedulerFull):
+        scheduler.check_capacity('batch')
+
+    # Other priorities have their own queue, and batch jobs don't hold up interactive ones
+    scheduler.check_capacity('interactive')
+    futures.append(scheduler.submit(lambda: 'interactive', priority='interactive'))
+    release.set()
+    assert [future.result(TIMEOUT) for future in futures] == ['batch', 'batch', 'interactive']
+    blocker.result(TIMEOUT)
+
+    stats = scheduler.stats()
+    assert stats['rejected'] == 2
+    assert stats['submitted'] == 4
+    assert stats['completed'] == 4
+    # There's room again
+    scheduler.check_capacity('batch')
+
+
+def test_retry_after_minimum():
+    scheduler = BuildScheduler(workers=1, queue_limits={'interactive': 0})
+    try:
+        with pytest.raises(SchedulerFull) as e:
+            scheduler.submit(lambda: None)
+        assert e.value.retry_after == MIN_RETRY_AFTER
+    finally:
+        scheduler.shutdown()
+
+
+def test_expired_jobs_dont_run(scheduler):
+    release, blocker = occupy(scheduler)
+    ran = []
+    future = scheduler.submit(ran.append, 'expired', deadline=Deadline(0))
+    release.set()
+
+    with pytest.raises(DeadlineExceeded):
+        future.result(TIMEOUT)
+    blocker.result(TIMEOUT)
+    assert ran == []
+    assert scheduler.stats()['expired'] == 1
+
+
+def test_unknown_priority(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.submit(lambda: None, priority='urgent')
@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+from build_server import BuildServer
+from conftest import TEMPLATE_PBW_PATH, load_sample, parse_exposition
+from create_watchface import create_watchface
+
+SAMPLE_BODY = json.dumps(load_sample('horizontal-stripes')).encode('utf-8')
+WAIT_SECONDS = 30
+
+
+@pytest.fixture(scope='module')
+def server():
+    # One worker and room for one queued build, so the tests can fill the server up
+    server = BuildServer(('127.0.0.1', 0), TEMPLATE_PBW_PATH, workers=1,
+                         queue_limits={'interactive': 1, 'batch': 1})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def gate(server):
+    """
+    Holds builds before they're handed to the worker until gate.open.set(), gate.entered is set
+    once one is waiting
+    """
+
+    gate = SimpleNamespace(open=threading.Event(), entered=threading.Event())
+    build_on_worker = server.build_on_worker
+
+    def gated(*args):
+        gate.entered.set()
+        gate.open.wait(WAIT_SECONDS)
+        return build_on_worker(*args)
+
+    server.build_on_worker = gated
+    yield gate
+    gate.open.set()
+    del server.build_on_worker
+
+
+def request(server, path, body=None):
+    """
+    Returns (status, headers, body), HTTP errors included
+    """
+
+    url = f'http://127.0.0.1:{server.server_port}{path}'
+    try:
+        with urllib.request.urlopen(url, body, timeout=WAIT_SECONDS) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        with e:
+            return e.code, e.headers, e.read()
+
+
+def in_background(fn, *args):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fn(*args)))
+    thread.start()
+    return thread, results
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + WAIT_SECONDS
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_build(server, template_pbw_stream):
+    status, headers, pbw = request(server, '/build?reproducible=1', SAMPLE_BODY)
+
+    assert status == 200
+    expected, pbw_name = create_watchface(load_sample('horizontal-stripes'), template_pbw_stream,
+                                          reproducible=True)
+    assert pbw == expected
+    assert headers['Content-Type'] == 'application/octet-stream'
+    assert headers['Content-Disposition'] == f'attachment; filename="{pbw_name}"'
+    assert 'font;dur=' in headers['Server-Timing']
+
+
+def test_invalid_requests(server):
+    status, headers, body = request(server, '/build', b'{"customization": {}}')
+    assert status == 400
+    assert json.loads(body)['error'].startswith('Invalid watchface')
+
+    status, headers, body = request(server, '/build?compression=lzma', SAMPLE_BODY)
+    assert status == 400
+    assert request(server, '/nowhere')[0] == 404
+
+
+def test_health(server):
+    status, headers, body = request(server, '/health')
+
+    assert status == 200
+    health = json.loads(body)
+    assert health['status'] == 'ok'
+    assert health['workers'] == 1
+    assert set(health['coalescing']) == {'builds', 'coalesced', 'in_flight'}
+    assert health['scheduler']['queued'] == {'interactive': 0, 'batch': 0}
+
+
+def test_metrics_include_worker_builds(server):
+    def builds():
+        status, headers, body = request(server, '/metrics')
+        assert status == 200
+        assert headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        samples = parse_exposition(str(body, 'utf-8'))
+        return samples.get(('watchface_platform_builds_total', (('platform', 'basalt'),)), 0)
+
+    before = builds()
+    assert request(server, '/build?level=1', SAMPLE_BODY)[0] == 200
+    # Counted in the worker process and sent back with the build
+    assert builds() == before + 1
+
+
+def test_identical_requests_are_coalesced(server, gate):
+    stats = server.coalescer.stats()
+    first, first_result = in_background(request, server, '/build?level=2', SAMPLE_BODY)
+    assert gate.entered.wait(WAIT_SECONDS)
+    second, second_result = in_background(request, server, '/build?level=2', SAMPLE_BODY)
+    wait_for(lambda: server.coalescer.stats()['coalesced'] == stats['coalesced'] + 1)
+
+    gate.open.set()
+    first.join()
+    second.join()
+
+    assert first_result[0][0] == second_result[0][0] == 200
+    assert first_result[0][2] == second_result[0][2]
+    assert server.coalescer.stats()['builds'] == stats['builds'] + 1
+
+
+def test_rejected_when_the_queue_is_full(server, gate):
+    # One build waiting for the worker, one in the queue
+    running, running_result = in_background(request, server, '/build?level=3', SAMPLE_BODY)
+    assert gate.entered.wait(WAIT_SECONDS)
+    queued, queued_result = in_background(request, server, '/build?level=4', SAMPLE_BODY)
+    wait_for(lambda: server.scheduler.stats()['queued']['interactive'] == 1)
+
+    status, headers, body = request(server, '/build?level=5', SAMPLE_BODY)
+
+    assert status == 503
+    assert int(headers['Retry-After']) >= 1
+    assert json.loads(body)['retry_after'] == int(headers['Retry-After'])
+    # Batch builds have their own queue
+    batch, batch_result = in_background(request, server, '/build?level=5&priority=batch',
+                                        SAMPLE_BODY)
+    wait_for(lambda: server.scheduler.stats()['queued']['batch'] == 1)
+
+    gate.open.set()
+    for thread, result in ((running, running_result), (queued, queued_result),
+                           (batch, batch_result)):
+        thread.join()
+        assert result[0][0] == 200
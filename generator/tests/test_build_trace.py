@@ -0,0 +1,127 @@
+import json
+import pickle
+
+import pytest
+
+from build_trace import NULL_TRACER, Tracer
+from conftest import load_sample
+from create_watchface import create_watchface
+
+RESOURCES = {('png', 'IMAGE_BACKGROUND'), ('font', 'FONT_TIME_52'), ('font', 'FONT_DATE_32'),
+             ('font', 'FONT_TEXT_20'), ('raw', 'DATA')}
+
+
+@pytest.fixture
+def traced_build(template_pbw_stream):
+    # A single platform (basalt) sample
+    tracer = Tracer()
+    pbw, pbw_name = create_watchface(load_sample('horizontal-stripes'), template_pbw_stream,
+                                     tracer=tracer)
+    return tracer, pbw
+
+
+def spans_of(tracer, category):
+    return [span for span in sorted(tracer.spans, key=lambda span: span.start)
+            if span.category == category]
+
+
+def test_build_spans(traced_build):
+    tracer, pbw = traced_build
+
+    stages = spans_of(tracer, 'stage')
+    assert [span.name for span in stages] == \
+        ['decode', 'fingerprint', 'pack', 'binary', 'manifest', 'zip']
+    stages = {span.name: span for span in stages}
+    assert stages['pack'].args['bytes_out'] + stages['binary'].args['bytes_out'] == \
+        stages['manifest'].args['bytes_in']
+    assert stages['zip'].args['bytes_out'] == len(pbw)
+    assert all(span.seconds >= 0 for span in tracer.spans)
+
+    resources = spans_of(tracer, 'resource')
+    assert {(span.name, span.args['resource']) for span in resources} == RESOURCES
+    for span in resources:
+        assert span.args['platform'] == 'basalt'
+        assert span.args['cached'] is False
+        assert span.args['bytes_in'] > 0 and span.args['bytes_out'] > 0
+        # Resources are built before their pack
+        assert span.start + span.seconds <= stages['pack'].start
+
+    platform, = spans_of(tracer, 'platform')
+    assert platform.name == 'platform'
+    assert platform.args == {'platform': 'basalt'}
+    # The platform span holds its binary and manifest
+    for name in ('binary', 'manifest'):
+        assert platform.start <= stages[name].start
+        assert stages[name].start + stages[name].seconds <= platform.start + platform.seconds
+
+    assert tracer.counters == {'resource_built': len(RESOURCES)}
+
+
+def test_summary(traced_build):
+    tracer, pbw = traced_build
+    summary = tracer.summary()
+
+    assert summary['font']['category'] == 'resource'
+    assert summary['font']['count'] == 3
+    assert summary['font']['bytes_out'] == sum(span.args['bytes_out'] for span in tracer.spans
+                                               if span.name == 'font')
+    assert summary['zip']['bytes_out'] == len(pbw)
+    assert summary['platform'] == {'category': 'platform', 'count': 1,
+                                   'seconds': summary['platform']['seconds']}
+
+
+def test_chrome_trace(traced_build):
+    tracer, pbw = traced_build
+    trace = json.loads(json.dumps(tracer.chrome_trace()))
+
+    assert trace['displayTimeUnit'] == 'ms'
+    assert trace['otherData'] == {'counters': {'resource_built': len(RESOURCES)}}
+    events = trace['traceEvents']
+    assert len(events) == len(tracer.spans)
+    assert [event['ts'] for event in events] == sorted(event['ts'] for event in events)
+    for event in events:
+        assert set(event) == {'name', 'cat', 'ph', 'ts', 'dur', 'pid', 'tid', 'args'}
+        assert event['ph'] == 'X'
+        assert event['ts'] >= 0 and event['dur'] >= 0
+        assert event['pid'] == tracer.pid
+    assert {(event['name'], event['args']['resource']) for event in events
+            if event['cat'] == 'resource'} == RESOURCES
+
+
+def test_shared_resources(template_pbw_stream):
+    # hollow-knight targets several platforms, most of their resources come out the same
+    watchface_info = load_sample('hollow-knight')
+    tracer = Tracer()
+    create_watchface(watchface_info, template_pbw_stream, tracer=tracer)
+
+    resources = spans_of(tracer, 'resource')
+    shared = [span for span in resources if span.args.get('shared')]
+    built = [span for span in resources if not span.args['cached']]
+    assert shared and built
+    assert len(shared) + len(built) == len(resources)
+    assert tracer.counters == {'resource_built': len(built), 'resource_shared': len(shared)}
+    assert [span.args['platform'] for span in spans_of(tracer, 'platform')] == \
+        watchface_info['metadata']['target_platforms']
+    assert tracer.summary()['platform']['count'] == len(watchface_info['metadata']
+                                                       ['target_platforms'])
+
+
+def test_failed_span_and_pickling():
+    tracer = Tracer()
+    with pytest.raises(KeyError):
+        with tracer.span('png', 'resource', platform='basalt'):
+            raise KeyError('image_data')
+    tracer.count('resource_built')
+
+    copy = pickle.loads(pickle.dumps(tracer))
+    span, = copy.spans
+    assert (span.name, span.category, span.args) == \
+        ('png', 'resource', {'platform': 'basalt', 'error': 'KeyError'})
+    assert copy.counters == {'resource_built': 1}
+
+
+def test_null_tracer():
+    with NULL_TRACER.span('decode') as span:
+        span.set(bytes_out=1)
+    NULL_TRACER.count('resource_built')
+    assert not NULL_TRACER.enabled
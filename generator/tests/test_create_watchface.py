@@ -0,0 +1,176 @@
+import base64
+import copy
+import json
+import os
+import tracemalloc
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import stm32_crc
+from build_memory import MemoryTracer
+from build_trace import Tracer
+from conftest import load_sample
+from create_watchface import (blen, convert_base64_to_bytes, create_watchface,
+                              create_watchface_variants, merge_overlay, stm32crc)
+
+DATA_SIZE = 4 * 1024 * 1024
+# What tracemalloc and the tracer's own bookkeeping allocate within a span
+SPAN_OVERHEAD = 16 * 1024
+
+
+def traced_peak(fn, *args):
+    """
+    Highest Python memory allocated while fn(*args) runs, above where it started
+    """
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('offset', [0, 1])
+def test_sizes_and_crcs_read_data_in_place(offset):
+    data = memoryview(os.urandom(DATA_SIZE))[offset:]
+    assert traced_peak(blen, data) < 1024
+    # Only one chunk at a time is bit-reversed
+    assert traced_peak(stm32crc, data) < 4 * stm32_crc.CRC_CHUNK_SIZE
+
+
+def test_crc32_parts():
+    parts = [os.urandom(size) for size in (0, 1, 2, 3, 5, 4096, 7, DATA_SIZE, 6)]
+    assert stm32_crc.crc32_parts(parts) == stm32_crc.crc32(b''.join(parts))
+    assert traced_peak(stm32_crc.crc32_parts, parts) < 4 * stm32_crc.CRC_CHUNK_SIZE
+
+
+def test_base64_decoded_without_copying_the_text():
+    data = os.urandom(DATA_SIZE)
+    text = base64.b64encode(data).decode('ascii')
+    assert convert_base64_to_bytes(text) == data
+    assert traced_peak(convert_base64_to_bytes, text) < DATA_SIZE + SPAN_OVERHEAD
+
+
+def test_build_stages_dont_copy(template_pbw_stream, monkeypatch):
+    # With small CRC chunks, a stage that copies its input stands out even for a small sample
+    monkeypatch.setattr(stm32_crc, 'CRC_CHUNK_SIZE', 1024)
+    watchface_info = load_sample('hollow-knight')
+    # Leave imports and other first build costs out of it
+    create_watchface(load_sample('hollow-knight'), template_pbw_stream)
+
+    tracer = MemoryTracer(snapshot_top=0)
+    try:
+        create_watchface(watchface_info, template_pbw_stream, tracer=tracer)
+    finally:
+        tracer.close()
+
+    stages = [span for span in tracer.spans if span.category == 'stage']
+    assert {span.name for span in stages} >= {'decode', 'pack', 'binary', 'manifest'}
+    for span in stages:
+        peak = span.args['memory_peak']
+        label = (span.name, span.args.get('platform'))
+        if span.name in ('decode', 'pack', 'binary'):
+            # Assets are decoded straight from the base64 text, the pbpacks and the patched
+            # binary are built once
+            assert peak < span.args['bytes_out'] + SPAN_OVERHEAD, label
+        elif span.name == 'manifest':
+            # The sizes and CRCs of the pbpack and binary are taken in place
+            assert peak < SPAN_OVERHEAD, label
+
+
+def test_merge_overlay():
+    base = load_sample('horizontal-stripes')['customization']
+    original = copy.deepcopy(base)
+    merged = merge_overlay(base, {'date': {'colour': '#FF0000', 'enabled': True},
+                                  'background': {'image_data': 'AAAA'}})
+
+    assert merged['date']['colour'] == '#FF0000'
+    assert merged['date']['enabled'] is True
+    # Keys the overlay doesn't mention come from base
+    assert merged['date']['format'] == base['date']['format']
+    assert merged['background']['image_data'] == 'AAAA'
+    assert merged['clocks'] is base['clocks']
+    assert base == original
+
+
+def test_variants_match_separate_builds(template_pbw_stream):
+    base = load_sample('horizontal-stripes')
+    original = copy.deepcopy(base)
+    overlays = [{'date': {'colour': '#FF0000', 'enabled': True}},
+                {'text': {'text': 'Second variant', 'enabled': True}}]
+    tracer = Tracer()
+
+    variants = create_watchface_variants(json.dumps(base), overlays, template_pbw_stream,
+                                         reproducible=True, tracer=tracer)
+
+    assert base == original
+    assert len(variants) == len(overlays)
+    for (pbw, pbw_name), overlay in zip(variants, overlays):
+        variant_info = dict(base, customization=merge_overlay(base['customization'], overlay))
+        assert (pbw, pbw_name) == create_watchface(variant_info, template_pbw_stream,
+                                                   reproducible=True)
+    assert variants[0][0] != variants[1][0]
+    # The second variant only builds what its overlay changed
+    assert tracer.counters.get('resource_reused', 0) > 0
+
+
+def replace_file(pbw, path, data):
+    output = BytesIO()
+    with zipfile.ZipFile(BytesIO(pbw)) as zip_in, zipfile.ZipFile(output, 'w') as zip_out:
+        for name in zip_in.namelist():
+            zip_out.writestr(name, data if name == path else zip_in.read(name))
+    return output.getvalue()
+
+
+def test_incremental_rebuild_matches_clean_build(template_pbw_stream):
+    base = load_sample('horizontal-stripes')
+    previous, _ = create_watchface(base, template_pbw_stream, reproducible=True)
+    changed = copy.deepcopy(base)
+    changed['customization']['background']['image_data'] = \
+        load_sample('vertical-stripes')['customization']['background']['image_data']
+    tracer = Tracer()
+
+    rebuilt = create_watchface(changed, template_pbw_stream, reproducible=True,
+                               previous_pbw=previous, tracer=tracer)
+
+    assert rebuilt == create_watchface(changed, template_pbw_stream, reproducible=True)
+    # Only the background changed
+    assert tracer.counters['resource_built'] == 1
+    assert tracer.counters['resource_reused'] == 4
+
+
+def test_previous_pbw_content_is_checked(template_pbw_stream):
+    info = load_sample('horizontal-stripes')
+    previous, _ = create_watchface(info, template_pbw_stream, reproducible=True)
+    other, _ = create_watchface(load_sample('vertical-stripes'), template_pbw_stream)
+    pbpack_path = 'basalt/app_resources.pbpack'
+    # A pbpack that doesn't belong with the manifest, as if it was swapped since
+    with zipfile.ZipFile(BytesIO(other)) as other_zip:
+        stale = replace_file(previous, pbpack_path, other_zip.read(pbpack_path))
+    tracer = Tracer()
+
+    rebuilt = create_watchface(info, template_pbw_stream, reproducible=True, previous_pbw=stale,
+                               tracer=tracer)
+
+    assert rebuilt == create_watchface(info, template_pbw_stream, reproducible=True)
+    assert tracer.counters['resource_built'] > 0
+    # A pbpack that can't be read at all means everything is rebuilt
+    tracer = Tracer()
+    corrupt = replace_file(previous, pbpack_path, b'not a pbpack')
+    assert create_watchface(info, template_pbw_stream, reproducible=True, previous_pbw=corrupt,
+                            tracer=tracer) == rebuilt
+    assert 'resource_reused' not in tracer.counters
+
+
+def test_library_build_prints_nothing(template_pbw_stream, capsys, caplog):
+    with caplog.at_level('INFO', logger='create_watchface'):
+        create_watchface(load_sample('horizontal-stripes'), template_pbw_stream)
+
+    assert capsys.readouterr().out == ''
+    # The uuid is logged instead
+    assert any(record.getMessage().startswith('UUID: 13371337') for record in caplog.records)
@@ -0,0 +1,65 @@
+import base64
+
+import pytest
+
+from build_metrics import REGISTRY
+from conftest import load_sample
+from font.face_pool import FacePool
+
+FACES = 'watchface_font_face_pool_requests_total'
+EVICTIONS = 'watchface_font_face_pool_evictions_total'
+
+
+@pytest.fixture(scope='module')
+def fonts():
+    # Two different TTF files
+    customization = load_sample('googly-eyes')['customization']
+    return [base64.b64decode(customization['date']['font_data']),
+            base64.b64decode(customization['clocks']['digital']['font_data'])]
+
+
+@pytest.fixture
+def metrics():
+    # Only count what the test does
+    REGISTRY.drain()
+    yield REGISTRY.drain
+    REGISTRY.drain()
+
+
+def test_face_is_reused(fonts, metrics):
+    pool = FacePool()
+    with pool.face(fonts[0], 20) as face:
+        assert face.size.y_ppem == 20
+    with pool.face(fonts[0], 32) as again:
+        assert again is face
+        # Resized for the new user
+        assert again.size.y_ppem == 32
+    with pool.face(fonts[1], 20) as other:
+        assert other is not face
+
+    assert pool.stats() == {'hits': 1, 'misses': 2, 'evictions': 0, 'idle_faces': 2,
+                            'max_faces': 8}
+    assert metrics() == {FACES: {(('result', 'hit'),): 1, (('result', 'miss'),): 2}}
+
+
+def test_face_in_use_is_not_shared(fonts):
+    pool = FacePool()
+    with pool.face(fonts[0], 20) as face:
+        with pool.face(fonts[0], 20) as other:
+            assert other is not face
+    assert pool.stats()['misses'] == 2
+    assert pool.stats()['idle_faces'] == 2
+
+
+def test_least_recently_used_face_is_evicted(fonts, metrics):
+    pool = FacePool(max_faces=1)
+    with pool.face(fonts[0], 20) as first:
+        pass
+    with pool.face(fonts[1], 20):
+        pass
+    with pool.face(fonts[0], 20) as face:
+        assert face is not first
+
+    assert pool.stats() == {'hits': 0, 'misses': 3, 'evictions': 2, 'idle_faces': 1,
+                            'max_faces': 1}
+    assert metrics() == {FACES: {(('result', 'miss'),): 3}, EVICTIONS: {(): 2}}
@@ -0,0 +1,74 @@
+import base64
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+from build_metrics import REGISTRY
+from conftest import load_sample
+from resources.resource_map.font_worker_pool import FontWorkerPool
+from resources.resource_map.resource_generator_font import (build_font_bitstring,
+                                                            font_params_from_definition)
+
+
+def font_definition(name, **params):
+    definition = SimpleNamespace(name=name, max_glyph_size=256, character_list=None,
+                                 character_regex=None, compatibility=None, compress=None,
+                                 extended=False, tracking_adjust=None)
+    for param, value in params.items():
+        setattr(definition, param, value)
+    return definition
+
+
+DEFINITIONS = [
+    font_definition('FONT_TIME_52', character_regex='[0-9:]'),
+    font_definition('FONT_DATE_32', character_regex='[0-9/-]', compress='RLE4'),
+    font_definition('FONT_TEXT_20'),
+]
+
+
+@pytest.fixture(scope='module')
+def font_data():
+    return base64.b64decode(load_sample('horizontal-stripes')['customization']['date']['font_data'])
+
+
+@pytest.fixture
+def pool():
+    with FontWorkerPool(max_workers=2) as pool:
+        yield pool
+
+
+def in_process(data, definition):
+    return build_font_bitstring(BytesIO(data), font_params_from_definition(definition))
+
+
+def test_font_sent_once(pool, font_data):
+    expected = [in_process(font_data, definition) for definition in DEFINITIONS] * 2
+    REGISTRY.drain()
+    assert [pool.build_font_data(font_data, definition)
+            for definition in DEFINITIONS * 2] == expected
+
+    # Builds of one font all go to the worker that already has it
+    assert pool.stats() == {'workers': 2, 'digest_hits': 5, 'data_sends': 1, 'retries': 0}
+    # The worker's metrics are merged in here: it parsed the font once and reused the face
+    assert REGISTRY.drain()['watchface_font_face_pool_requests_total'] == \
+        {(('result', 'hit'),): 5, (('result', 'miss'),): 1}
+
+
+def test_missing_font_is_resent(pool, font_data):
+    definition = DEFINITIONS[0]
+    assert pool.build_font_data(font_data, definition) == in_process(font_data, definition)
+    # As if the worker had been replaced since
+    for executor in pool.executors:
+        executor.submit(_forget_fonts).result()
+
+    assert pool.build_font_data(BytesIO(font_data), definition) == \
+        in_process(font_data, definition)
+    assert pool.stats() == {'workers': 2, 'digest_hits': 0, 'data_sends': 2, 'retries': 1}
+    assert pool.build_font_data(font_data, definition) == in_process(font_data, definition)
+    assert pool.stats()['digest_hits'] == 1
+
+
+def _forget_fonts():
+    from resources.resource_map import font_worker_pool
+    font_worker_pool._worker_fonts.clear()
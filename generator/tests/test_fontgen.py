@@ -0,0 +1,175 @@
+import collections
+import random
+import struct
+import types
+
+import pytest
+
+from font.fontgen import (Font, GLYPH_BATCH_SIZE, HASH_BUCKET_TARGET_SIZE, HASH_TABLE_SIZE,
+                          MAX_GLYPHS_EXTENDED, MAX_OFFSET_TABLE_OFFSET, RLE4Error,
+                          choose_hash_table_size)
+
+
+def make_font(max_glyph_size):
+    # check_decompress_glyph_RLE4 only needs the glyph header, the buffer size and a name
+    font = Font.__new__(Font)
+    font.name = b'Test_Regular'
+    font.max_glyph_size = max_glyph_size
+    font.glyph_header = '<BBbbb'
+    return font
+
+
+def reference_check(font, glyph_packed, rle_units):
+    # The in-place decode simulation check_decompress_glyph_RLE4 used to run, returns whether
+    # the glyph decodes in place
+    header_size = struct.calcsize(font.glyph_header)
+    dst_ptr = header_size
+    src_ptr = font.max_glyph_size - len(glyph_packed)
+    if src_ptr < 0:
+        return False
+    bitmap = [0] * font.max_glyph_size
+    bitmap[-len(glyph_packed):] = glyph_packed
+
+    out_num_bits = 0
+    while rle_units > 0:
+        unit_pair = bitmap[src_ptr]
+        src_ptr += 1
+        for i in range(min(rle_units, 2)):
+            out_num_bits += (unit_pair & 0x07) + 1
+            if out_num_bits >= 8:
+                if dst_ptr >= src_ptr or dst_ptr >= font.max_glyph_size:
+                    return False
+                dst_ptr += 1
+                out_num_bits -= 8
+            unit_pair >>= 4
+            rle_units -= 1
+    if out_num_bits > 0 and dst_ptr >= font.max_glyph_size:
+        return False
+    return True
+
+
+def accepts(font, glyph_packed, rle_units):
+    try:
+        return font.check_decompress_glyph_RLE4(glyph_packed, 0, rle_units)
+    except RLE4Error:
+        return False
+
+
+def test_rle4_round_trip_units():
+    font = make_font(256)
+    glyph_packed, units = font.compress_glyph_RLE4(b'\x01' * 4 + b'\x00' + b'\x01' * 3)
+    assert units == 3
+    assert glyph_packed == bytes([0x0B, 0x0A, 0, 0])
+
+
+def test_rle4_check_small_src_start():
+    # An 89px line compressed into 24 bytes of 47 units used to be rejected with a 27 byte
+    # buffer, although the decoder never overtakes its input
+    rng = random.Random(89)
+    for attempt in range(10000):
+        bitmap = bytes(rng.choice((0, 1)) for i in range(89))
+        glyph_packed, units = make_font(27).compress_glyph_RLE4(bitmap)
+        if len(glyph_packed) == 24 and units == 47:
+            break
+    else:
+        pytest.fail("No 89px line compresses to 24 bytes of 47 units")
+    font = make_font(27)
+    assert reference_check(font, glyph_packed, units)
+    assert accepts(font, glyph_packed, units)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rle4_check_matches_decode_simulation(seed):
+    rng = random.Random(seed)
+    for i in range(300):
+        width = rng.randint(1, 120)
+        # Long runs compress well, short ones badly, mix both
+        run_bias = rng.random()
+        bitmap = bytearray()
+        pixel = rng.choice((0, 1))
+        while len(bitmap) < width:
+            if rng.random() < run_bias:
+                pixel ^= 1
+            bitmap.append(pixel)
+        glyph_packed, units = make_font(256).compress_glyph_RLE4(bytes(bitmap))
+        for max_glyph_size in range(max(len(glyph_packed) - 2, 1), len(glyph_packed) + 24):
+            font = make_font(max_glyph_size)
+            assert accepts(font, glyph_packed, units) == \
+                reference_check(font, glyph_packed, units), (bytes(bitmap), max_glyph_size)
+
+
+def brute_force_table_size(codepoints):
+    # Tables with fewer than HASH_BUCKET_TARGET_SIZE glyphs per entry are never considered
+    smallest_size = min(max(-(-len(codepoints) // HASH_BUCKET_TARGET_SIZE), 1), HASH_TABLE_SIZE)
+    longest = {table_size: max(collections.Counter(cp % table_size for cp in codepoints).values())
+               for table_size in range(smallest_size, HASH_TABLE_SIZE + 1)}
+    good = [table_size for table_size in longest if longest[table_size] <= HASH_BUCKET_TARGET_SIZE]
+    if good:
+        return min(good)
+    return min(longest, key=lambda table_size: (longest[table_size], table_size))
+
+
+@pytest.mark.parametrize('count', [1, 4, 5, 95, 300, 600, 1100, 5000])
+def test_choose_hash_table_size(count):
+    rng = random.Random(count)
+    for codepoints in (list(range(0x20, 0x20 + count)), rng.sample(range(0x20, 0x30000), count)):
+        assert choose_hash_table_size(codepoints) == brute_force_table_size(codepoints)
+
+
+class FakeFace(object):
+    """
+    A freetype face with an 8x8 square glyph for each of codepoints
+    """
+
+    family_name = b'Test'
+    style_name = b'Regular'
+
+    def __init__(self, codepoints):
+        self.codepoints = list(codepoints)
+        self.glyph = types.SimpleNamespace(
+            bitmap=types.SimpleNamespace(width=8, rows=8, pitch=1, pixel_mode=1,
+                                         buffer=[0xFF] * 8),
+            advance=types.SimpleNamespace(x=9 * 64), bitmap_left=0, bitmap_top=8)
+
+    def get_first_char(self):
+        return self.get_next_char(None, 0)
+
+    def get_next_char(self, codepoint, gindex):
+        if gindex >= len(self.codepoints):
+            return 0, 0
+        return self.codepoints[gindex], gindex + 1
+
+    def load_glyph(self, gindex, flags):
+        pass
+
+
+def large_font(codepoints):
+    return Font(b'', 10, MAX_GLYPHS_EXTENDED, 256, False, face=FakeFace(codepoints))
+
+
+def test_large_font_is_cut_at_the_limit():
+    font = large_font(range(0x20, 0x20 + 2 * MAX_GLYPHS_EXTENDED))
+    progress = []
+
+    font.build_tables(lambda done, total: progress.append(done))
+
+    # The wildcard plus MAX_GLYPHS_EXTENDED glyphs
+    assert font.number_of_glyphs == MAX_GLYPHS_EXTENDED + 1
+    assert progress[-1] == font.number_of_glyphs
+    assert len(progress) == -(-font.number_of_glyphs // GLYPH_BATCH_SIZE)
+    assert font.offset_size_bytes == 4
+    assert len(font.offset_tables) <= MAX_OFFSET_TABLE_OFFSET + 1
+    # Every bucket's offset points at its own glyphs
+    offset_entry = struct.Struct('<HL')
+    for i in range(font.table_size):
+        value, size, offset = struct.unpack_from('<BBH', font.hash_table, i * 4)
+        for j in range(size):
+            codepoint, glyph_offset = offset_entry.unpack_from(font.offset_tables,
+                                                                offset + j * offset_entry.size)
+            assert codepoint % font.table_size == i
+
+
+def test_large_font_with_4_byte_codepoints_does_not_fit():
+    font = large_font(range(0x10000, 0x10000 + MAX_GLYPHS_EXTENDED))
+    with pytest.raises(Exception, match="offset tables don't fit"):
+        font.build_tables()
@@ -0,0 +1,56 @@
+import base64
+import json
+import random
+from io import BytesIO
+
+import png
+import pytest
+
+from conftest import TEMPLATE_PBW_PATH
+from create_watchface import create_watchface
+from load_test import (FONT_SIZES, PLATFORMS, load_seeds, percentile,
+                       synthesize_watchface_info)
+
+
+@pytest.fixture(scope='module')
+def seeds():
+    return load_seeds()
+
+
+def test_synthesized_documents_are_repeatable(seeds):
+    first = [synthesize_watchface_info(random.Random(7), seeds, i) for i in range(3)]
+    again = [synthesize_watchface_info(random.Random(7), seeds, i) for i in range(3)]
+    assert json.dumps(first) == json.dumps(again)
+    other = synthesize_watchface_info(random.Random(8), seeds, 0)
+    assert json.dumps(other) != json.dumps(first[0])
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_synthesized_document_builds(seeds, seed):
+    info = synthesize_watchface_info(random.Random(seed), seeds, seed)
+
+    platforms = info['metadata']['target_platforms']
+    assert platforms and set(platforms) <= set(PLATFORMS)
+    assert info['metadata']['name'] == f'Load Test {seed}'
+    background = info['customization']['background']
+    for key in ('image_data', 'bw_image_data'):
+        width, height, rows, image_info = png.Reader(
+            bytes=base64.b64decode(background[key])).read()
+        assert (width, height) == (background['width'], background['height'])
+    fonts = {'digital': info['customization']['clocks']['digital'],
+             'date': info['customization']['date'], 'text': info['customization']['text']}
+    for name, element in fonts.items():
+        low, high = FONT_SIZES[name]
+        assert low <= element['font_size'] <= high
+
+    with open(TEMPLATE_PBW_PATH, 'rb') as f:
+        pbw, pbw_name = create_watchface(json.dumps(info), BytesIO(f.read()))
+    assert pbw_name.endswith('.pbw')
+
+
+def test_percentile():
+    values = list(range(100, 0, -1))
+    assert [percentile(values, percent) for percent in (0, 50, 90, 99, 100)] == \
+        [1, 50, 90, 99, 100]
+    assert percentile([0.5], 99) == 0.5
+    assert percentile([3, 1, 2], 50) == 2
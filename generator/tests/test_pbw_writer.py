@@ -0,0 +1,39 @@
+import os
+import stat
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import pbw_writer
+from pbw_writer import write_pbw
+
+ENTRIES = [('appinfo.json', b'{"uuid": "x"}'), ('basalt/app_resources.pbpack', os.urandom(5000)),
+           ('basalt/pebble-app.bin', bytes(20000)), ('été.txt', memoryview(b'summer'))]
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_write_pbw(compression):
+    f_out = BytesIO()
+    size = write_pbw(f_out, ENTRIES, b'comment', compression, date_time=(2024, 1, 2, 3, 4, 6))
+    assert size == f_out.tell()
+
+    with zipfile.ZipFile(f_out) as z:
+        assert z.testzip() is None
+        assert z.comment == b'comment'
+        assert [(info.filename, z.read(info)) for info in z.infolist()] == \
+            [(path, bytes(data)) for path, data in ENTRIES]
+        for info in z.infolist():
+            assert info.compress_type == compression
+            # Made on Unix, so unzip applies the mode
+            assert info.create_system == 3
+            assert info.external_attr >> 16 == stat.S_IFREG | 0o644
+            assert info.date_time == (2024, 1, 2, 3, 4, 6)
+
+
+def test_compress_executor_is_shared():
+    write_pbw(BytesIO(), ENTRIES)
+    executor = pbw_writer._compress_executor
+    write_pbw(BytesIO(), ENTRIES)
+    assert executor is not None and pbw_writer._compress_executor is executor
+    assert executor._max_workers == pbw_writer.COMPRESS_WORKERS
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import stm32_crc
+
+
+def reference_crc(data, crc=0xffffffff):
+    """
+    The STM32 CRC one word at a time through the lookup table
+    """
+
+    for i in range(0, len(data), 4):
+        crc = stm32_crc.process_word(data[i:i + 4], crc)
+    return crc
+
+
+@pytest.mark.parametrize('data, crc', [
+    (b'123 567 901 34', 0x89f3bab2),
+    (b'123456789', 0xaff19057),
+    (b'\xfe\xff\xfe\xff', 0x519b130),
+    (b'\xfe\xff\xfe\xff\x88', 0x495e02ca),
+    (b'', 0xffffffff),
+])
+def test_known_values(data, crc):
+    assert stm32_crc.crc32(data) == crc
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 5, 7, 8, 1023, 4096, 4097])
+def test_matches_table_crc(size, monkeypatch):
+    # Small chunks, so the larger sizes span several of them
+    monkeypatch.setattr(stm32_crc, 'CRC_CHUNK_SIZE', 1024)
+    data = os.urandom(size)
+    assert stm32_crc.crc32(data) == reference_crc(data)
+    assert stm32_crc.crc32(memoryview(data)) == reference_crc(data)
+    # Carrying on from an earlier CRC
+    assert stm32_crc.process_buffer(data, 0x12345678) == reference_crc(data, 0x12345678)
@@ -0,0 +1,52 @@
+import json
+import zipfile
+from io import BytesIO, StringIO
+
+import pytest
+
+import streaming_json
+from conftest import load_sample
+from create_watchface import create_watchface_from_stream
+from streaming_json import load_watchface_info
+
+
+@pytest.fixture(params=[streaming_json.READ_CHUNK_SIZE, 1, 5])
+def chunk_size(request, monkeypatch):
+    # Small chunks split escapes across reads
+    monkeypatch.setattr(streaming_json, 'READ_CHUNK_SIZE', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('text', [
+    '"\\u00e9\\/\\n"',
+    '"\\ud83d\\ude00"',
+    '"a\\ud83d\\ude00b\\ud834\\udd1e"',
+    # Lone surrogates are kept, like json does
+    '"\\ud83d"',
+    '"\\ud83dx"',
+    '"\\ud83d\\u0041"',
+    '"\\ude00"',
+])
+def test_unicode_escapes(chunk_size, text):
+    document = '{"name": %s}' % text
+    assert load_watchface_info(StringIO(document)) == json.loads(document)
+
+
+@pytest.mark.parametrize('text', ['"\\u12g4"', '"\\u+123"', '"\\ud83d\\u12"', '"\\u00'])
+def test_invalid_unicode_escapes(chunk_size, text):
+    with pytest.raises(ValueError):
+        load_watchface_info(StringIO('{"name": %s}' % text))
+
+
+def test_astral_plane_name(template_pbw_stream):
+    watchface_info = load_sample('horizontal-stripes')
+    watchface_info['metadata']['name'] = 'Stripes \U0001F600'
+    # json escapes the emoji as a surrogate pair
+    info_stream = BytesIO(json.dumps(watchface_info).encode('ascii'))
+    assert b'\\ud83d\\ude00' in info_stream.getvalue()
+
+    pbw, pbw_name = create_watchface_from_stream(info_stream, template_pbw_stream)
+    assert pbw_name == 'stripes-\U0001F600.pbw'
+    with zipfile.ZipFile(BytesIO(pbw)) as z:
+        assert z.testzip() is None
+        assert json.loads(z.read('appinfo.json'))['longName'] == 'Stripes \U0001F600'